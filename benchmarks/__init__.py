@@ -0,0 +1 @@
+"""Benchmarks of the models and the data pipeline on synthetic data"""
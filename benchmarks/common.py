@@ -0,0 +1,196 @@
+# pylint: disable=no-member, invalid-name, too-many-arguments, too-many-locals
+"""Shared setup of the benchmarks: synthetic data, configs, models and step timing"""
+from importlib import import_module
+import os
+import platform
+import subprocess
+import time
+
+import numpy as np
+import torch
+from torch import nn
+
+from omegaconf import DictConfig, OmegaConf, open_dict
+
+from src.data import common_processor, data_postfactory
+from src.dataloader import dataloader_factory
+from src.memory import ActivationMeter, memory_snapshot, reset_peak_rss
+from src.model import model_factory
+from src.model_utils import optimizer_factory, scheduler_factory
+from src.settings import PROJECT_ROOT
+from src.trainer import trainer_factory
+
+CONF_ROOT = PROJECT_ROOT.joinpath("src", "conf")
+
+
+class NotATorchModel(Exception):
+    """The model is not a torch module (e.g. sklearn LogisticRegression), it can't be benchmarked"""
+
+
+def available_models():
+    """Names of the models with configs in src/conf/model"""
+    return sorted(path.stem for path in CONF_ROOT.joinpath("model").files("*.yaml"))
+
+
+def available_datasets():
+    """Names of the datasets with configs in src/conf/dataset"""
+    return sorted(path.stem for path in CONF_ROOT.joinpath("dataset").files("*.yaml"))
+
+
+def synthetic_dataset(n_samples, time_length, feature_size, n_classes=2, seed=42):
+    """Random TS data [n_samples, time_length, feature_size] (float32) and balanced labels"""
+    rng = np.random.default_rng(seed)
+    ts_data = rng.standard_normal((n_samples, time_length, feature_size), dtype=np.float32)
+    labels = rng.permutation(np.arange(n_samples) % n_classes)
+    return ts_data, labels
+
+
+def benchmark_cfg(model_name, dataset_name, batch_size, run_dir):
+    """
+    Experiment config of model_name on the synthetic dataset_name, with the exp mode defaults,
+    one training epoch and no side features (resumable states, profiling)
+    """
+    cfg = OmegaConf.create(
+        {
+            "mode": OmegaConf.load(CONF_ROOT.joinpath("mode", "exp.yaml")),
+            "model": OmegaConf.load(CONF_ROOT.joinpath("model", f"{model_name}.yaml")),
+            "dataset": {"name": dataset_name, "zscore": False},
+            "run_dir": str(run_dir),
+        }
+    )
+    cfg.mode.batch_size = batch_size
+    cfg.mode.max_epochs = 1
+    cfg.mode.train_state_every = None
+    cfg.mode.micro_batching = False
+    cfg.mode.autotune_batch_size = False
+    return cfg
+
+
+def default_model_cfg(cfg: DictConfig):
+    """Default HPs of the model, without pretrained weights (the benchmarks don't have them)"""
+    model_module = import_module(f"src.models.{cfg.model.name}")
+    model_cfg = model_module.default_HPs(cfg)
+    if "load_pretrained" in model_cfg:
+        model_cfg.load_pretrained = False
+    return model_cfg
+
+
+def process_data(cfg: DictConfig, ts_data, labels):
+    """Run common_processor on the synthetic data, save data_info in cfg, return the processed data"""
+    data, data_info = common_processor(cfg, (ts_data, labels))
+    set_data_info(cfg, data_info)
+    return {"main": data}
+
+
+def set_data_info(cfg: DictConfig, data_info):
+    """Save data_info of the main dataset in cfg, as data_factory does"""
+    with open_dict(cfg):
+        cfg.dataset.data_info = {"main": data_info}
+
+
+def build_run(cfg: DictConfig, data):
+    """Build model config, dataloaders, model and trainer for the processed data, the same way a run does"""
+    model_cfg = default_model_cfg(cfg)
+    data = data_postfactory(cfg, model_cfg, data)
+    dataloaders = dataloader_factory(cfg, data, k=0, trial=0)
+    model = model_factory(cfg, model_cfg)
+    if not isinstance(model, nn.Module):
+        raise NotATorchModel(f"'{cfg.model.name}' is not a torch model")
+    optimizer = optimizer_factory(cfg, model_cfg, model)
+    scheduler = scheduler_factory(cfg, model_cfg, optimizer)
+    os.makedirs(cfg.run_dir, exist_ok=True)
+    trainer = trainer_factory(cfg, model_cfg, dataloaders, model, optimizer, scheduler)
+    return model_cfg, dataloaders, trainer
+
+
+def synchronize(device):
+    """Wait for the queued work on the device"""
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def time_step(model, batch, device, n_steps, warmup=1):
+    """
+    Mean forward and backward time (seconds) of the model on a dataloader batch (inputs..., target),
+    activation memory saved for backward (MB) and CUDA peak memory (MB, None on CPU).
+    The backward pass is driven by the sum of the logits, so it doesn't depend on the model's criterion
+    """
+    inputs = [tensor.to(device) for tensor in batch[:-1]]
+    model.train()
+    meter = ActivationMeter(model)
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+    forward_time, backward_time = 0.0, 0.0
+    for i in range(warmup + n_steps):
+        synchronize(device)
+        start_time = time.perf_counter()
+        with meter:
+            output = model(*inputs)
+        logits = output[0] if isinstance(output, (tuple, list)) else output
+        synchronize(device)
+        middle_time = time.perf_counter()
+        logits.float().sum().backward()
+        synchronize(device)
+        end_time = time.perf_counter()
+        model.zero_grad(set_to_none=True)
+        if i >= warmup:
+            forward_time += middle_time - start_time
+            backward_time += end_time - middle_time
+
+    return {
+        "forward_time": forward_time / n_steps,
+        "backward_time": backward_time / n_steps,
+        "activation_mb": meter.peak / 2**20,
+        "cuda_peak_mb": torch.cuda.max_memory_allocated(device) / 2**20 if device.type == "cuda" else None,
+    }
+
+
+def time_epoch(trainer):
+    """Time one training epoch with the trainer's hot path; returns seconds and samples/second"""
+    n_samples = len(trainer.dataloaders["train"].dataset)
+    synchronize(trainer.device)
+    start_time = time.perf_counter()
+    trainer.run_epoch("train")
+    synchronize(trainer.device)
+    epoch_time = time.perf_counter() - start_time
+    return {"epoch_time": epoch_time, "epoch_samples_per_s": n_samples / epoch_time}
+
+
+def benchmark_model(cfg: DictConfig, data, n_steps, epoch=True):
+    """
+    Benchmark the model on processed data: forward/backward step time and throughput,
+    activation and peak memory, and (optionally) a full training epoch
+    """
+    reset_peak_rss()
+    _, dataloaders, trainer = build_run(cfg, data)
+    batch = next(iter(dataloaders["train"]))
+    batch_size = batch[-1].shape[0]
+
+    results = time_step(trainer.model, batch, trainer.device, n_steps)
+    results["batch_size"] = batch_size
+    results["params"] = sum(p.numel() for p in trainer.model.parameters())
+    results["forward_samples_per_s"] = batch_size / results["forward_time"]
+    results["step_samples_per_s"] = batch_size / (results["forward_time"] + results["backward_time"])
+    if epoch:
+        results.update(time_epoch(trainer))
+    results["peak_rss_mb"] = memory_snapshot(trainer.device)["peak_rss_mb"]
+    return results
+
+
+def environment():
+    """Description of the host and software the benchmarks ran on"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=PROJECT_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "host": platform.node(),
+        "device": torch.cuda.get_device_name(0) if torch.cuda.is_available() else platform.processor(),
+        "threads": torch.get_num_threads(),
+        "torch": torch.__version__,
+        "python": platform.python_version(),
+        "commit": commit,
+    }
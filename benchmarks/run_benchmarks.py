@@ -0,0 +1,196 @@
+# pylint: disable=invalid-name, too-many-locals, broad-except
+"""
+Benchmark every model on synthetic data at the shapes of the real datasets ('shape' entries of src/conf/dataset):
+forward/backward and full-epoch throughput, peak memory, and the data path stages.
+Results are appended to the JSON history and compared against the stored baseline.
+By default the synthetic datasets are capped at DEFAULT_MAX_SAMPLES subjects (the shapes of the samples
+are kept); --full uses the real dataset sizes, which takes hours per recurrent model at the UKB shape.
+
+Usage:
+    PYTHONPATH=. python benchmarks/run_benchmarks.py --datasets fbirn hcp --models mlp dice
+    PYTHONPATH=. python benchmarks/run_benchmarks.py --save-baseline
+    PYTHONPATH=. python benchmarks/run_benchmarks.py --full --models DBNglassFIX
+"""
+import argparse
+from datetime import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+import traceback
+
+import pandas as pd
+
+from benchmarks.common import (
+    NotATorchModel,
+    available_datasets,
+    available_models,
+    benchmark_cfg,
+    benchmark_model,
+    environment,
+    process_data,
+    set_data_info,
+    synthetic_dataset,
+)
+from src.data import dataset_shape
+from src.dataloader import common_dataloader
+from src.settings import BENCHMARKS_ROOT, UTCNOW
+
+HISTORY_PATH = BENCHMARKS_ROOT.joinpath("history.jsonl")
+BASELINE_PATH = BENCHMARKS_ROOT.joinpath("baseline.json")
+# lower is better for all compared metrics
+MODEL_METRICS = ["forward_time", "backward_time", "epoch_time", "activation_mb", "cuda_peak_mb", "peak_rss_mb"]
+DATA_METRICS = ["time"]
+# one dataset per distinct shape by default
+DEFAULT_DATASETS = ["fbirn", "fbirn_roi", "abide_869", "abide_roi", "oasis", "hcp", "hcp_roi_752", "ukb"]
+# cap on the number of synthetic subjects, unless the full run is requested
+DEFAULT_MAX_SAMPLES = 256
+
+
+def run_benchmarks(models, datasets, batch_size, n_steps, max_samples=None, epoch=True):
+    """Return model benchmark rows and data path rows"""
+    model_rows, data_rows = [], []
+    for dataset_name in datasets:
+        shape = dataset_shape(dataset_name)
+        n_samples = shape["n_samples"] if max_samples is None else min(shape["n_samples"], max_samples)
+        ts_data, labels = synthetic_dataset(
+            n_samples, shape["time_length"], shape["feature_size"], shape["n_classes"]
+        )
+        print(f"Dataset {dataset_name}: {ts_data.shape}")
+
+        # processed data is shared by the models with the same data type
+        processed = {}
+        with tempfile.TemporaryDirectory() as run_dir:
+            for model_name in models:
+                cfg = benchmark_cfg(model_name, dataset_name, batch_size, run_dir)
+                data_type = cfg.model.data_type if "data_type" in cfg.model else "TS"
+                row = {"model": model_name, "dataset": dataset_name, "data_type": data_type, "n_samples": n_samples}
+
+                if data_type not in processed:
+                    start_time = time.perf_counter()
+                    data = process_data(cfg, ts_data, labels)
+                    data_rows.append(
+                        {"stage": "common_processor", "dataset": dataset_name, "data_type": data_type,
+                         "time": time.perf_counter() - start_time}
+                    )
+                    start_time = time.perf_counter()
+                    common_dataloader(cfg, data, k=0, trial=0)
+                    data_rows.append(
+                        {"stage": "common_dataloader", "dataset": dataset_name, "data_type": data_type,
+                         "time": time.perf_counter() - start_time}
+                    )
+                    processed[data_type] = (data, cfg.dataset.data_info.main)
+                data, data_info = processed[data_type]
+                set_data_info(cfg, data_info)
+
+                print(f"Benchmarking {model_name} on {dataset_name}")
+                try:
+                    row.update(benchmark_model(cfg, data, n_steps, epoch=epoch))
+                    row["status"] = "ok"
+                except NotATorchModel as e:
+                    row["status"] = f"skipped: {e}"
+                except Exception:
+                    traceback.print_exc()
+                    row["status"] = "error: " + traceback.format_exc(limit=1).strip().splitlines()[-1]
+                model_rows.append(row)
+
+    return model_rows, data_rows
+
+
+def compare(record, baseline, tolerance):
+    """
+    Return a comparison table of the record against the baseline:
+    baseline and current values, their ratio, and whether it is a regression (ratio > 1 + tolerance)
+    """
+    rows = []
+    for kind, keys, metrics in [
+        ("models", ["model", "dataset"], MODEL_METRICS),
+        ("data", ["stage", "dataset", "data_type"], DATA_METRICS),
+    ]:
+        base = {tuple(row[key] for key in keys): row for row in baseline[kind]}
+        for row in record[kind]:
+            base_row = base.get(tuple(row[key] for key in keys))
+            if base_row is None or row.get("status", "ok") != "ok":
+                continue
+            for metric in metrics:
+                value, base_value = row.get(metric), base_row.get(metric)
+                if value is None or base_value is None or base_value == 0:
+                    continue
+                ratio = value / base_value
+                rows.append({
+                    "name": "/".join(str(row[key]) for key in keys),
+                    "metric": metric,
+                    "baseline": base_value,
+                    "current": value,
+                    "ratio": ratio,
+                    "regression": ratio > 1 + tolerance,
+                })
+    return pd.DataFrame(rows, columns=["name", "metric", "baseline", "current", "ratio", "regression"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--models", nargs="+", default=None, help="models from src/conf/model (default: all)")
+    parser.add_argument("--datasets", nargs="+", default=DEFAULT_DATASETS, choices=available_datasets())
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--n-steps", type=int, default=5, help="timed forward/backward steps")
+    parser.add_argument("--max-samples", type=int, default=DEFAULT_MAX_SAMPLES,
+                        help="cap on the number of synthetic subjects (default: %(default)s)")
+    parser.add_argument("--full", action="store_true", help="use the real dataset sizes, ignores --max-samples")
+    parser.add_argument("--no-epoch", action="store_true", help="skip the full epoch timing")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown against the baseline")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit with code 1 on regressions")
+    args = parser.parse_args()
+
+    models = args.models if args.models is not None else available_models()
+    max_samples = None if args.full else args.max_samples
+    model_rows, data_rows = run_benchmarks(
+        models, args.datasets, args.batch_size, args.n_steps, max_samples, epoch=not args.no_epoch
+    )
+    record = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "environment": environment(),
+        "settings": {"batch_size": args.batch_size, "n_steps": args.n_steps, "max_samples": max_samples},
+        "models": model_rows,
+        "data": data_rows,
+    }
+
+    os.makedirs(BENCHMARKS_ROOT, exist_ok=True)
+    with open(HISTORY_PATH, "a", encoding="utf8") as f:
+        f.write(json.dumps(record, default=str) + "\n")
+
+    print(pd.DataFrame(model_rows).to_string(index=False))
+    print(pd.DataFrame(data_rows).to_string(index=False))
+
+    exit_code = 0
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH, "r", encoding="utf8") as f:
+            baseline = json.load(f)
+        if baseline["environment"]["device"] != record["environment"]["device"]:
+            print(f"Warning: the baseline was recorded on {baseline['environment']['device']}")
+        if baseline["settings"] != record["settings"]:
+            print(f"Warning: the baseline was recorded with different settings {baseline['settings']}")
+        report = compare(record, baseline, args.tolerance)
+        report_path = BENCHMARKS_ROOT.joinpath(f"report_{UTCNOW}.csv")
+        report.to_csv(report_path, index=False)
+        regressions = report[report["regression"]]
+        print(f"Comparison with the baseline of {baseline['timestamp']} is saved to {report_path}")
+        if len(regressions) != 0:
+            print("Regressions:")
+            print(regressions.to_string(index=False))
+            exit_code = int(args.fail_on_regression)
+        else:
+            print("No regressions")
+
+    if args.save_baseline or not os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH, "w", encoding="utf8") as f:
+            json.dump(record, f, indent=2, default=str)
+        print(f"Baseline is saved to {BASELINE_PATH}")
+
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
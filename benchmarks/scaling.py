@@ -0,0 +1,197 @@
+# pylint: disable=invalid-name, too-many-locals, too-many-arguments, broad-except
+"""
+Scaling curves of the models over the number of components C, time length T and batch size B.
+Each axis is swept over its grid with the other two fixed at the base point;
+step time and peak memory are measured on synthetic data, and the empirical exponents
+(time ~ x^k) are fitted on the log-log curves. The fits are extrapolated to the target C values,
+e.g. to check if moving from 53 ICA components to 200/400 ROIs is feasible for a model.
+
+Usage:
+    PYTHONPATH=. python benchmarks/scaling.py --models DBNglassFIX dice bnt --C 16 32 53 100 200 --extrapolate-C 400
+"""
+import argparse
+import math
+import os
+import tempfile
+import traceback
+
+import matplotlib
+
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt  # pylint: disable=wrong-import-position
+import numpy as np
+import pandas as pd
+import torch
+
+from benchmarks.common import (  # pylint: disable=wrong-import-position
+    NotATorchModel,
+    benchmark_cfg,
+    benchmark_model,
+    process_data,
+    synthetic_dataset,
+)
+from src.memory import is_oom_error  # pylint: disable=wrong-import-position
+from src.settings import BENCHMARKS_ROOT, UTCNOW  # pylint: disable=wrong-import-position
+
+AXES = {"C": "feature_size", "T": "time_length", "B": "batch_size"}
+# measured quantities, which get exponent fits
+QUANTITIES = ["step_time", "activation_mb", "cuda_peak_mb"]
+
+
+def measure_point(model_name, feature_size, time_length, batch_size, n_steps, run_dir):
+    """Step time and memory of the model at one (C, T, B) point"""
+    # enough subjects for a full training batch after the test and validation splits
+    n_samples = math.ceil(batch_size / 0.6) + 10
+    ts_data, labels = synthetic_dataset(n_samples, time_length, feature_size)
+    cfg = benchmark_cfg(model_name, "synthetic", batch_size, run_dir)
+    data = process_data(cfg, ts_data, labels)
+    results = benchmark_model(cfg, data, n_steps, epoch=False)
+    results["step_time"] = results["forward_time"] + results["backward_time"]
+    return results
+
+
+def sweep(model_name, grids, base, n_steps):
+    """
+    Sweep each axis of grids ({"C": [...], "T": [...], "B": [...]}) with the others fixed at base.
+    Larger values of an axis are skipped after an out of memory error
+    """
+    rows = []
+    with tempfile.TemporaryDirectory() as run_dir:
+        for axis, grid in grids.items():
+            for value in sorted(grid):
+                point = {**base, axis: value}
+                row = {"model": model_name, "axis": axis, "value": value, **point}
+                print(f"{model_name}: C={point['C']}, T={point['T']}, B={point['B']}")
+                try:
+                    results = measure_point(model_name, point["C"], point["T"], point["B"], n_steps, run_dir)
+                    row.update({key: results[key] for key in ["params", *QUANTITIES]})
+                    row["status"] = "ok"
+                except NotATorchModel as e:
+                    print(e)
+                    return rows
+                except Exception as e:
+                    if not is_oom_error(e):
+                        traceback.print_exc()
+                        row["status"] = "error"
+                        rows.append(row)
+                        continue
+                    row["status"] = "oom"
+                    rows.append(row)
+                    break
+                finally:
+                    if torch.cuda.is_available():
+                        torch.cuda.empty_cache()
+                rows.append(row)
+    return rows
+
+
+def fit_exponents(df):
+    """Fit log(quantity) = log(a) + k * log(value) for each model, axis and quantity"""
+    rows = []
+    for (model_name, axis), group in df[df["status"] == "ok"].groupby(["model", "axis"]):
+        for quantity in QUANTITIES:
+            points = group[["value", quantity]].dropna()
+            points = points[points[quantity] > 0]
+            if len(points) < 2:
+                continue
+            exponent, log_scale = np.polyfit(np.log(points["value"]), np.log(points[quantity]), 1)
+            rows.append({
+                "model": model_name,
+                "axis": axis,
+                "quantity": quantity,
+                "exponent": exponent,
+                "scale": math.exp(log_scale),
+                "n_points": len(points),
+            })
+    return pd.DataFrame(rows, columns=["model", "axis", "quantity", "exponent", "scale", "n_points"])
+
+
+def extrapolate(exponents, targets):
+    """Predict the quantities at the target C values from the C-axis fits (other axes at the base point)"""
+    rows = []
+    for _, fit in exponents[exponents["axis"] == "C"].iterrows():
+        for target in targets:
+            rows.append({
+                "model": fit["model"],
+                "quantity": fit["quantity"],
+                "C": target,
+                "predicted": fit["scale"] * target ** fit["exponent"],
+            })
+    return pd.DataFrame(rows, columns=["model", "quantity", "C", "predicted"])
+
+
+def plot_curves(df, exponents, save_dir):
+    """Save log-log scaling curves of each model: a row per quantity, a column per axis"""
+    for model_name, model_df in df[df["status"] == "ok"].groupby("model"):
+        fig, axes = plt.subplots(len(QUANTITIES), len(AXES), figsize=(4 * len(AXES), 3 * len(QUANTITIES)))
+        for i, quantity in enumerate(QUANTITIES):
+            for j, axis in enumerate(AXES):
+                ax = axes[i][j]
+                points = model_df[model_df["axis"] == axis][["value", quantity]].dropna()
+                if len(points) == 0:
+                    ax.set_visible(False)
+                    continue
+                ax.loglog(points["value"], points[quantity], "o-", label="measured")
+                fit = exponents[
+                    (exponents["model"] == model_name)
+                    & (exponents["axis"] == axis)
+                    & (exponents["quantity"] == quantity)
+                ]
+                if len(fit) != 0:
+                    fit = fit.iloc[0]
+                    ax.loglog(
+                        points["value"], fit["scale"] * points["value"] ** fit["exponent"], "--",
+                        label=f"fit: k={fit['exponent']:.2f}",
+                    )
+                    ax.legend()
+                ax.set_xlabel(axis)
+                ax.set_ylabel(quantity)
+        fig.suptitle(model_name)
+        fig.tight_layout()
+        fig.savefig(f"{save_dir}/{model_name}_scaling.png")
+        plt.close(fig)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--models", nargs="+", required=True, help="models from src/conf/model")
+    parser.add_argument("--C", nargs="+", type=int, default=[16, 32, 53, 100, 200], help="components grid")
+    parser.add_argument("--T", nargs="+", type=int, default=[50, 100, 200, 400, 800], help="time length grid")
+    parser.add_argument("--B", nargs="+", type=int, default=[8, 16, 32, 64, 128], help="batch size grid")
+    parser.add_argument("--base", nargs=3, type=int, default=[53, 140, 32], metavar=("C", "T", "B"),
+                        help="fixed values of the axes which are not swept")
+    parser.add_argument("--n-steps", type=int, default=3, help="timed forward/backward steps per point")
+    parser.add_argument("--extrapolate-C", nargs="+", type=int, default=[200, 400],
+                        help="C values to predict the step time and memory at")
+    parser.add_argument("--save-dir", default=None, help=f"default: {BENCHMARKS_ROOT}/scaling_<time>")
+    args = parser.parse_args()
+
+    save_dir = args.save_dir or BENCHMARKS_ROOT.joinpath(f"scaling_{UTCNOW}")
+    os.makedirs(save_dir, exist_ok=True)
+    grids = {"C": args.C, "T": args.T, "B": args.B}
+    base = dict(zip(AXES, args.base))
+
+    rows = []
+    for model_name in args.models:
+        rows += sweep(model_name, grids, base, args.n_steps)
+    df = pd.DataFrame(rows)
+    if len(df) == 0:
+        print("Nothing was measured")
+        return
+    df.to_csv(f"{save_dir}/scaling_points.csv", index=False)
+
+    exponents = fit_exponents(df)
+    exponents.to_csv(f"{save_dir}/scaling_exponents.csv", index=False)
+    predictions = extrapolate(exponents, args.extrapolate_C)
+    predictions.to_csv(f"{save_dir}/scaling_predictions.csv", index=False)
+    plot_curves(df, exponents, save_dir)
+
+    print("Empirical exponents (quantity ~ axis^k):")
+    print(exponents.pivot_table(index=["model", "quantity"], columns="axis", values="exponent").to_string())
+    print(f"Predictions at C={args.extrapolate_C} (T={base['T']}, B={base['B']}):")
+    print(predictions.to_string(index=False))
+    print(f"Results are saved to {save_dir}")
+
+
+if __name__ == "__main__":
+    main()
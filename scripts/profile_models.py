@@ -0,0 +1,136 @@
+# pylint: disable=invalid-name, too-many-locals, broad-except
+"""
+Static profiler of the models: parameters, activation memory and FLOPs per sample,
+for every model x dataset config combination in src/conf, without allocating real memory.
+Models are built on the meta device from their default HPs and the dataset's data_info,
+which is derived from a few synthetic subjects at the dataset's shape (the 'shape' entry of its config).
+
+Usage:
+    PYTHONPATH=. python scripts/profile_models.py
+    PYTHONPATH=. python scripts/profile_models.py --models DBNglassFIX dice --datasets fbirn hcp_roi_752
+"""
+import argparse
+from importlib import import_module
+import os
+import sys
+import traceback
+
+import numpy as np
+import pandas as pd
+
+from omegaconf import OmegaConf, open_dict
+
+from src.data import common_processor, data_postfactory, dataset_shape
+from src.profiling import static_profile
+from src.settings import BENCHMARKS_ROOT, PROJECT_ROOT, UTCNOW
+
+CONF_ROOT = PROJECT_ROOT.joinpath("src", "conf")
+# order of the inputs in the batches of common_dataloader
+KEY_ORDER = ["TS", "FNC"]
+# synthetic subjects used to derive data_info and the post-processed input shapes
+N_PROBE_SAMPLES = 4
+
+
+def config_names(kind):
+    """Names of the configs in src/conf/{kind}"""
+    return sorted(path.stem for path in CONF_ROOT.joinpath(kind).files("*.yaml"))
+
+
+def prepare(model_name, dataset_name, shape):
+    """
+    Return cfg, default model_cfg and per-sample input shapes of the model on the dataset,
+    after common_processor and the model's data_postfactory
+    """
+    cfg = OmegaConf.create(
+        {
+            "mode": OmegaConf.load(CONF_ROOT.joinpath("mode", "exp.yaml")),
+            "model": OmegaConf.load(CONF_ROOT.joinpath("model", f"{model_name}.yaml")),
+            "dataset": {"name": dataset_name, "zscore": False},
+        }
+    )
+    rng = np.random.default_rng(42)
+    ts_data = rng.standard_normal((N_PROBE_SAMPLES, shape["time_length"], shape["feature_size"]), dtype=np.float32)
+    labels = np.arange(N_PROBE_SAMPLES) % shape["n_classes"]
+    data, data_info = common_processor(cfg, (ts_data, labels))
+    # data_info describes the full dataset
+    if OmegaConf.is_dict(data_info.data_shape):
+        for key in data_info.data_shape:
+            data_info.data_shape[key][0] = shape["n_samples"]
+    else:
+        data_info.data_shape[0] = shape["n_samples"]
+    with open_dict(cfg):
+        cfg.dataset.data_info = {"main": data_info}
+
+    model_module = import_module(f"src.models.{model_name}")
+    model_cfg = model_module.default_HPs(cfg)
+    # pretrained weights would be loaded into real memory
+    if "load_pretrained" in model_cfg:
+        model_cfg.load_pretrained = False
+    data = data_postfactory(cfg, model_cfg, {"main": data})
+
+    input_shapes = [tuple(data["main"][key].shape[1:]) for key in KEY_ORDER if key in data["main"]]
+    return cfg, model_cfg, input_shapes
+
+
+def profile(model_name, dataset_name):
+    """Static profile row of the model on the dataset"""
+    row = {"model": model_name, "dataset": dataset_name}
+    try:
+        shape = dataset_shape(dataset_name)
+        row.update({key: shape[key] for key in ["time_length", "feature_size"]})
+        cfg, model_cfg, input_shapes = prepare(model_name, dataset_name, shape)
+        model_module = import_module(f"src.models.{model_name}")
+        row["input_shapes"] = input_shapes
+        profile_results = static_profile(lambda: model_module.get_model(cfg, model_cfg), input_shapes)
+        if profile_results is None:
+            row["status"] = "skipped: not a torch model"
+            return row
+        row.update(profile_results)
+        row["status"] = "ok"
+    except Exception:
+        traceback.print_exc()
+        row["status"] = "error: " + traceback.format_exc(limit=1).strip().splitlines()[-1]
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--models", nargs="+", default=None, help="models from src/conf/model (default: all)")
+    parser.add_argument("--datasets", nargs="+", default=None, help="datasets from src/conf/dataset (default: all)")
+    parser.add_argument("--output", default=None, help=f"CSV path, default: {BENCHMARKS_ROOT}/model_profiles_<time>.csv")
+    args = parser.parse_args()
+
+    models = args.models if args.models is not None else config_names("model")
+    datasets = args.datasets if args.datasets is not None else config_names("dataset")
+
+    rows = []
+    for model_name in models:
+        for dataset_name in datasets:
+            print(f"Profiling {model_name} on {dataset_name}")
+            rows.append(profile(model_name, dataset_name))
+    df = pd.DataFrame(rows)
+
+    output = args.output or BENCHMARKS_ROOT.joinpath(f"model_profiles_{UTCNOW}.csv")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    df.to_csv(output, index=False)
+
+    columns = [
+        "model", "dataset", "params", "param_mb", "activation_mb_per_sample",
+        "forward_flops_per_sample", "backward_flops_per_sample", "status",
+    ]
+    print(df[[column for column in columns if column in df]].to_string(index=False))
+    print(f"Profiles are saved to {output}")
+
+    skipped = df[df["status"].str.startswith("skipped")]
+    if len(skipped) != 0:
+        print(f"{len(skipped)} model x dataset pairs were skipped:")
+        print(skipped[["model", "dataset", "status"]].to_string(index=False))
+    failed = df[df["status"].str.startswith("error")]
+    if len(failed) != 0:
+        print(f"{len(failed)} model x dataset pairs failed to profile:")
+        print(failed[["model", "dataset", "status"]].to_string(index=False))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 # pylint: disable=too-many-statements, too-many-locals, invalid-name, unbalanced-tuple-unpacking, no-value-for-parameter
 """Script for running experiments: tuning and testing hypertuned models"""
 import os
+import shutil
 from copy import deepcopy
 
 from omegaconf import OmegaConf, DictConfig
@@ -10,13 +11,18 @@ import pandas as pd
 import numpy as np
 
 import optuna
+from optuna.trial import TrialState
 
-from src.utils import set_project_name, set_run_name, validate_config, get_resume_params
-from src.data import data_factory, data_postfactory
+from src.utils import set_project_name, set_run_name, validate_config, get_resume_params, append_csv
+from src.data import data_factory, data_postfactory, publish_data, release_data
 from src.dataloader import dataloader_factory, cross_validation_split
 from src.model import model_config_factory, model_factory
 from src.model_utils import optimizer_factory, scheduler_factory
 from src.trainer import trainer_factory
+from src.autotune import autotune_batch_size
+from src.scheduler import LocalScheduler, RunError
+from src.memory import setup_memory_accounting, reset_peak_rss
+from src.tracing import configure_tracing, tracing_enabled, merge_traces, span, traced
 
 
 @hydra.main(version_base=None, config_path="../src/conf", config_name="exp_config")
@@ -39,8 +45,28 @@ def start(cfg: DictConfig):
     print("General config:")
     print(OmegaConf.to_yaml(cfg))
 
+    # record the stages' spans of all runs, the trace is merged even if the experiment fails
+    configure_tracing(cfg)
+    # tracemalloc and the hard memory limit
+    setup_memory_accounting(cfg, cfg.project_dir)
+    try:
+        run_project(cfg)
+    finally:
+        if tracing_enabled():
+            summary = merge_traces(cfg.project_dir)
+            if summary is not None:
+                print("Time by stage:")
+                print(summary.to_string(index=False))
+
+
+def run_project(cfg: DictConfig):
+    """Load data and run tuning or experiment"""
     # load dataset, compute FNCs if model requires them.
     original_data = data_factory(cfg)
+    # publish data once for all parallel workers
+    shared_data = "shared_data" in cfg and cfg.shared_data
+    if shared_data:
+        original_data = publish_data(original_data)
 
     if cfg.mode.name == "tune":
         if ("single_HPs" in cfg and cfg.single_HPs) or (
@@ -69,16 +95,21 @@ def start(cfg: DictConfig):
                 # resume flags check
                 is_interupted = "resume" in cfg and cfg.resume and k == starting_k
 
-                tune_fold_data = deepcopy(original_data)
+                # shared data is read-only and is not modified by the split
+                tune_fold_data = dict(original_data) if shared_data else deepcopy(original_data)
                 tune_fold_data["main"], _ = cross_validation_split(
                     tune_fold_data["main"], cfg.mode.n_splits, k
                 )
+                if shared_data:
+                    tune_fold_data = publish_data(tune_fold_data)
                 tune(
                     cfg=cfg,
                     original_data=tune_fold_data,
                     outer_k=k,
                     is_interupted=is_interupted,
                 )
+                if shared_data:
+                    release_data(tune_fold_data)
 
     elif cfg.mode.name == "exp":
         # resume flags check
@@ -90,91 +121,368 @@ def start(cfg: DictConfig):
 def tune(cfg, original_data, outer_k=None, is_interupted=False):
     """Given config and data, run several cross-validated rounds of optimal HP search"""
 
-    # set starting trial
-    if is_interupted:
-        starting_trial = cfg.resumed_params.trial
-    else:
-        starting_trial = 0
-
-    tuner = OptunaTuner(cfg, original_data, outer_k)
+    # for each trial get new set of HPs, test them using CV.
+    # interrupted study is resumed from its storage
+    tuner = OptunaTuner(cfg, original_data, outer_k, is_interupted=is_interupted)
     tuner.optimize()
-    # # for each trial get new set of HPs, test them using CV
 
     # get optimal config and save it
+    with span("aggregate", outer_k=outer_k):
+        select_best_config(cfg)
+
+
+def select_best_config(cfg):
+    """Select the best trial in trial_runs.csv and save its config as best_config.yaml"""
     df = pd.read_csv(f"{cfg.k_dir}/trial_runs.csv")
-    best_idx = df["score"].idxmax()
+    # trials pruned before any inner fold was finished have no score
+    df = df[df["score"].notna()]
+    if "state" in df:
+        # pruned trials have partial scores, they are used only if no trial was completed
+        complete = df[df["state"] == "COMPLETE"]
+        if len(complete) != 0:
+            df = complete
+        else:
+            print("Warning: no trial was completed, selecting among the pruned trials by their partial scores")
+    if len(df) == 0:
+        raise ValueError(f"No trial in '{cfg.k_dir}/trial_runs.csv' has a score, can't select the best config")
+    if "over_budget" in df and not df["over_budget"].all():
+        df = df[~df["over_budget"]]
+    cost = cfg.mode.cost_objective if "cost_objective" in cfg.mode else None
+    if cost is not None:
+        pareto_front(df, cost).to_csv(f"{cfg.k_dir}/pareto_front.csv", index=False)
+    best_idx = select_best_trial(cfg, df)
     best_config_path = df.loc[best_idx]["path_to_config"]
     with open(best_config_path, "r", encoding="utf8") as f:
         best_config = OmegaConf.load(f)
     with open(f"{cfg.k_dir}/best_config.yaml", "w", encoding="utf8") as f:
         OmegaConf.save(best_config, f)
 
+def pareto_front(df, cost):
+    """Return trials of df that are not dominated in (max score, min cost), sorted by cost"""
+    is_optimal = [
+        not (
+            (df["score"] >= row["score"])
+            & (df[cost] <= row[cost])
+            & ((df["score"] > row["score"]) | (df[cost] < row[cost]))
+        ).any()
+        for _, row in df.iterrows()
+    ]
+    return df[is_optimal].sort_values(cost)
+
+
+def select_best_trial(cfg, df):
+    """
+    Return index of the best trial in df according to cfg.mode.selection:
+        best - the highest score;
+        cheapest_within - the lowest cost (cfg.mode.cost_objective, 'time' by default)
+            among the trials with score within cfg.mode.selection_eps of the highest one
+    """
+    selection = cfg.mode.selection if "selection" in cfg.mode else "best"
+    if selection == "best":
+        return df["score"].idxmax()
+    if selection == "cheapest_within":
+        cost = cfg.mode.cost_objective if "cost_objective" in cfg.mode and cfg.mode.cost_objective else "time"
+        candidates = df[df["score"] >= df["score"].max() - cfg.mode.selection_eps]
+        return candidates[cost].idxmin()
+    raise ValueError(f"Unknown selection rule '{selection}', use 'best' or 'cheapest_within'")
+
+
+# cost objectives of multi-objective tuning
+COST_OBJECTIVES = ["time", "latency", "params"]
+
+
 class OptunaTuner:
-    def __init__(self, cfg, data, outer_k=None) -> None:
+    def __init__(self, cfg, data, outer_k=None, is_interupted=False) -> None:
         self.cfg = cfg
         self.data = data
         self.outer_k = outer_k
-    
+        self.is_interupted = is_interupted
+        self.scheduler = LocalScheduler.from_cfg(cfg)
+
+        # set k_dir, the study's storage is kept there
+        set_run_name(self.cfg, outer_k=outer_k, trial=0, inner_k=0)
+        os.makedirs(self.cfg.k_dir, exist_ok=True)
+        self.cost_objective = cfg.mode.cost_objective if "cost_objective" in cfg.mode else None
+        if self.cost_objective is not None and self.cost_objective not in COST_OBJECTIVES:
+            raise ValueError(f"Unknown cost objective '{self.cost_objective}', use one of {COST_OBJECTIVES}")
+        self.storage = self.get_storage()
+        if self.is_interupted and isinstance(self.storage, optuna.storages.InMemoryStorage):
+            # a new in-memory study would restart trial numbering and overwrite the logged trials
+            raise ValueError("Resuming a tune requires a persistent 'mode.storage' ('journal' or 'sqlite')")
+        self.pruner = self.get_pruner()
+        self.study_name = cfg.project_name
+        if outer_k is not None:
+            self.study_name += f"-k_{outer_k:02d}"
+
+    def get_storage(self):
+        """Return optuna storage according to cfg.mode.storage"""
+        storage = self.cfg.mode.storage if "storage" in self.cfg.mode else None
+        if storage is None:
+            return optuna.storages.InMemoryStorage()
+        if storage == "journal":
+            path = f"{self.cfg.k_dir}/optuna_journal.log"
+            if hasattr(optuna.storages, "journal") and hasattr(optuna.storages.journal, "JournalFileBackend"):
+                # optuna>=4.0
+                return optuna.storages.JournalStorage(optuna.storages.journal.JournalFileBackend(path))
+            return optuna.storages.JournalStorage(optuna.storages.JournalFileStorage(path))
+        if storage == "sqlite":
+            return optuna.storages.RDBStorage(
+                f"sqlite:///{self.cfg.k_dir}/optuna.db",
+                engine_kwargs={"connect_args": {"timeout": 60}},
+            )
+        raise ValueError(f"Unknown optuna storage '{storage}', use 'journal', 'sqlite' or null")
+
+    def get_pruner(self):
+        """Return optuna pruner according to cfg.mode.pruner, None if pruning is disabled"""
+        pruner = self.cfg.mode.pruner if "pruner" in self.cfg.mode else None
+        if pruner is None:
+            return None
+        if self.cost_objective is not None:
+            print("Pruning is not supported in multi-objective tuning, pruner is disabled")
+            return None
+        if pruner == "median":
+            return optuna.pruners.MedianPruner(n_startup_trials=5)
+        if pruner == "successive_halving":
+            return optuna.pruners.SuccessiveHalvingPruner()
+        if pruner == "hyperband":
+            return optuna.pruners.HyperbandPruner(
+                min_resource=1,
+                max_resource=self.cfg.mode.n_splits * (self.cfg.mode.max_epochs + 1),
+            )
+        raise ValueError(
+            f"Unknown pruner '{pruner}', use 'median', 'successive_halving', 'hyperband' or null"
+        )
+
+    def load_study(self):
+        return optuna.create_study(
+            study_name=self.study_name,
+            storage=self.storage,
+            directions=["maximize"] if self.cost_objective is None else ["maximize", "minimize"],
+            pruner=self.pruner,
+            load_if_exists=True,
+        )
+
     def optimize(self):
-        study = optuna.create_study(direction='maximize')
-        study.optimize(self.objective, n_trials=self.cfg.mode.n_trials)
+        study = self.load_study()
+
+        if self.is_interupted:
+            # trials that were running when the study was interrupted will never finish:
+            # mark them failed, and re-enqueue their parameters to continue them in their directories
+            for trial in study.get_trials(deepcopy=False, states=(TrialState.RUNNING,)):
+                print(f"Trial {trial.number:04d} was interrupted, re-enqueuing it")
+                self.storage.set_trial_state_values(trial._trial_id, state=TrialState.FAIL)  # pylint: disable=protected-access
+                study.enqueue_trial(
+                    trial.params,
+                    user_attrs={"resumed_from": trial.user_attrs.get("resumed_from", trial.number)},
+                )
 
-        print("Best trial:")
-        trial = study.best_trial
-        print("  Value: ", trial.value)
-        print("  Params: ")
-        for key, value in trial.params.items():
-            print("    {}: {}".format(key, value))
+        n_workers = self.cfg.mode.tune_workers if "tune_workers" in self.cfg.mode else 1
+        if n_workers == 1:
+            self.run_optimization()
+        else:
+            if isinstance(self.storage, optuna.storages.InMemoryStorage):
+                raise ValueError("Parallel tune workers require a persistent 'mode.storage'")
+            # each worker optimizes the shared study until n_trials trials are finished
+            scheduler = LocalScheduler(n_workers=n_workers)
+            tasks = [(deepcopy(self.cfg), self.data, self.outer_k) for _ in range(n_workers)]
+            for _, result in scheduler.run(run_tune_worker, tasks):
+                if isinstance(result, RunError):
+                    raise result
+            study = self.load_study()
+
+        if self.cost_objective is None:
+            print("Best trial:")
+            trial = study.best_trial
+            print("  Value: ", trial.value)
+            print("  Params: ")
+            for key, value in trial.params.items():
+                print("    {}: {}".format(key, value))
+        else:
+            print(f"Pareto front (score, {self.cost_objective}):")
+            for trial in sorted(study.best_trials, key=lambda t: t.values[1]):
+                print(f"  Trial {trial.number:04d}: {trial.values}")
+
+    def run_optimization(self):
+        """Run trials of the study in this process until n_trials trials are finished"""
+        study = self.load_study()
+        n_trials = self.cfg.mode.n_trials
+
+        def n_finished(study):
+            # trials skipped by the budget check before training don't count
+            return sum(
+                not (trial.state == TrialState.PRUNED and trial.user_attrs.get("over_budget", False))
+                for trial in study.get_trials(deepcopy=False, states=(TrialState.COMPLETE, TrialState.PRUNED))
+            )
+
+        def stop_if_finished(study, trial):  # pylint: disable=unused-argument
+            if n_finished(study) >= n_trials:
+                study.stop()
+            elif len(study.trials) >= 10 * n_trials:
+                print("Too many trials are skipped by the budget check, stopping the study")
+                study.stop()
+
+        if n_finished(study) >= n_trials:
+            return
+        study.optimize(self.objective, callbacks=[stop_if_finished])
 
     def objective(self, trial):
+        # re-enqueued interrupted trials continue in the directory of the original trial
+        number = trial.user_attrs.get("resumed_from", trial.number)
+        set_run_name(self.cfg, outer_k=self.outer_k, trial=number, inner_k=0)
+        resumed = "resumed_from" in trial.user_attrs
+        if not resumed:
+            # leftovers of an earlier study in the same directory
+            shutil.rmtree(self.cfg.trial_dir, ignore_errors=True)
+        os.makedirs(self.cfg.trial_dir, exist_ok=True)
+
         # get random model config
         model_cfg = model_config_factory(self.cfg, optuna_trial=trial)
+        model_cfg_path = f"{self.cfg.trial_dir}/model_config.yaml"
+        if resumed and os.path.exists(model_cfg_path):
+            # use exactly the same config as the interrupted trial
+            model_cfg = OmegaConf.load(model_cfg_path)
+        else:
+            # save model config
+            with open(model_cfg_path, "w", encoding="utf8") as f:
+                OmegaConf.save(model_cfg, f)
         # reshape data according to model config (if needed)
         data = data_postfactory(
             self.cfg,
             model_cfg,
             self.data,
         )
-        # run nested CV
-        for inner_k in range(0, self.cfg.mode.n_splits):
-            if self.outer_k is not None:
-                print(f"Outer k: {self.outer_k:02d}")
-            print(f"Trial: {trial.number:04d}")
-            print(f"Inner k: {inner_k:02d}")
-
-            set_run_name(self.cfg, outer_k=self.outer_k, trial=trial.number, inner_k=inner_k)
-            os.makedirs(self.cfg.run_dir, exist_ok=True)
-            dataloaders = dataloader_factory(self.cfg, data, k=inner_k)
-            results = run_trial(self.cfg, model_cfg, dataloaders)
-
-            # save results of nested CV in the trial directory
-            df = pd.DataFrame(results, index=[0])
-            with open(f"{self.cfg.trial_dir}/CV_runs.csv", "a", encoding="utf8") as f:
-                df.to_csv(f, header=f.tell() == 0, index=False)
 
-        # save model config
-        with open(f"{self.cfg.trial_dir}/model_config.yaml", "w", encoding="utf8") as f:
-            OmegaConf.save(model_cfg, f)
-
-        # summarize the trial's CV results and save them
-        df = pd.read_csv(f"{self.cfg.trial_dir}/CV_runs.csv")
-        score = np.mean(df["test_score"].to_numpy())
-        loss = np.mean(df["test_average_loss"].to_numpy())
-        time = np.mean(df["training_time"].to_numpy())
+        # skip the inner folds finished before the interruption
+        results = [None] * self.cfg.mode.n_splits
+        if resumed and os.path.exists(f"{self.cfg.trial_dir}/CV_runs.csv"):
+            finished = pd.read_csv(f"{self.cfg.trial_dir}/CV_runs.csv")
+            if "inner_k" in finished:
+                for result in finished.to_dict("records"):
+                    results[int(result["inner_k"])] = result
+                print(f"Trial {number:04d}: skipping finished inner folds")
+            else:
+                # CV_runs.csv written by older versions doesn't record the folds, all of them are re-run
+                print(f"Trial {number:04d}: finished inner folds are unknown, re-running all of them")
+                os.remove(f"{self.cfg.trial_dir}/CV_runs.csv")
+
+        # run nested CV, inner folds are independent and may run in parallel
+        print(f"Trial: {number:04d}")
+        max_epochs = self.cfg.mode.max_epochs
+        prune_every = self.cfg.mode.prune_every if "prune_every" in self.cfg.mode else None
+        tasks = []
+        task_folds = []
+        for inner_k in range(0, self.cfg.mode.n_splits):
+            if results[inner_k] is not None:
+                continue
+            # epoch-level pruning is possible only if the runs are executed in this process
+            if self.pruner is not None and prune_every and self.scheduler.n_workers == 1:
+                epoch_callbacks = [EpochPruningCallback(trial, inner_k, max_epochs, prune_every)]
+            else:
+                epoch_callbacks = None
+            tasks.append(
+                (deepcopy(self.cfg), model_cfg, data, self.outer_k, number, inner_k, epoch_callbacks)
+            )
+            task_folds.append(inner_k)
+
+        # epoch-level pruning raises TrialPruned in the runs executed in this process
+        runs = self.scheduler.run(run_task, tasks, propagate=(optuna.TrialPruned,))
+        try:
+            for i, result in runs:
+                results[task_folds[i]] = result
+                if isinstance(result, RunError):
+                    continue
+                # save results of nested CV in the trial directory
+                append_csv(pd.DataFrame(result, index=[0]), f"{self.cfg.trial_dir}/CV_runs.csv")
+
+                # report the mean score of the finished inner folds.
+                # steps: inner fold i epoch e -> i * (max_epochs + 1) + e, the finished fold -> i * (max_epochs + 1) + max_epochs
+                if self.pruner is not None:
+                    scores = [r["test_score"] for r in results if r is not None and not isinstance(r, RunError)]
+                    trial.report(np.mean(scores), step=(len(scores) - 1) * (max_epochs + 1) + max_epochs)
+                    if trial.should_prune():
+                        raise optuna.TrialPruned(f"Pruned after {len(scores)} inner folds")
+        except optuna.TrialPruned:
+            # stop the remaining runs of the trial and record its partial results
+            runs.close()
+            print(f"Trial {number:04d} is pruned")
+            self.save_trial(trial, state="PRUNED")
+            raise
+
+        failed = [result for result in results if isinstance(result, RunError)]
+        if len(failed) != 0:
+            raise RunError("\n".join(str(e) for e in failed))
+
+        score, costs = self.save_trial(trial, state="COMPLETE")
+        if trial.user_attrs.get("over_budget", False):
+            # steer the sampler away from over-budget configs
+            score -= self.cfg.mode.budget.get("penalty", 0.1)
+        if self.cost_objective is None:
+            return score
+        return score, costs[self.cost_objective]
+
+    @traced("aggregate_trial")
+    def save_trial(self, trial, state):
+        """
+        Summarize the trial's (possibly partial) CV results, save them in trial_runs.csv,
+        and return the score and the dict of costs
+        """
+        number = trial.user_attrs.get("resumed_from", trial.number)
+        set_run_name(self.cfg, outer_k=self.outer_k, trial=number, inner_k=0)
+        try:
+            df = pd.read_csv(f"{self.cfg.trial_dir}/CV_runs.csv")
+            score = np.mean(df["test_score"].to_numpy())
+            loss = np.mean(df["test_average_loss"].to_numpy())
+            costs = {
+                "time": np.mean(df["training_time"].to_numpy()),
+                "latency": np.mean(df["test_average_inf_time"].to_numpy()),
+                "params": np.mean(df["params"].to_numpy()),
+            }
+        except FileNotFoundError:
+            # pruned before any inner fold was finished
+            score, loss = np.nan, np.nan
+            costs = {key: np.nan for key in COST_OBJECTIVES}
         df = pd.DataFrame(
             {
-                "trial": trial.number,
+                "trial": number,
                 "score": score,
                 "loss": loss,
-                "time": time,
+                **costs,
+                "state": state,
+                "over_budget": trial.user_attrs.get("over_budget", False),
                 "path_to_config": f"{self.cfg.trial_dir}/model_config.yaml",
             },
             index=[0],
         )
-        with open(f"{self.cfg.k_dir}/trial_runs.csv", "a", encoding="utf8") as f:
-            df.to_csv(f, header=f.tell() == 0, index=False)
-        
-        return score
+        # several tune workers may append to the file concurrently
+        append_csv(df, f"{self.cfg.k_dir}/trial_runs.csv")
+
+        return score, costs
+
+
+class EpochPruningCallback:
+    """
+    Trainer epoch callback: report the validation score to the optuna trial every prune_every epochs,
+    and stop training if the trial should be pruned
+    """
+
+    def __init__(self, trial, inner_k, max_epochs, prune_every) -> None:
+        self.trial = trial
+        self.inner_k = inner_k
+        self.max_epochs = max_epochs
+        self.prune_every = prune_every
+        self.n_reported = 0
+
+    def __call__(self, epoch, results):
+        # not every epoch is validated, and asynchronous validation results come one epoch late
+        if "valid_score" not in results:
+            return
+        epoch = results.get("valid_epoch", epoch)
+        if (epoch + 1) // self.prune_every == self.n_reported:
+            return
+        self.n_reported = (epoch + 1) // self.prune_every
+        self.trial.report(results["valid_score"], step=self.inner_k * (self.max_epochs + 1) + epoch)
+        if self.trial.should_prune():
+            raise optuna.TrialPruned(f"Pruned at inner fold {self.inner_k}, epoch {epoch}")
 
 
 def experiment(cfg, original_data, is_interupted=False):
@@ -186,6 +494,8 @@ def experiment(cfg, original_data, is_interupted=False):
     else:
         starting_k = 0
 
+    scheduler = LocalScheduler.from_cfg(cfg)
+
     for outer_k in range(starting_k, cfg.mode.n_splits):
         # for each fold get optimal set of HPs,
         # unless single_HP is True,
@@ -205,34 +515,81 @@ def experiment(cfg, original_data, is_interupted=False):
             original_data,
         )
         # for outer_k test fold, train model n_trials times,
-        # using different train/valid split each time
-        for trial in range(starting_trial, cfg.mode.n_trials):
-            print(f"k: {outer_k:02d}")
-            print(f"Trial: {trial:04d}")
-
-            set_run_name(cfg, outer_k=outer_k, trial=trial)
-            os.makedirs(cfg.run_dir, exist_ok=True)
-            dataloaders = dataloader_factory(cfg, data, k=outer_k, trial=trial)
-            results = run_trial(cfg, model_cfg, dataloaders)
-
-            # save run's results in the folds directory
-            df = pd.DataFrame(results, index=[0])
-            with open(f"{cfg.k_dir}/fold_runs.csv", "a", encoding="utf8") as f:
+        # using different train/valid split each time.
+        # trials are independent and may run in parallel
+        print(f"k: {outer_k:02d}")
+        set_run_name(cfg, outer_k=outer_k, trial=starting_trial)
+        tasks = [
+            (deepcopy(cfg), model_cfg, data, outer_k, trial)
+            for trial in range(starting_trial, cfg.mode.n_trials)
+        ]
+        # save runs' results in the folds directory in trial order,
+        # so that an interrupted experiment can be resumed from the first missing trial
+        results = [None] * len(tasks)
+        n_saved = 0
+        for i, result in scheduler.run(run_task, tasks):
+            results[i] = result
+            while n_saved < len(results) and results[n_saved] is not None:
+                if isinstance(results[n_saved], RunError):
+                    break
+                df = pd.DataFrame(results[n_saved], index=[0])
+                with open(f"{cfg.k_dir}/fold_runs.csv", "a", encoding="utf8") as f:
+                    df.to_csv(f, header=f.tell() == 0, index=False)
+                n_saved += 1
+        failed = [result for result in results if isinstance(result, RunError)]
+        if len(failed) != 0:
+            raise RunError("\n".join(str(e) for e in failed))
+
+        with span("aggregate", outer_k=outer_k):
+            # save outer_k's model config
+            with open(f"{cfg.k_dir}/model_config.yaml", "w", encoding="utf8") as f:
+                OmegaConf.save(model_cfg, f)
+
+            # load and save the fold's results in the project directory
+            df = pd.read_csv(f"{cfg.k_dir}/fold_runs.csv")
+            with open(f"{cfg.project_dir}/runs.csv", "a", encoding="utf8") as f:
                 df.to_csv(f, header=f.tell() == 0, index=False)
 
-        # save outer_k's model config
-        with open(f"{cfg.k_dir}/model_config.yaml", "w", encoding="utf8") as f:
-            OmegaConf.save(model_cfg, f)
 
-        # load and save the fold's results in the project directory
-        df = pd.read_csv(f"{cfg.k_dir}/fold_runs.csv")
-        with open(f"{cfg.project_dir}/runs.csv", "a", encoding="utf8") as f:
-            df.to_csv(f, header=f.tell() == 0, index=False)
+def run_tune_worker(cfg, data, outer_k):
+    """Optimize the shared study in a tune worker process"""
+    tuner = OptunaTuner(cfg, data, outer_k)
+    tuner.run_optimization()
+
+
+@traced("run")
+def run_task(cfg, model_cfg, data, outer_k, trial, inner_k=None, epoch_callbacks=None):
+    """
+    Set up a single run's directory and dataloaders, train and test the model, return test results.
+    Executed by LocalScheduler, possibly in a worker process
+    """
+    print(f"Starting run: k {outer_k}, trial {trial}" + (f", inner k {inner_k}" if inner_k is not None else ""))
+    set_run_name(cfg, outer_k=outer_k, trial=trial, inner_k=inner_k)
+    # remove logs of a run interrupted together with the experiment,
+    # unless the run can be continued from its saved training state
+    if not ("resume" in cfg and cfg.resume and os.path.exists(f"{cfg.run_dir}/train_state.pt")):
+        shutil.rmtree(cfg.run_dir, ignore_errors=True)
+    os.makedirs(cfg.run_dir, exist_ok=True)
+    # memory statistics and the memory limit report cover this run
+    setup_memory_accounting(cfg, cfg.run_dir)
+    reset_peak_rss()
+    if cfg.mode.name == "tune":
+        dataloaders = dataloader_factory(cfg, data, k=inner_k)
+    else:
+        dataloaders = dataloader_factory(cfg, data, k=outer_k, trial=trial)
 
+    results = run_trial(cfg, model_cfg, dataloaders, epoch_callbacks)
+    if inner_k is not None:
+        results["inner_k"] = inner_k
 
-def run_trial(cfg, model_cfg, dataloaders):
+    return results
+
+
+def run_trial(cfg, model_cfg, dataloaders, epoch_callbacks=None):
     """Given config and prepared dataloaders, build and train the model and return test results"""
     model = model_factory(cfg, model_cfg)
+    if "autotune_batch_size" in cfg.mode and cfg.mode.autotune_batch_size:
+        dataloaders, model_cfg = autotune_batch_size(cfg, model_cfg, model, dataloaders)
     optimizer = optimizer_factory(cfg, model_cfg, model)
     scheduler = scheduler_factory(cfg, model_cfg, optimizer)
 
@@ -244,8 +601,19 @@ def run_trial(cfg, model_cfg, dataloaders):
         optimizer,
         scheduler,
     )
-
-    results = trainer.run()
+    if epoch_callbacks is not None:
+        trainer.epoch_callbacks.extend(epoch_callbacks)
+
+    try:
+        results = trainer.run()
+    except optuna.TrialPruned:
+        # pruned trials are not resumed
+        if os.path.exists(trainer.train_state_path):
+            os.remove(trainer.train_state_path)
+        raise
+    finally:
+        # stop the checkpoint writer thread also if the run is aborted
+        trainer.early_stopping.close()
 
     return results
 
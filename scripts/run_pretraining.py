@@ -11,6 +11,7 @@ import pandas as pd
 from tqdm import tqdm
 from src.model import model_factory
 from src.model_utils import optimizer_factory
+from src.trainer import MetricsWriter
 
 from src.datasets.ukb import load_data as load_new
 from src.datasets.ukb_old import load_data as load_old
@@ -146,6 +147,10 @@ def start(ds, model_name, postfix):
     LR_scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, "min", patience=50)
     early_stopper = EarlyStopping(cfg.mode.max_epochs)
     
+    metrics_writer = MetricsWriter(
+        f"{path}/log_{ds}_{model_name}_{postfix}",
+        fmt=cfg.mode.metrics_format if "metrics_format" in cfg.mode else "csv",
+    )
     for epoch in range(cfg.mode.max_epochs):
         
         train_loss = 0.0
@@ -186,8 +191,9 @@ def start(ds, model_name, postfix):
         early_stopper(val_loss, model)
         LR_scheduler.step(val_loss)
 
-        train_loss_components = {key: value / n_batches for key, value in train_loss_components.items()}
-        val_loss_components = {key: value / n_batches_val for key, value in val_loss_components.items()}
+        # loss components are accumulated as tensors, sync them once per epoch
+        train_loss_components = {key: float(value) / n_batches for key, value in train_loss_components.items()}
+        val_loss_components = {key: float(value) / n_batches_val for key, value in val_loss_components.items()}
         log = {
             "epoch": epoch,
             "tr_loss": train_loss/n_batches,
@@ -197,14 +203,11 @@ def start(ds, model_name, postfix):
 
         }
 
-        if not os.path.isfile(f"{path}/log_{ds}_{model_name}_{postfix}.csv"):
-            pd.DataFrame([log]).to_csv(f"{path}/log_{ds}_{model_name}_{postfix}.csv", index=False)
-        else:
-            # Append to the existing file without writing the header
-            pd.DataFrame([log]).to_csv(f"{path}/log_{ds}_{model_name}_{postfix}.csv", mode='a', header=False, index=False)
+        metrics_writer.write(log)
 
         print(log)
 
+    metrics_writer.close()
     torch.save(early_stopper.checkpoint, f"{path}/{model_name}_{ds}_{postfix}.pt")
 
     target = next(iter(val_dataloader))
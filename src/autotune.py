@@ -0,0 +1,231 @@
+# pylint: disable=no-member, invalid-name, too-many-locals
+"""Throughput-driven batch size autotuning"""
+from copy import deepcopy
+import hashlib
+import json
+import math
+import os
+import platform
+import time
+
+import torch
+from torch.utils.data import DataLoader
+
+from omegaconf import DictConfig, OmegaConf, open_dict
+
+from src.memory import ActivationMeter, available_memory, is_oom_error
+from src.model_utils import copy_model
+from src.settings import AUTOTUNE_CACHE_ROOT
+from src.trainer import ce_wrapper
+
+DEFAULT_CANDIDATES = [16, 32, 64, 128, 256]
+# model_cfg entries which don't change the model's compute (optimization and loss HPs),
+# so trials that differ only in them share the cached choice
+NON_ARCHITECTURE_KEYS = [
+    "lr", "weight_decay", "optimizer", "scheduler", "loss", "reg_param", "sparsity_loss_weight",
+    "dropout", "load_pretrained", "pretrained_path", "params",
+]
+
+
+def autotune_batch_size(cfg: DictConfig, model_cfg: DictConfig, model, dataloaders):
+    """
+    Pick the batch size with the best training throughput (samples/second)
+    among cfg.mode.autotune_candidates, under the memory ceiling.
+    The benchmark runs under the model's precision policy. The choice is cached per
+    (model architecture, input shapes, precision, host), so later trials with the same architecture skip it.
+
+    Returns dataloaders with the chosen batch size and model_cfg,
+    which is a copy with rescaled "lr" if cfg.mode.autotune_lr_scaling is set.
+    cfg is not changed except for the cfg.autotune record.
+    """
+    base_batch_size = cfg.mode.batch_size
+    candidates = (
+        list(cfg.mode.autotune_candidates) if "autotune_candidates" in cfg.mode else DEFAULT_CANDIDATES
+    )
+    dataset = dataloaders["train"].dataset
+    candidates = sorted({min(b, len(dataset)) for b in candidates})
+
+    *inputs, _ = next(iter(DataLoader(dataset, batch_size=1)))
+    cache_key = get_cache_key(cfg, model_cfg, [list(x.shape[1:]) for x in inputs], candidates)
+    cache_path = AUTOTUNE_CACHE_ROOT.joinpath(f"{cache_key}.json")
+
+    if os.path.exists(cache_path):
+        with open(cache_path, "r", encoding="utf8") as f:
+            choice = json.load(f)
+        print(f"Autotune: using cached batch size {choice['batch_size']}")
+    else:
+        choice = benchmark_batch_sizes(cfg, model, dataset, candidates)
+        if choice is None:
+            print("Autotune: no candidate batch size fits into memory, using the default one")
+            return dataloaders, model_cfg
+
+        os.makedirs(AUTOTUNE_CACHE_ROOT, exist_ok=True)
+        # write atomically, parallel runs may share the cache
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf8") as f:
+            json.dump(choice, f, indent=2)
+        os.replace(tmp_path, cache_path)
+
+    batch_size = choice["batch_size"]
+
+    # rescale learning rate relative to the configured batch size
+    scaling = cfg.mode.autotune_lr_scaling if "autotune_lr_scaling" in cfg.mode else None
+    if scaling is not None and "lr" in model_cfg and batch_size != base_batch_size:
+        ratio = batch_size / base_batch_size
+        if scaling == "linear":
+            factor = ratio
+        elif scaling == "sqrt":
+            factor = math.sqrt(ratio)
+        else:
+            raise ValueError(
+                f"Unknown autotune_lr_scaling '{scaling}', use 'linear', 'sqrt' or null"
+            )
+        model_cfg = deepcopy(model_cfg)
+        model_cfg.lr = float(model_cfg.lr) * factor
+
+    with open_dict(cfg):
+        cfg.autotune = {**choice, "lr_scaling": scaling}
+
+    dataloaders = {
+        key: DataLoader(
+            dataloader.dataset,
+            batch_size=batch_size,
+            num_workers=0,
+            shuffle=key == "train",
+        )
+        for key, dataloader in dataloaders.items()
+    }
+
+    return dataloaders, model_cfg
+
+
+def benchmark_batch_sizes(cfg: DictConfig, model, dataset, candidates):
+    """
+    Time forward/backward steps for each candidate batch size on a copy of the model.
+    Larger candidates are skipped once the memory ceiling is hit.
+    Returns the smallest batch size within cfg.mode.autotune_tolerance of the best throughput,
+    or None if none of the candidates fit into memory.
+    """
+    n_steps = cfg.mode.autotune_steps if "autotune_steps" in cfg.mode else 3
+    tolerance = cfg.mode.autotune_tolerance if "autotune_tolerance" in cfg.mode else 0.05
+    fraction = cfg.mode.memory_fraction if "memory_fraction" in cfg.mode else 0.8
+
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    if "memory_budget_gb" in cfg.mode and cfg.mode.memory_budget_gb:
+        memory = cfg.mode.memory_budget_gb * 2**30
+    else:
+        memory = available_memory(device)
+    ceiling = memory * fraction if memory is not None else None
+    precision = cfg.model.precision if "precision" in cfg.model and cfg.model.precision is not None else "fp32"
+
+    if "custom_criterion" not in cfg.model or not cfg.model.custom_criterion:
+        get_criterion = lambda model: ce_wrapper
+    else:
+        get_criterion = lambda model: model.compute_loss
+
+    # the benchmark runs on copies; the model's buffers (e.g. BatchNorm stats) and gradients are
+    # still restored afterwards, in case a copy shares state with the model
+    buffers = {name: buffer.detach().clone() for name, buffer in model.named_buffers()}
+    try:
+        throughput = run_candidates(model, dataset, candidates, device, precision, get_criterion, ceiling, n_steps)
+    finally:
+        with torch.no_grad():
+            for name, buffer in model.named_buffers():
+                buffer.copy_(buffers[name])
+        model.zero_grad(set_to_none=True)
+
+    if len(throughput) == 0:
+        return None
+
+    best = max(throughput.values())
+    batch_size = min(b for b, value in throughput.items() if value >= (1 - tolerance) * best)
+
+    return {
+        "batch_size": batch_size,
+        "throughput": throughput[batch_size],
+        "candidates": {str(b): value for b, value in throughput.items()},
+    }
+
+
+def run_candidates(model, dataset, candidates, device, precision, get_criterion, ceiling, n_steps):
+    """Return {batch size: samples/second} of the candidates, stop at the first one over the memory ceiling"""
+    throughput = {}
+    for batch_size in candidates:
+        # benchmark an eager copy, so that the model's state (e.g. BatchNorm stats) is untouched
+        bench_model = copy_model(model, recompile=False).to(device)
+        if precision == "bf16":
+            bench_model = bench_model.to(torch.bfloat16)
+        bench_model.train()
+        criterion = get_criterion(bench_model)
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, drop_last=True)
+        *inputs, target = next(iter(loader))
+        inputs, target = [x.to(device) for x in inputs], target.to(device)
+        if precision == "bf16":
+            inputs = [x.to(torch.bfloat16) if x.is_floating_point() else x for x in inputs]
+
+        meter = ActivationMeter(bench_model)
+        if device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(device)
+            base_memory = torch.cuda.memory_allocated(device)
+
+        def step():
+            with meter, torch.autocast(
+                device_type=device.type, dtype=torch.bfloat16, enabled=precision == "bf16-autocast"
+            ):
+                logits, additional_outputs = bench_model(*inputs)
+            loss, _ = criterion(logits=logits.float(), target=target, additional_outputs=additional_outputs)
+            loss.backward()
+            bench_model.zero_grad(set_to_none=True)
+
+        try:
+            # warm-up step, also measures memory
+            step()
+            if device.type == "cuda":
+                used_memory = torch.cuda.max_memory_allocated(device) - base_memory
+            else:
+                used_memory = meter.peak
+            if ceiling is not None and used_memory > ceiling:
+                print(f"Autotune: batch size {batch_size} exceeds the memory ceiling")
+                break
+
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            start_time = time.time()
+            for _ in range(n_steps):
+                step()
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            step_time = (time.time() - start_time) / n_steps
+        except (torch.cuda.OutOfMemoryError, MemoryError, RuntimeError) as e:
+            if not is_oom_error(e):
+                raise
+            print(f"Autotune: batch size {batch_size} is out of memory")
+            break
+        finally:
+            del bench_model
+
+        throughput[batch_size] = batch_size / step_time
+        print(f"Autotune: batch size {batch_size}: {throughput[batch_size]:.1f} samples/s")
+
+    return throughput
+
+
+def get_cache_key(cfg: DictConfig, model_cfg: DictConfig, sample_shapes, candidates):
+    """Hash of everything the benchmark result depends on"""
+    architecture = {
+        key: value
+        for key, value in OmegaConf.to_container(model_cfg, resolve=True).items()
+        if key not in NON_ARCHITECTURE_KEYS
+    }
+    key = {
+        "model": cfg.model.name,
+        "architecture": architecture,
+        "sample_shapes": sample_shapes,
+        "candidates": candidates,
+        "precision": cfg.model.precision if "precision" in cfg.model else "fp32",
+        "host": platform.node(),
+        "device": torch.cuda.get_device_name(0) if torch.cuda.is_available() else platform.processor(),
+        "threads": torch.get_num_threads(),
+        "torch": torch.__version__,
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf8")).hexdigest()
@@ -1,6 +1,12 @@
 # pylint: disable=invalid-name, line-too-long
 """Functions for extracting dataset features and labels"""
 from importlib import import_module
+import atexit
+import mmap
+import os
+import shutil
+import signal
+import uuid
 
 import numpy as np
 from scipy import stats
@@ -8,7 +14,12 @@ from sklearn.model_selection import StratifiedKFold
 
 from omegaconf import OmegaConf, DictConfig, open_dict
 
+from src.memory import log_memory
+from src.settings import PROJECT_ROOT, SHARED_DATA_ROOT
+from src.tracing import span, traced
 
+
+@traced()
 def data_factory(cfg: DictConfig):
     """
     Model-agnostic data factory.
@@ -53,7 +64,9 @@ def data_factory(cfg: DictConfig):
             ) from e
 
         try:
-            ts_data, labels = dataset_module.load_data(cfg)
+            with span("load_data", dataset=dataset_name):
+                ts_data, labels = dataset_module.load_data(cfg)
+            log_memory(cfg, "load_data", scope="project", dataset=dataset_name)
         except AttributeError as e:
             raise AttributeError(
                 f"'src.datasets.{dataset_name}' has no function\
@@ -93,7 +106,9 @@ def data_factory(cfg: DictConfig):
     data = {}
     data_info = {}
     for dataset_name, (ts_data, labels) in raw_data.items():
-        data[dataset_name], data_info[dataset_name] = processor(cfg, (ts_data, labels))
+        with span("process_data", dataset=dataset_name):
+            data[dataset_name], data_info[dataset_name] = processor(cfg, (ts_data, labels))
+        log_memory(cfg, "process_data", scope="project", dataset=dataset_name, processor=processor.__name__)
 
     with open_dict(cfg):
         cfg.dataset.data_info = data_info
@@ -153,9 +168,10 @@ def common_processor(cfg: DictConfig, data):
         data_shape = ts_data.shape
     # derive FNC data
     elif cfg.model.data_type in ["FNC", "tri-FNC", "TS-FNC"]:
-        pearson = np.zeros((ts_data.shape[0], ts_data.shape[2], ts_data.shape[2]))
-        for i in range(ts_data.shape[0]):
-            pearson[i, :, :] = np.corrcoef(ts_data[i, :, :], rowvar=False)
+        with span("compute_fnc"):
+            pearson = np.zeros((ts_data.shape[0], ts_data.shape[2], ts_data.shape[2]))
+            for i in range(ts_data.shape[0]):
+                pearson[i, :, :] = np.corrcoef(ts_data[i, :, :], rowvar=False)
 
         if cfg.model.data_type == "FNC":
             data = {"FNC": pearson, "labels": labels}
@@ -181,6 +197,7 @@ def common_processor(cfg: DictConfig, data):
     return data, data_info
 
 
+@traced()
 def data_postfactory(cfg: DictConfig, model_cfg: DictConfig, original_data):
     """
     Post-process the raw dataset according to model_cfg if cfg.model.require_data_postproc is True
@@ -206,5 +223,142 @@ def data_postfactory(cfg: DictConfig, model_cfg: DictConfig, original_data):
             ) from e
 
         data = data_postproc(cfg, model_cfg, original_data)
+        log_memory(cfg, "data_postfactory", scope="project")
 
     return data
+
+
+def dataset_shape(dataset_name):
+    """
+    Return the 'shape' entry of the dataset's config: n_samples, time_length, feature_size and n_classes
+    of the loaded data. It is used to build synthetic data of the dataset's shape without loading it
+    """
+    path = PROJECT_ROOT.joinpath("src", "conf", "dataset", f"{dataset_name}.yaml")
+    dataset_cfg = OmegaConf.load(path)
+    if "shape" not in dataset_cfg:
+        raise ValueError(f"Dataset config '{path}' has no 'shape' entry")
+    return OmegaConf.to_container(dataset_cfg.shape)
+
+
+class SharedArray(np.memmap):
+    """
+    Read-only memory-mapped array published by publish_data.
+    A whole array is pickled as its file path, so worker processes attach to the same memory without copying it;
+    views and slices are pickled as regular arrays.
+    """
+
+    def __reduce__(self):
+        if isinstance(self.base, mmap.mmap):
+            return attach_array, (self.filename,)
+        return np.asarray(self).__reduce__()
+
+
+def attach_array(filename):
+    """Memory-map the published .npy file as a read-only SharedArray"""
+    with open(filename, "rb") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+
+    return SharedArray(
+        filename,
+        dtype=dtype,
+        mode="r",
+        shape=shape,
+        offset=offset,
+        order="F" if fortran_order else "C",
+    )
+
+
+def publish_data(data):
+    """
+    Publish the processed data (as returned by data_factory) into shared memory once,
+    and return the same structure with read-only SharedArray views of it.
+    Worker processes receiving the returned data attach to the published arrays instead of copying them.
+    Float arrays are stored as float32, the dtype used by the dataloaders.
+
+    The published files are removed when the publishing process exits;
+    files left by crashed processes are removed by the next publish_data call.
+    """
+    sweep_shared_data()
+
+    publish_dir = SHARED_DATA_ROOT.joinpath(f"{os.getpid()}_{uuid.uuid4().hex[:8]}")
+    os.makedirs(publish_dir)
+    _register_cleanup(publish_dir)
+
+    shared_data = {}
+    for dataset_name, dataset in data.items():
+        shared_data[dataset_name] = {}
+        for key, array in dataset.items():
+            if not isinstance(array, np.ndarray):
+                shared_data[dataset_name][key] = array
+                continue
+            if np.issubdtype(array.dtype, np.floating):
+                array = array.astype(np.float32, copy=False)
+
+            filename = publish_dir.joinpath(f"{dataset_name}_{key}.npy")
+            np.save(filename, np.ascontiguousarray(array))
+            shared_data[dataset_name][key] = attach_array(str(filename))
+
+    return shared_data
+
+
+def release_data(data):
+    """Remove the shared memory files of data published by publish_data"""
+    for dataset in data.values():
+        for array in dataset.values():
+            if isinstance(array, SharedArray) and array.filename is not None:
+                shutil.rmtree(os.path.dirname(array.filename), ignore_errors=True)
+
+
+def is_shared(data):
+    """Whether data contains arrays published by publish_data"""
+    return any(
+        isinstance(array, SharedArray)
+        for dataset in data.values()
+        for array in dataset.values()
+    )
+
+
+def sweep_shared_data():
+    """Remove shared data left by processes that are no longer alive"""
+    if not os.path.isdir(SHARED_DATA_ROOT):
+        return
+    for name in os.listdir(SHARED_DATA_ROOT):
+        try:
+            pid = int(name.split("_")[0])
+            os.kill(pid, 0)
+        except ValueError:
+            continue
+        except ProcessLookupError:
+            print(f"Removing stale shared data '{name}'")
+            shutil.rmtree(SHARED_DATA_ROOT.joinpath(name), ignore_errors=True)
+        except PermissionError:
+            # the process exists, but belongs to another user
+            continue
+
+
+_cleanup_dirs = []
+
+
+def _register_cleanup(publish_dir):
+    """Remove publish_dir on normal exit, and on SIGTERM/SIGHUP"""
+    if len(_cleanup_dirs) == 0:
+        atexit.register(_cleanup)
+        for signum in [signal.SIGTERM, signal.SIGHUP]:
+            # only replace the default handlers, the interpreter exits via SystemExit and runs atexit hooks
+            if signal.getsignal(signum) == signal.SIG_DFL:
+                signal.signal(signum, _exit_on_signal)
+    _cleanup_dirs.append(publish_dir)
+
+
+def _cleanup():
+    for publish_dir in _cleanup_dirs:
+        shutil.rmtree(publish_dir, ignore_errors=True)
+
+
+def _exit_on_signal(signum, frame):  # pylint: disable=unused-argument
+    raise SystemExit(128 + signum)
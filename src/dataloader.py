@@ -3,13 +3,19 @@
 from importlib import import_module
 from copy import deepcopy
 
+import numpy as np
 from numpy.random import default_rng
 
 from sklearn.model_selection import StratifiedKFold, StratifiedShuffleSplit
 import torch
-from torch.utils.data import DataLoader, TensorDataset
+from torch.utils.data import DataLoader, Dataset, TensorDataset
 from omegaconf import open_dict, OmegaConf
 
+from src.data import is_shared
+from src.memory import log_memory
+from src.tracing import traced
+
+@traced()
 def dataloader_factory(cfg, data, k, trial=None):
     """Return dataloader according to the used model"""
     if "custom_dataloader" not in cfg.model or not cfg.model.custom_dataloader:
@@ -61,7 +67,11 @@ def common_dataloader(cfg, original_data, k, trial=None):
 
     Output dataloaders return tuples with ("TS", "FNC", "labels"), ("TS", "labels"), or ("FNC", "labels") data order
     """
-    data = deepcopy(original_data)
+    # arrays published in shared memory are read-only and are not copied:
+    # the splits are indexed lazily, unless the training data has to be modified
+    shared = is_shared(original_data)
+    lazy = shared and not ("permute" in cfg and cfg.permute == "Single")
+    data = original_data if shared else deepcopy(original_data)
     split_data = {"train": {}, "valid": {}, "test": {}}
 
     if "follow_splits" in cfg and cfg.follow_splits is not None:
@@ -69,37 +79,27 @@ def common_dataloader(cfg, original_data, k, trial=None):
         split_cfg = OmegaConf.load(f"{cfg.follow_splits}/k_{k:02d}/trial_{trial:04d}/config.yaml")
         train_indices, valid_indices, test_indices = list(split_cfg.dataset.split_info.train), list(split_cfg.dataset.split_info.valid), list(split_cfg.dataset.split_info.test)
 
-        for key in data["main"]:
-            split_data["train"][key], split_data["valid"][key], split_data["test"][key] = (
-                data["main"][key][train_indices],
-                data["main"][key][valid_indices],
-                data["main"][key][test_indices],
-            )
-        
     else:
         # just split the data
         # train/test split
-        split_data["train"], split_data["test"], train_indices, test_indices = cross_validation_split(
-            data["main"], cfg.mode.n_splits, k, return_indices=True
+        labels = data["main"]["labels"]
+        _, _, train_indices, test_indices = cross_validation_split(
+            {"labels": labels}, cfg.mode.n_splits, k, return_indices=True
         )
 
         # train/val split
+        train_labels = labels[train_indices]
         splitter = StratifiedShuffleSplit(
             n_splits=cfg.mode.n_trials,
-            test_size=split_data["train"]["labels"].shape[0] // cfg.mode.n_splits,
+            test_size=train_labels.shape[0] // cfg.mode.n_splits,
             random_state=42,
         )
         tr_val_splits = list(
-            splitter.split(split_data["train"]["labels"], split_data["train"]["labels"])
+            splitter.split(train_labels, train_labels)
         )
         tr_index, val_index = (
             tr_val_splits[0] if cfg.mode.name == "tune" else tr_val_splits[trial]
         )
-        for key in split_data["train"]:
-            split_data["train"][key], split_data["valid"][key] = (
-                split_data["train"][key][tr_index],
-                split_data["train"][key][val_index],
-            )
 
         # finalize split and save to log
         valid_indices = train_indices[val_index].tolist()
@@ -113,7 +113,29 @@ def common_dataloader(cfg, original_data, k, trial=None):
     }
     with open_dict(cfg):
         cfg.dataset.split_info = split_indices
-    
+    log_memory(cfg, "split", k=k, trial=trial)
+
+    key_order = ["TS", "FNC", "labels"]
+    if lazy:
+        dataloaders = {}
+        for key in data:
+            indices = split_indices if key == "main" else {key: None}
+            for split, split_idx in indices.items():
+                dataloaders[split] = DataLoader(
+                    IndexedDataset(
+                        [data[key][data_key] for data_key in key_order if data_key in data[key]],
+                        split_idx,
+                    ),
+                    batch_size=cfg.mode.batch_size,
+                    num_workers=0,
+                    shuffle=split == "train",
+                )
+        log_memory(cfg, "dataloaders", k=k, trial=trial, lazy=True)
+        return dataloaders
+
+    for key in data["main"]:
+        for split, split_idx in split_indices.items():
+            split_data[split][key] = data["main"][key][split_idx]
 
     # shuffle training data time-wise
     if "permute" in cfg and cfg.permute == "Single":
@@ -130,7 +152,6 @@ def common_dataloader(cfg, original_data, k, trial=None):
 
     # create dataloaders
     dataloaders = {}
-    key_order = ["TS", "FNC", "labels"]
     for key in split_data:
         for data_key in split_data[key]:
             if data_key == "labels":
@@ -155,10 +176,41 @@ def common_dataloader(cfg, original_data, k, trial=None):
             num_workers=0,
             shuffle=key == "train",
         )
+    log_memory(cfg, "dataloaders", k=k, trial=trial, lazy=False)
 
     return dataloaders
 
 
+class IndexedDataset(Dataset):
+    """
+    Dataset of rows of (shared, memory-mapped) arrays selected by indices.
+    Rows are read and converted to tensors on access, so the arrays are never copied as a whole.
+    Integer arrays (labels) are returned as int64 tensors, the rest as float32 tensors
+    """
+
+    def __init__(self, arrays, indices=None):
+        self.arrays = arrays
+        if indices is None:
+            indices = range(arrays[0].shape[0])
+        self.indices = np.asarray(indices)
+
+    def __len__(self):
+        return self.indices.shape[0]
+
+    def __getitem__(self, idx):
+        return self.__getitems__([idx])[0]
+
+    def __getitems__(self, idxs):
+        """Read a whole batch of rows at once"""
+        rows = self.indices[idxs]
+        tensors = []
+        for array in self.arrays:
+            dtype = torch.int64 if np.issubdtype(array.dtype, np.integer) else torch.float32
+            tensors.append(torch.as_tensor(np.array(array[rows]), dtype=dtype))
+        return list(zip(*tensors))
+
+
+@traced()
 def cross_validation_split(data, n_splits, k, return_indices=False):
     """
     Split data into train and test data using StratifiedKFold.
@@ -0,0 +1,249 @@
+# pylint: disable=invalid-name, global-statement
+"""Memory accounting utilities"""
+import json
+import os
+import resource
+import signal
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+import torch
+
+from omegaconf import DictConfig
+
+# the last stage logged with log_memory, reported when the memory limit is exceeded
+_last_stage = None
+_watchdog = None
+
+
+def available_memory(device):
+    """Return available memory in bytes on the device, or None if it can't be estimated"""
+    if device.type == "cuda":
+        free_memory, _ = torch.cuda.mem_get_info(device)
+        return free_memory
+
+    try:
+        with open("/proc/meminfo", "r", encoding="utf8") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def is_oom_error(e):
+    """Whether the exception is an out of memory error (CUDA or host)"""
+    if isinstance(e, (torch.cuda.OutOfMemoryError, MemoryError)):
+        return True
+    message = str(e).lower()
+    return "out of memory" in message or "can't allocate memory" in message
+
+
+def rss_stats():
+    """Return current and peak resident set size of the process in bytes (current is None if unknown)"""
+    current, peak = None, None
+    try:
+        with open("/proc/self/status", "r", encoding="utf8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    current = int(line.split()[1]) * 1024
+                elif line.startswith("VmHWM:"):
+                    peak = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if peak is None:
+        # kilobytes on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return current, peak
+
+
+def reset_peak_rss():
+    """Reset the peak RSS (Linux) and the CUDA allocator peak, so that they cover only the following stages"""
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="utf8") as f:
+            f.write("5")
+    except OSError:
+        pass
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        torch.cuda.reset_peak_memory_stats()
+
+
+def memory_snapshot(device=None):
+    """
+    Return process memory statistics in MB: current and peak RSS,
+    tracemalloc current and peak (if tracing), and CUDA allocator statistics (if CUDA is used)
+    """
+    rss, peak_rss = rss_stats()
+    snapshot = {
+        "rss_mb": rss / 2**20 if rss is not None else None,
+        "peak_rss_mb": peak_rss / 2**20,
+    }
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot["tracemalloc_mb"] = current / 2**20
+        snapshot["tracemalloc_peak_mb"] = peak / 2**20
+    if device is None:
+        use_cuda = torch.cuda.is_available() and torch.cuda.is_initialized()
+    else:
+        use_cuda = device.type == "cuda"
+    if use_cuda:
+        snapshot["cuda_allocated_mb"] = torch.cuda.memory_allocated(device) / 2**20
+        snapshot["cuda_reserved_mb"] = torch.cuda.memory_reserved(device) / 2**20
+        snapshot["cuda_peak_mb"] = torch.cuda.max_memory_allocated(device) / 2**20
+    return snapshot
+
+
+def log_memory(cfg: DictConfig, stage, scope="run", device=None, **info):
+    """
+    Append the memory snapshot after `stage` to memory_log.csv
+    in cfg.run_dir (scope="run") or cfg.project_dir (scope="project"), and return the snapshot.
+    Nothing is written if the directory is not set
+    """
+    global _last_stage
+    _last_stage = stage
+    snapshot = memory_snapshot(device)
+
+    key = "run_dir" if scope == "run" else "project_dir"
+    if key not in cfg or cfg[key] is None:
+        return snapshot
+    directory = cfg[key]
+    os.makedirs(directory, exist_ok=True)
+    row = {
+        "time": time.time(),
+        "pid": os.getpid(),
+        "stage": stage,
+        "info": json.dumps(info, default=str) if info else None,
+        **snapshot,
+    }
+    with open(f"{directory}/memory_log.csv", "a", encoding="utf8") as f:
+        pd.DataFrame(row, index=[0]).to_csv(f, header=f.tell() == 0, index=False)
+    return snapshot
+
+
+class MemoryLimitExceeded(Exception):
+    """The process exceeded the configured memory limit"""
+
+
+class MemoryWatchdog:
+    """
+    Daemon thread which polls the process RSS. If it exceeds limit bytes, the watchdog writes
+    a report (memory snapshot, the last logged stage, top tracemalloc allocations if tracing)
+    to {report_dir}/memory_limit_report.json and raises MemoryLimitExceeded in the main thread
+    (via SIGUSR1), so the run fails gracefully instead of being killed by the OOM killer.
+    Allocations in a long C call are not interrupted, so the limit should leave some headroom
+    """
+
+    def __init__(self, limit, report_dir, interval=0.5):
+        self.limit = limit
+        self.report_dir = report_dir
+        self.interval = interval
+        self.triggered = False
+        signal.signal(signal.SIGUSR1, self._raise)
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+        self._thread.start()
+
+    def _raise(self, *_):
+        raise MemoryLimitExceeded(
+            f"Memory limit of {self.limit / 2**30:.2f} GB exceeded at stage '{_last_stage}', "
+            f"see {self.report_dir}/memory_limit_report.json"
+        )
+
+    def _watch(self):
+        while not self.triggered:
+            rss, _ = rss_stats()
+            if rss is not None and rss > self.limit:
+                self.triggered = True
+                self.write_report()
+                os.kill(os.getpid(), signal.SIGUSR1)
+                return
+            time.sleep(self.interval)
+
+    def write_report(self):
+        """Save the memory report"""
+        report = {
+            "limit_gb": self.limit / 2**30,
+            "stage": _last_stage,
+            "pid": os.getpid(),
+            **memory_snapshot(),
+        }
+        if tracemalloc.is_tracing():
+            stats = tracemalloc.take_snapshot().statistics("lineno")[:20]
+            report["tracemalloc_top"] = [str(stat) for stat in stats]
+        os.makedirs(self.report_dir, exist_ok=True)
+        with open(f"{self.report_dir}/memory_limit_report.json", "w", encoding="utf8") as f:
+            json.dump(report, f, indent=2)
+
+
+def setup_memory_accounting(cfg: DictConfig, report_dir):
+    """
+    Start tracemalloc if cfg.tracemalloc is True, and the memory watchdog if cfg.memory_limit_gb is set
+    (once per process, later calls only move the report directory, e.g. to the current run)
+    """
+    global _watchdog
+    if "tracemalloc" in cfg and cfg.tracemalloc and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if "memory_limit_gb" not in cfg or not cfg.memory_limit_gb:
+        return
+    if _watchdog is None:
+        _watchdog = MemoryWatchdog(cfg.memory_limit_gb * 2**30, report_dir)
+    else:
+        _watchdog.report_dir = report_dir
+
+
+class ActivationMeter:
+    """
+    Measures activation memory retained by autograd:
+    counts the bytes of unique tensor storages saved for backward while the meter is active.
+    Parameters of `model` are not counted, since they are not activations.
+
+    Usage:
+        meter = ActivationMeter(model)
+        with meter:
+            loss = criterion(model(x))
+        meter.current, meter.peak  # bytes saved by the last forward pass / max over all passes
+    """
+
+    def __init__(self, model=None):
+        self.param_ptrs = set()
+        if model is not None:
+            self.param_ptrs = {
+                param.untyped_storage().data_ptr() for param in model.parameters()
+            }
+        self.peak = 0
+        self.current = 0
+        self._seen_ptrs = set()
+        self._hooks = None
+
+    def reset_peak(self):
+        """Reset the peak value, e.g. at the start of an epoch"""
+        self.peak = 0
+
+    def pack(self, tensor):
+        """saved_tensors_hooks pack hook: account the tensor storage once"""
+        storage = tensor.untyped_storage()
+        ptr = storage.data_ptr()
+        if ptr not in self.param_ptrs and ptr not in self._seen_ptrs:
+            self._seen_ptrs.add(ptr)
+            self.current += storage.nbytes()
+        return tensor
+
+    @staticmethod
+    def unpack(tensor):
+        """saved_tensors_hooks unpack hook"""
+        return tensor
+
+    def __enter__(self):
+        self.current = 0
+        self._seen_ptrs = set()
+        self._hooks = torch.autograd.graph.saved_tensors_hooks(self.pack, self.unpack)
+        self._hooks.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self._hooks.__exit__(*args)
+        self._hooks = None
+        self._seen_ptrs = set()
+        self.peak = max(self.peak, self.current)
@@ -0,0 +1,68 @@
+# pylint: disable=no-member, invalid-name
+"""On-device classification metrics, computed without per-batch host synchronization"""
+import torch
+
+
+def confusion_counts(y_true, y_pred, n_classes):
+    """Return [n_classes, n_classes] confusion matrix (rows - true classes, columns - predictions)"""
+    counts = torch.bincount(y_true * n_classes + y_pred, minlength=n_classes**2)
+    return counts.reshape(n_classes, n_classes)
+
+
+def average_ranks(x):
+    """Return 1-based ranks of x, tied values get the average of their ranks"""
+    sorted_x, order = torch.sort(x)
+    _, inverse, counts = torch.unique_consecutive(sorted_x, return_inverse=True, return_counts=True)
+    # average rank of each group of ties: (first rank + last rank) / 2
+    last_ranks = torch.cumsum(counts, dim=0).to(torch.float64)
+    group_ranks = last_ranks - (counts.to(torch.float64) - 1) / 2
+
+    ranks = torch.empty_like(group_ranks[inverse])
+    ranks[order] = group_ranks[inverse]
+    return ranks
+
+
+def binary_auc(y_true, y_score):
+    """
+    ROC AUC of binary y_true (bool) and y_score, computed from ranks (Mann-Whitney U statistic).
+    Returns nan if only one class is present
+    """
+    n_pos = y_true.sum().to(torch.float64)
+    n_neg = y_true.shape[0] - n_pos
+    ranks = average_ranks(y_score)
+    u_statistic = (ranks * y_true).sum() - n_pos * (n_pos + 1) / 2
+    return u_statistic / (n_pos * n_neg)
+
+
+def weighted_auc(y_true, y_score):
+    """
+    One-vs-rest ROC AUC for each class, averaged with class support weights.
+    Classes with undefined AUC (absent or the only present class) are ignored
+    """
+    n_classes = y_score.shape[1]
+    aucs, supports = [], []
+    for c in range(n_classes):
+        positives = y_true == c
+        aucs.append(binary_auc(positives, y_score[:, c]))
+        supports.append(positives.sum())
+    aucs, supports = torch.stack(aucs), torch.stack(supports).to(torch.float64)
+
+    defined = ~torch.isnan(aucs)
+    return torch.where(defined, aucs * supports, 0.0).sum() / torch.where(defined, supports, 0.0).sum()
+
+
+def classification_metrics(y_true, y_score):
+    """
+    Return accuracy and support-weighted ROC AUC (as 0-dim tensors on the input device),
+    and the confusion matrix, for targets y_true [n_samples] and class probabilities y_score [n_samples, n_classes]
+    """
+    n_classes = y_score.shape[1]
+    y_pred = torch.argmax(y_score, dim=-1)
+    confusion = confusion_counts(y_true, y_pred, n_classes)
+    accuracy = confusion.diagonal().sum() / y_true.shape[0]
+
+    return {
+        "accuracy": accuracy,
+        "auc": weighted_auc(y_true, y_score),
+        "confusion": confusion,
+    }
@@ -5,8 +5,17 @@ from importlib import import_module
 import os
 
 from omegaconf import OmegaConf, DictConfig, open_dict
+import optuna
+import pandas as pd
+import torch
 
+from src.memory import ActivationMeter, is_oom_error
+from src.model_utils import freeze_groups, compile_model, estimate_cost, copy_model, benchmark_step
+from src.utils import append_csv
+from src.tracing import span, traced
 
+
+@traced()
 def model_config_factory(cfg: DictConfig, optuna_trial=None):
     """Model config factory"""
     if cfg.mode.name == "tune":
@@ -47,9 +56,59 @@ def get_tune_config(cfg: DictConfig, optuna_trial=None):
     print("Tuning model config:")
     print(f"{OmegaConf.to_yaml(model_cfg)}")
 
+    # pre-flight check of the sampled config against the per-trial budget
+    if "budget" in cfg.mode and cfg.mode.budget is not None:
+        check_budget(cfg, model_cfg, model_module.get_model, optuna_trial)
+
     return model_cfg
 
 
+def check_budget(cfg: DictConfig, model_cfg: DictConfig, get_model, optuna_trial=None):
+    """
+    Estimate the cost of the sampled model config and compare it with cfg.mode.budget limits
+    (max_params, max_activation_mb, max_step_time; null - no limit). The estimate is logged in budget_log.csv.
+    Over-budget configs are either skipped (action: prune, the optuna trial is pruned before training),
+    or trained and marked with 'over_budget' trial attribute (action: penalize).
+    Limits that can't be measured (activation memory and step time of non-TS data) are reported and not enforced
+    """
+    budget = cfg.mode.budget
+    limits = {
+        "params": budget.get("max_params"),
+        "activation_mb": budget.get("max_activation_mb"),
+        "step_time": budget.get("max_step_time"),
+    }
+    action = budget.get("action", "prune")
+    if action not in ["prune", "penalize"]:
+        raise ValueError(f"Unknown budget action '{action}', use 'prune' or 'penalize'")
+
+    probe = limits["activation_mb"] is not None or limits["step_time"] is not None
+    cost = estimate_cost(cfg, model_cfg, get_model, probe=probe, n_steps=budget.get("probe_steps", 3))
+    exceeded = [
+        key for key, limit in limits.items()
+        if limit is not None and key in cost and cost[key] > limit
+    ]
+    unmeasured = [key for key, limit in limits.items() if limit is not None and key not in cost]
+    if len(unmeasured) != 0:
+        print(f"Budget limits can't be measured for '{cfg.dataset.name}' data and are not enforced: {', '.join(unmeasured)}")
+
+    log = {
+        "trial": optuna_trial.number if optuna_trial is not None else None,
+        **cost,
+        "exceeded": ",".join(exceeded),
+        "unmeasured": ",".join(unmeasured),
+        "action": action if len(exceeded) != 0 else None,
+    }
+    append_csv(pd.DataFrame(log, index=[0]), f"{cfg.k_dir}/budget_log.csv")
+
+    if len(exceeded) == 0:
+        return
+    print(f"Model config exceeds the budget ({', '.join(exceeded)}): {cost}")
+    if optuna_trial is not None:
+        optuna_trial.set_user_attr("over_budget", True)
+        if action == "prune":
+            raise optuna.TrialPruned(f"Model config exceeds the budget: {', '.join(exceeded)}")
+
+
 def get_best_config(cfg: DictConfig):
     """
     1. If cfg.HP_path is not None, return the HPs stored in cfg.HP_path.
@@ -98,6 +157,7 @@ def get_best_config(cfg: DictConfig):
     return model_cfg
 
 
+@traced()
 def model_factory(cfg: DictConfig, model_cfg: DictConfig):
     """Models factory"""
     try:
@@ -117,6 +177,61 @@ def model_factory(cfg: DictConfig, model_cfg: DictConfig):
                              'get_model'. Is the function misnamed/not defined?"
         ) from e
 
-    model = get_model(cfg, model_cfg)
+    with span("get_model", model=cfg.model.name):
+        model = get_model(cfg, model_cfg)
+
+    # freeze the requested submodule groups (e.g., parts of a pretrained model)
+    if "freeze" in cfg.model and cfg.model.freeze:
+        try:
+            group_map = model_module.FREEZE_GROUPS
+        except AttributeError as e:
+            raise AttributeError(
+                f"'src.models.{cfg.model.name}' has no\
+                                 'FREEZE_GROUPS'. Is the model not supposed to be frozen?"
+            ) from e
+        log_freeze_savings(cfg, model, list(cfg.model.freeze), group_map)
+        model = freeze_groups(model, list(cfg.model.freeze), group_map)
+
+    # compile the model (falls back to eager mode if the model can't be compiled)
+    if "compile" in cfg.model and cfg.model.compile:
+        model = compile_model(
+            cfg, model_cfg, model, getattr(model_module, "COMPILE_TARGETS", None)
+        )
 
     return model
+
+
+def log_freeze_savings(cfg: DictConfig, model, groups, group_map):
+    """
+    Probe a training step of copies of the model without and with the groups frozen,
+    and log the activation memory and step time saved by freezing in run_dir/freeze_savings.csv
+    """
+    costs = {}
+    for name, frozen in [("unfrozen", []), ("frozen", groups)]:
+        probe_model = freeze_groups(copy_model(model, recompile=False), frozen, group_map)
+        meter = ActivationMeter(probe_model)
+        try:
+            step_time = benchmark_step(cfg, probe_model, n_steps=3, activation_meter=meter)
+        except (torch.cuda.OutOfMemoryError, MemoryError, RuntimeError) as e:
+            if not is_oom_error(e):
+                raise
+            step_time = None
+        del probe_model
+        if step_time is None:
+            print("Freezing savings can't be measured (non-TS data or out of memory)")
+            return
+        costs[name] = {"activation_mb": meter.peak / 2**20, "step_time": step_time}
+
+    savings = {
+        "groups": ",".join(groups),
+        **{f"{key}_unfrozen": value for key, value in costs["unfrozen"].items()},
+        **{f"{key}_frozen": value for key, value in costs["frozen"].items()},
+        "activation_mb_saved": costs["unfrozen"]["activation_mb"] - costs["frozen"]["activation_mb"],
+        "step_time_saved": costs["unfrozen"]["step_time"] - costs["frozen"]["step_time"],
+    }
+    print(
+        f"Freezing {savings['groups']} saves {savings['activation_mb_saved']:.1f} MB of activations "
+        f"and {savings['step_time_saved']:.4f} s per training step"
+    )
+    os.makedirs(cfg.run_dir, exist_ok=True)
+    append_csv(pd.DataFrame(savings, index=[0]), f"{cfg.run_dir}/freeze_savings.csv")
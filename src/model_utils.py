@@ -1,10 +1,22 @@
 # pylint: disable=invalid-name, too-few-public-methods
 """Models for experiments and functions for setting them up"""
 
+from contextlib import nullcontext
+from copy import deepcopy
 from importlib import import_module
+import hashlib
+import math
+import os
+import time
+
+import torch
 from torch import nn, optim
+import pandas as pd
+
+from omegaconf import DictConfig, OmegaConf
 
-from omegaconf import DictConfig
+from src.memory import ActivationMeter, available_memory, is_oom_error
+from src.settings import COMPILE_CACHE_ROOT
 
 
 def criterion_factory(cfg: DictConfig, model_cfg: DictConfig):
@@ -49,10 +61,12 @@ class CEloss:
 def optimizer_factory(cfg: DictConfig, model_cfg: DictConfig, model):
     """Optimizer factory"""
     if "custom_optimizer" not in cfg.model or not cfg.model.custom_optimizer:
-        optimizer = optim.Adam(
-            model.parameters(),
-            lr=float(model_cfg["lr"]),
-        )
+        params = [param for param in model.parameters() if param.requires_grad]
+        if len(params) == 0:
+            raise ValueError(
+                f"'{cfg.model.name}' has no trainable parameters, check the frozen groups in cfg.model.freeze"
+            )
+        optimizer = optim.Adam(params, lr=float(model_cfg["lr"]))
     else:
         try:
             model_module = import_module(f"src.models.{cfg.model.name}")
@@ -111,3 +125,291 @@ class DummyScheduler:
 
     def step(self, metric):
         pass
+
+
+def freeze_groups(model, groups, group_map):
+    """
+    Freeze named submodule groups of the model.
+    group_map maps group names to the model's submodule attributes;
+    the models which support cfg.model.freeze define it as FREEZE_GROUPS in their module
+    (model_factory raises if it is missing)
+    """
+    unknown_groups = [group for group in groups if group not in group_map]
+    if len(unknown_groups) != 0:
+        raise ValueError(
+            f"Unknown freeze groups {unknown_groups}, available groups are {list(group_map)}"
+        )
+
+    frozen_modules = []
+    for group in groups:
+        for attr in group_map[group]:
+            getattr(model, attr).requires_grad_(False)
+            frozen_modules.append(attr)
+
+    # used by the models to skip autograd for frozen parts of the graph,
+    # and by the trainer to keep frozen modules in eval mode
+    model.frozen_groups = tuple(groups)
+    model.frozen_modules = tuple(frozen_modules)
+
+    return model
+
+
+def no_grad_if_frozen(model, *groups):
+    """
+    Returns no_grad context if all given groups of the model are frozen.
+    Should only wrap the parts of forward pass which don't depend on trainable parameters,
+    so that autograd doesn't retain their activations
+    """
+    frozen_groups = getattr(model, "frozen_groups", ())
+    if all(group in frozen_groups for group in groups):
+        return torch.no_grad()
+    return nullcontext()
+
+
+def copy_model(model, recompile=True):
+    """
+    Deep copy of the model that runs on its own weights.
+    Modules compiled in-place (Module.compile) keep calling the original module after deepcopy,
+    so their copies are compiled again, or run in eager mode if recompile=False
+    """
+    model_copy = deepcopy(model)
+    for module in model_copy.modules():
+        if getattr(module, "_compiled_call_impl", None) is not None:
+            module._compiled_call_impl = None  # pylint: disable=protected-access
+            if recompile:
+                module.compile(backend="inductor")
+    return model_copy
+
+
+def autocast_disabled(tensor):
+    """
+    Returns context which disables autocast on the tensor's device, so that the block runs in fp32.
+    Devices without autocast support (e.g. meta, used by the static profiler) get a no-op context
+    """
+    if tensor.device.type in ["cuda", "cpu"]:
+        return torch.autocast(device_type=tensor.device.type, enabled=False)
+    return nullcontext()
+
+
+def compile_model(cfg: DictConfig, model_cfg: DictConfig, model, compile_targets=None):
+    """
+    Compile the model according to cfg.model.compile:
+        "inductor" - torch.compile with the Inductor backend, compiled in-place so that
+            state_dict keys and custom methods (compute_loss, save_data) are preserved;
+            if compile_targets (list of submodule names) is given,
+            only these submodules are compiled. model_factory takes them from COMPILE_TARGETS
+            in the model's module: recurrent models whose loop is unrolled over time
+            compile only the per-time-step block
+        "script" - torch.jit.script, only for models that don't rely on custom methods;
+            models with custom_criterion (DBNglass variants, DICE, ...) are not supported
+    The models that can't be compiled run in eager mode.
+    Compiled artifacts are cached in COMPILE_CACHE_ROOT, so that the compilation cost
+    is paid once per (model, input shape) across trials and processes.
+    """
+    mode = cfg.model.compile
+    if mode not in ["inductor", "script"]:
+        raise ValueError(f"Unknown compile mode '{mode}', use 'inductor' or 'script'")
+
+    def compile_fn(module):
+        if mode == "inductor":
+            return inductor_compile(module, compile_targets)
+        return script_compile(cfg, model_cfg, module)
+
+    try:
+        n_steps = cfg.model.compile_benchmark if "compile_benchmark" in cfg.model else 0
+        if n_steps:
+            # measure on copies, so that the model's state (e.g. BatchNorm stats) is untouched
+            eager_time = benchmark_step(cfg, deepcopy(model), n_steps)
+            start_time = time.time()
+            compiled_time = benchmark_step(cfg, compile_fn(deepcopy(model)), n_steps)
+            if eager_time is not None:
+                results = {
+                    "model": cfg.model.name,
+                    "compile": mode,
+                    "eager_step_time": eager_time,
+                    "compiled_step_time": compiled_time,
+                    "speedup": eager_time / compiled_time,
+                    # compilation happens in the untimed warm-up step
+                    "compile_time": time.time() - start_time - compiled_time * n_steps,
+                }
+                print(f"Compile benchmark: {results}")
+                benchmark_path = f"{cfg.project_dir}/compile_benchmark.csv"
+                pd.DataFrame([results]).to_csv(
+                    benchmark_path, mode="a", header=not os.path.exists(benchmark_path), index=False
+                )
+
+        compiled = compile_fn(model)
+    except Exception as e:  # pylint: disable=broad-except
+        print(f"Can't compile '{cfg.model.name}' in '{mode}' mode, using eager mode: {e}")
+        return model
+
+    return compiled
+
+
+def inductor_compile(model, compile_targets=None):
+    """
+    Compile the model (or its compile_targets submodules) in-place with torch.compile.
+    Compilation happens lazily on the first forward pass, so the code that can't be compiled
+    falls back to eager mode via torch._dynamo.config.suppress_errors, which is process-wide:
+    after this call, dynamo errors of any compiled module in the process are logged instead of raised
+    """
+    if not hasattr(nn.Module, "compile"):
+        raise RuntimeError("in-place torch.compile requires torch>=2.2")
+    # pylint: disable=import-outside-toplevel, protected-access
+    import torch._dynamo
+    import torch._functorch.config
+    import torch._inductor.config
+
+    # persistent FX graph (and AOTAutograd, if supported) caches; the config is set directly,
+    # as the environment variables are read when torch._inductor.config is imported.
+    # The cache directory is read from the environment at the first compilation
+    cache_dir = COMPILE_CACHE_ROOT.joinpath("inductor")
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", str(cache_dir))
+    torch._inductor.config.fx_graph_cache = True
+    if hasattr(torch._functorch.config, "enable_autograd_cache"):
+        torch._functorch.config.enable_autograd_cache = True
+
+    torch._dynamo.config.suppress_errors = True
+
+    if compile_targets is None:
+        model.compile(backend="inductor")
+    else:
+        for name in compile_targets:
+            getattr(model, name).compile(backend="inductor")
+
+    return model
+
+
+def script_compile(cfg: DictConfig, model_cfg: DictConfig, model):
+    """Script the model with torch.jit.script, reuse the cached scripted module if it exists"""
+    if "custom_criterion" in cfg.model and cfg.model.custom_criterion:
+        raise RuntimeError("scripted models don't keep custom methods like 'compute_loss'")
+
+    # scripted module depends only on the model architecture, not on the training HPs
+    model_key = hashlib.sha1(
+        f"{cfg.model.name}:{OmegaConf.to_yaml(model_cfg, sort_keys=True)}:{torch.__version__}".encode()
+    ).hexdigest()[:16]
+    cache_dir = COMPILE_CACHE_ROOT.joinpath("script")
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = f"{cache_dir}/{cfg.model.name}_{model_key}.pt"
+
+    if os.path.exists(cache_path):
+        scripted = torch.jit.load(cache_path, map_location="cpu")
+        scripted.load_state_dict(model.state_dict())
+    else:
+        scripted = torch.jit.script(model)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        torch.jit.save(scripted, tmp_path)
+        os.replace(tmp_path, cache_path)
+
+    return scripted
+
+
+def benchmark_step(cfg: DictConfig, model, n_steps, activation_meter=None, batch_size=None):
+    """
+    Return mean forward/backward step time of the model on a random batch of TS data
+    (cfg.mode.batch_size samples by default), on the training device and under cfg.model.precision.
+    The first step (compilation, warm-up) is not included; it runs inside activation_meter if provided.
+    Returns None if the data is not [subjects, time, components] TS data.
+    """
+    data_shape = cfg.dataset.data_info.main.data_shape
+    if OmegaConf.is_dict(data_shape) or len(data_shape) != 3:
+        return None
+
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    precision = cfg.model.precision if "precision" in cfg.model and cfg.model.precision is not None else "fp32"
+    if batch_size is None:
+        batch_size = min(cfg.mode.batch_size, data_shape[0])
+    x = torch.randn(batch_size, *data_shape[1:], device=device)
+    model = model.to(device)
+    if precision == "bf16":
+        model, x = model.to(torch.bfloat16), x.to(torch.bfloat16)
+    model.train()
+
+    def step(meter=None):
+        with meter if meter is not None else nullcontext(), torch.autocast(
+            device_type=device.type, dtype=torch.bfloat16, enabled=precision == "bf16-autocast"
+        ):
+            output = model(x)
+        logits = output[0] if isinstance(output, (tuple, list)) else output
+        logits.float().sum().backward()
+        model.zero_grad(set_to_none=True)
+
+    step(activation_meter)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start_time = time.time()
+    for _ in range(n_steps):
+        step()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return (time.time() - start_time) / n_steps if n_steps else 0.0
+
+
+def estimate_cost(cfg: DictConfig, model_cfg: DictConfig, get_model, probe=True, n_steps=3):
+    """
+    Estimate the cost of training get_model(cfg, model_cfg) on cfg.dataset:
+        params - parameter count;
+        activation_mb, step_time - activation memory and mean training step time over n_steps steps,
+            measured on random batches of the actual data shape if probe is True (TS data only).
+            The probe runs like the trainer: on the training device, under cfg.model.precision,
+            and with cfg.mode.micro_batching the batch is split into micro-batches that fit into memory
+            (step_time covers all accumulation steps). Configs that run out of memory get inf.
+    Without the probe the model is built on the meta device, without allocating memory.
+    """
+    if not probe:
+        try:
+            with torch.device("meta"):
+                model = get_model(cfg, model_cfg)
+        except Exception:  # pylint: disable=broad-except
+            # some models allocate real tensors in __init__
+            model = get_model(cfg, model_cfg)
+        return {"params": sum(param.numel() for param in model.parameters())}
+
+    model = get_model(cfg, model_cfg)
+    cost = {"params": sum(param.numel() for param in model.parameters())}
+    data_shape = cfg.dataset.data_info.main.data_shape
+    if OmegaConf.is_dict(data_shape) or len(data_shape) != 3:
+        return cost
+
+    batch_size = min(cfg.mode.batch_size, data_shape[0])
+    accumulation_steps = 1
+    try:
+        if "micro_batching" in cfg.mode and cfg.mode.micro_batching:
+            # pick the micro-batch size as BasicTrainer.probe_micro_batch_size does
+            meter = ActivationMeter(model)
+            benchmark_step(cfg, model, n_steps=0, activation_meter=meter, batch_size=min(2, batch_size))
+            sample_memory = max(meter.peak / min(2, batch_size), 1)
+            fraction = cfg.mode.memory_fraction if "memory_fraction" in cfg.mode else 0.8
+            if "memory_budget_gb" in cfg.mode and cfg.mode.memory_budget_gb:
+                memory = cfg.mode.memory_budget_gb * 2**30
+            else:
+                memory = available_memory(torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
+            if memory is not None:
+                micro_batch_size = int(min(max(memory * fraction // sample_memory, 1), batch_size))
+                accumulation_steps = math.ceil(batch_size / micro_batch_size)
+                batch_size = micro_batch_size
+
+        meter = ActivationMeter(model)
+        step_time = benchmark_step(cfg, model, n_steps, activation_meter=meter, batch_size=batch_size)
+    except (torch.cuda.OutOfMemoryError, MemoryError, RuntimeError) as e:
+        if not is_oom_error(e):
+            raise
+        print(f"Cost probe: batch size {batch_size} is out of memory")
+        cost["activation_mb"] = float("inf")
+        cost["step_time"] = float("inf")
+        return cost
+
+    cost["activation_mb"] = meter.peak / 2**20
+    cost["step_time"] = step_time * accumulation_steps
+    return cost
+
+    model = get_model(cfg, model_cfg)
+    meter = ActivationMeter(model)
+    step_time = benchmark_step(cfg, model, n_steps=1, activation_meter=meter)
+    if step_time is not None:
+        cost["activation_mb"] = meter.peak / 2**20
+        cost["step_time"] = step_time
+
+    return cost
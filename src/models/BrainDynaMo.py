@@ -9,17 +9,29 @@ from torch.nn import functional as F
 
 from omegaconf import OmegaConf, DictConfig
 from src.settings import WEIGHTS_ROOT
+from src.model_utils import autocast_disabled, no_grad_if_frozen
+from src.tracing import span
+
+FREEZE_GROUPS = {
+    "embeddings": ["embeddings"],
+    "gru": ["gru"],
+    "attention": ["attention"],
+    "predictor": ["predictor"],
+    "clf": ["clf"],
+}
+COMPILE_TARGETS = ["attention"]
 
 def get_model(cfg: DictConfig, model_cfg: DictConfig):
     model = BrainDynaMo(model_cfg)
     if model_cfg.load_pretrained == True:
         path = model_cfg.pretrained_path
-        checkpoint = torch.load(
-            path, map_location=lambda storage, loc: storage
-        )
-        dont_load = ["clf"]
-        pruned_checkpoint = {k: v for k, v in checkpoint.items() if not any(bad_key in k for bad_key in dont_load)}
-        model.load_state_dict(pruned_checkpoint, strict=False)
+        with span("load_pretrained"):
+            checkpoint = torch.load(
+                path, map_location=lambda storage, loc: storage
+            )
+            dont_load = ["clf"]
+            pruned_checkpoint = {k: v for k, v in checkpoint.items() if not any(bad_key in k for bad_key in dont_load)}
+            model.load_state_dict(pruned_checkpoint, strict=False)
 
     return model
 
@@ -80,6 +92,7 @@ class InvertedHoyerMeasure:
 
     def __call__(self, x):
         # Assuming x has shape (batch_size, input_dim, input_dim)
+        x = x.float() # the measure is computed in fp32 under reduced precision
 
         n = x[0].numel()
         sqrt_n = torch.sqrt(torch.tensor(float(n), device=x.device))
@@ -123,14 +136,14 @@ class BDMLoss:
             FNCs = FNCs.reshape(B*T, C, C)
             sparse_loss = self.sparsity_loss(FNCs)
 
-            pred_loss = F.mse_loss(predicted, originals)
+            pred_loss = F.mse_loss(predicted.float(), originals.float())
 
             loss = ce_loss + self.sp_weight * sparse_loss + self.pred_weight * pred_loss
 
             loss_components = {
-                "ce_loss": ce_loss.item(),
-                "sp_loss": sparse_loss.item(),
-                "pred_loss": pred_loss.item(),
+                "ce_loss": ce_loss.detach(),
+                "sp_loss": sparse_loss.detach(),
+                "pred_loss": pred_loss.detach(),
             }
             return loss, loss_components
         
@@ -139,13 +152,13 @@ class BDMLoss:
             FNCs = FNCs.reshape(B*T, C, C)
             sparse_loss = self.sparsity_loss(FNCs)
 
-            pred_loss = F.mse_loss(predicted, originals)
+            pred_loss = F.mse_loss(predicted.float(), originals.float())
 
             loss =  self.sp_weight * sparse_loss + self.pred_weight * pred_loss
 
             loss_components = {
-                "sp_loss": sparse_loss.item(),
-                "pred_loss": pred_loss.item(),
+                "sp_loss": sparse_loss.detach(),
+                "pred_loss": pred_loss.detach(),
             }
             return loss, loss_components
 
@@ -213,9 +226,10 @@ class BrainDynaMo(nn.Module):
         orig_x = x
 
         # Apply embedding vector
-        x = x.permute(0, 2, 1)
-        x = x.reshape(B, C, T, 1)
-        embedded = self.embeddings(x) # shape: (B, C, T, self.embedding_dim)
+        with no_grad_if_frozen(self, "embeddings"):
+            x = x.permute(0, 2, 1)
+            x = x.reshape(B, C, T, 1)
+            embedded = self.embeddings(x) # shape: (B, C, T, self.embedding_dim)
 
         # Initialize hidden state and run the recurrent loop
         h = torch.zeros(B, C, self.hidden_dim, device=x.device)
@@ -223,30 +237,33 @@ class BrainDynaMo(nn.Module):
 
         mixing_matrices = []
         hidden_states = []
-        for t in range(T):
-            # prepare the input data for GRU
-            gru_input = embedded[:, :, t, :].unsqueeze(2)  # (B, C, 1, embedding_dim)
-            gru_input = gru_input.reshape(B*C, 1, self.embedding_dim) # (B*C, 1, embedding_dim)
-            # input hidden state must have shape (D * num_layers, N, hidden_size), D*num_layers = 1 in our case, N is GRU batch size
-            h = h.reshape(1, B*C, self.hidden_dim) # (1, B*C, hidden_dim)
+        # the whole recurrence can skip autograd only if all of its parts are frozen
+        with no_grad_if_frozen(self, "embeddings", "gru", "attention"):
+            for t in range(T):
+                # prepare the input data for GRU
+                gru_input = embedded[:, :, t, :].unsqueeze(2)  # (B, C, 1, embedding_dim)
+                gru_input = gru_input.reshape(B*C, 1, self.embedding_dim) # (B*C, 1, embedding_dim)
+                # input hidden state must have shape (D * num_layers, N, hidden_size), D*num_layers = 1 in our case, N is GRU batch size
+                h = h.reshape(1, B*C, self.hidden_dim) # (1, B*C, hidden_dim)
 
-            # update the hidden states with the new input by running GRU
-            _, h = self.gru(gru_input, h) # output h shape is the same: (1, GRU_batch, hidden_size)
-            h = h.reshape(B, self.input_size, self.hidden_dim) # (B, C, hidden_dim)
+                # update the hidden states with the new input by running GRU
+                _, h = self.gru(gru_input, h) # output h shape is the same: (1, GRU_batch, hidden_size)
+                h = h.reshape(B, self.input_size, self.hidden_dim) # (B, C, hidden_dim)
 
-            # Apply self-attention
-            h, mixing_matrix = self.attention(h)
-            hidden_states.append(h)
-            mixing_matrices.append(mixing_matrix)
+                # Apply self-attention
+                h, mixing_matrix = self.attention(h)
+                hidden_states.append(h)
+                mixing_matrices.append(mixing_matrix)
 
-            if torch.any(torch.isnan(h)):
-                raise Exception(f"h has nans at time point {t}")
+                if not h.is_meta and torch.any(torch.isnan(h)):
+                    raise Exception(f"h has nans at time point {t}")
 
 
         # Stack the alignment matrices, predict the next input 
         mixing_matrices = torch.stack(mixing_matrices, dim=1)  # (batch_size, seq_len, input_size, input_size)
         hidden_states = torch.stack(hidden_states, dim=1)[:, :-1, :, :] # brain latent states starting with time 0, [batch_size; time_length-1; input_size, hidden_dim]
-        predicted = self.predictor(hidden_states).squeeze() # predictions of x starting with time 1, [batch_size; time_length-1; input_size]
+        with no_grad_if_frozen(self, "embeddings", "gru", "attention", "predictor"):
+            predicted = self.predictor(hidden_states).squeeze() # predictions of x starting with time 1, [batch_size; time_length-1; input_size]
 
         if pretraining:
             # pretrain on the input prediction task
@@ -302,8 +319,11 @@ class BilinearAttention(nn.Module):
         keys = self.key(x)
 
         transfer = torch.bmm(queries, keys.transpose(1, 2))
-        norms = torch.linalg.matrix_norm(transfer, keepdim=True)
-        transfer = transfer / norms
+        # Frobenius-norm normalization is kept in fp32 under reduced precision
+        with autocast_disabled(transfer):
+            transfer_fp32 = transfer.float()
+            norms = torch.linalg.matrix_norm(transfer_fp32, keepdim=True)
+            transfer = (transfer_fp32 / norms).to(transfer.dtype)
 
         gate = self.gate(transfer)
         transfer = transfer * gate
@@ -8,10 +8,19 @@ import torch.nn.functional as F
 from torch.nn.utils.parametrizations import spectral_norm
 
 from omegaconf import OmegaConf, DictConfig
+from src.model_utils import no_grad_if_frozen
 
 import ipdb
 import time
 
+FREEZE_GROUPS = {
+    "embeddings": ["embeddings"],
+    "gru": ["gru"],
+    "attention": ["attention"],
+    "predictor": ["predictor"],
+    "clf": ["clf"],
+}
+
 
 def get_model(cfg: DictConfig, model_cfg: DictConfig):
     model = MultivariateTSModel(model_cfg)
@@ -193,12 +202,13 @@ class MultivariateTSModel(nn.Module):
         orig_x = x
         # Apply component-specific embeddings
         # embedded = torch.stack([self.embeddings[i](x[:, :, i].unsqueeze(-1)) for i in range(self.num_components)], dim=1)
-        if self.single_embed:
-            x = x.permute(0, 2, 1)
-            x = x.reshape(B * self.num_components, T, 1)
-            embedded = self.embeddings(x).reshape(B, self.num_components, T, self.embedding_dim)
-        else:
-            embedded = torch.stack([self.embeddings[i](x[:, :, i].unsqueeze(-1)) for i in range(self.num_components)], dim=1)
+        with no_grad_if_frozen(self, "embeddings"):
+            if self.single_embed:
+                x = x.permute(0, 2, 1)
+                x = x.reshape(B * self.num_components, T, 1)
+                embedded = self.embeddings(x).reshape(B, self.num_components, T, self.embedding_dim)
+            else:
+                embedded = torch.stack([self.embeddings[i](x[:, :, i].unsqueeze(-1)) for i in range(self.num_components)], dim=1)
 
         if torch.any(torch.isnan(x)):
             print("X has nons")
@@ -212,35 +222,38 @@ class MultivariateTSModel(nn.Module):
         mixing_matrices = []
         hidden_states = []
         
-        for t in range(T):
-            # Process one time step
-            gru_input = embedded[:, :, t, :].unsqueeze(1).permute(0, 2, 1, 3)  # (batch_size, num_components, 1, embedding_dim)
-            gru_input = gru_input.reshape(B*self.num_components, 1, self.embedding_dim) # (batch_size * num_components, 1, embedding_dim)
-            h_0 = h_0.permute(1, 0, 2, 3).reshape(1, B*self.num_components, self.hidden_dim) # (1, batch_size * num_components, hidden_dim)
-            _, h_0 = self.gru(gru_input, h_0)
-            h_0 = h_0.reshape(1, B, self.num_components, self.hidden_dim).permute(1, 0, 2, 3) # (batch_size, 1, num_components, hidden_dim)
-
-            # Reshape h_0 for self-attention
-            h_0_reshaped = h_0.squeeze(1)  # (batch_size, num_components, hidden_dim)
-
-            # Apply self-attention
-            h_0, mixing_matrix = self.attention(h_0_reshaped)
-            hidden_states.append(h_0)
-            # Update h_0 with attention output
-            h_0 = h_0.unsqueeze(1)
-            # h_0_attn.append(h_0)
-
-            mixing_matrices.append(mixing_matrix)
-            # hid_states.append(h_0)
-
-            if torch.any(torch.isnan(h_0)):
-                raise Exception(f"h_0 has nans at time point {t}")
+        # the whole recurrence can skip autograd only if all of its parts are frozen
+        with no_grad_if_frozen(self, "embeddings", "gru", "attention"):
+            for t in range(T):
+                # Process one time step
+                gru_input = embedded[:, :, t, :].unsqueeze(1).permute(0, 2, 1, 3)  # (batch_size, num_components, 1, embedding_dim)
+                gru_input = gru_input.reshape(B*self.num_components, 1, self.embedding_dim) # (batch_size * num_components, 1, embedding_dim)
+                h_0 = h_0.permute(1, 0, 2, 3).reshape(1, B*self.num_components, self.hidden_dim) # (1, batch_size * num_components, hidden_dim)
+                _, h_0 = self.gru(gru_input, h_0)
+                h_0 = h_0.reshape(1, B, self.num_components, self.hidden_dim).permute(1, 0, 2, 3) # (batch_size, 1, num_components, hidden_dim)
+
+                # Reshape h_0 for self-attention
+                h_0_reshaped = h_0.squeeze(1)  # (batch_size, num_components, hidden_dim)
+
+                # Apply self-attention
+                h_0, mixing_matrix = self.attention(h_0_reshaped)
+                hidden_states.append(h_0)
+                # Update h_0 with attention output
+                h_0 = h_0.unsqueeze(1)
+                # h_0_attn.append(h_0)
+
+                mixing_matrices.append(mixing_matrix)
+                # hid_states.append(h_0)
+
+                if torch.any(torch.isnan(h_0)):
+                    raise Exception(f"h_0 has nans at time point {t}")
             
         
         # Stack the alignment matrices
         mixing_matrices = torch.stack(mixing_matrices, dim=1)  # (batch_size, seq_len, num_components, num_components)
         hidden_states = torch.stack(hidden_states, dim=1)[:, 1:, :, :] #[batch_size; time_length-1; num_components, hidden_dim]
-        predicted = self.predictor(hidden_states).squeeze() #[batch_size; time_length-1; num_components]
+        with no_grad_if_frozen(self, "embeddings", "gru", "attention", "predictor"):
+            predicted = self.predictor(hidden_states).squeeze() #[batch_size; time_length-1; num_components]
         
         if pretraining:
             return mixing_matrices, predicted, orig_x[:, 1:, :]
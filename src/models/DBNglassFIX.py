@@ -2,28 +2,125 @@
 """ glassDBN model """
 
 import os
+import shutil
 
+import numpy as np
 import torch
 from torch import nn
 from torch.nn import functional as F
+from torch.utils.data import DataLoader, TensorDataset, default_collate
 
 from omegaconf import OmegaConf, DictConfig
 from src.settings import WEIGHTS_ROOT
+from src.model_utils import autocast_disabled, freeze_groups, no_grad_if_frozen
+from src.tracing import span
+from src.trainer import BasicTrainer, ce_wrapper
+
+FREEZE_GROUPS = {
+    "embeddings": ["embeddings"],
+    "gru": ["gru"],
+    "attention": ["attention"],
+    "predictor": ["predictor"],
+    "clf": ["clf"],
+}
+# groups frozen with cfg.model.frozen_encoder, the head is trained from cached encoder outputs
+FROZEN_ENCODER_GROUPS = ["embeddings", "gru", "attention", "predictor"]
+COMPILE_TARGETS = ["attention"]
 
 def get_model(cfg: DictConfig, model_cfg: DictConfig):
     model = glassDBN(model_cfg)
     if model_cfg.load_pretrained == True:
         path = model_cfg.pretrained_path
-        checkpoint = torch.load(
-            path, map_location=lambda storage, loc: storage
-        )
-        dont_load = ["clf"]
-        pruned_checkpoint = {k: v for k, v in checkpoint.items() if not any(key in k for key in dont_load)}
-        model.load_state_dict(pruned_checkpoint, strict=False)
+        with span("load_pretrained"):
+            checkpoint = torch.load(
+                path, map_location=lambda storage, loc: storage
+            )
+            dont_load = ["clf"]
+            pruned_checkpoint = {k: v for k, v in checkpoint.items() if not any(key in k for key in dont_load)}
+            model.load_state_dict(pruned_checkpoint, strict=False)
+    if "frozen_encoder" in cfg.model and cfg.model.frozen_encoder:
+        # frozen before the optimizer and the trainer's compute copy (bf16 precision) are built
+        freeze_groups(model, FROZEN_ENCODER_GROUPS, FREEZE_GROUPS)
 
     return model
 
 
+def get_trainer(cfg, model_cfg, dataloaders, model, optimizer, scheduler):
+    if "frozen_encoder" in cfg.model and cfg.model.frozen_encoder:
+        return FrozenEncoderTrainer(cfg, model_cfg, dataloaders, model, optimizer, scheduler)
+    return BasicTrainer(cfg, model_cfg, dataloaders, model, optimizer, scheduler)
+
+
+class FrozenEncoderTrainer(BasicTrainer):
+    """
+    Fine-tunes only the `clf` head of a (pretrained) glassDBN.
+    Embeddings, GRU, attention and predictor are frozen, so the mixing matrices of each subject
+    are computed once per split, stored in a memory-mapped cache in '{run_dir}/feature_cache',
+    and the head is trained from that cache with plain cross-entropy
+    (the sparsity and prediction losses are constant w.r.t. `clf`).
+    The cache holds [subjects, time, C, C] matrices in float16: about 5.5 GB for HCP (833 x 1185 x 53 x 53)
+    """
+
+    def __init__(self, cfg, model_cfg, dataloaders, model, optimizer, scheduler) -> None:
+        if not model_cfg.load_pretrained:
+            print("Warning: frozen_encoder is used without pretrained weights")
+        # the encoder is frozen by get_model
+        assert all(group in getattr(model, "frozen_groups", ()) for group in FROZEN_ENCODER_GROUPS)
+        super().__init__(cfg, model_cfg, dataloaders, model, optimizer, scheduler)
+
+        self.criterion = ce_wrapper
+        self.cache_dir = f"{self.save_path}/feature_cache"
+        self.dataloaders = self.cache_features()
+        for module in (self.model, self.compute_model):
+            module.from_cache = True
+
+    @torch.no_grad()
+    def cache_features(self):
+        """Compute mixing matrices for every split and return dataloaders over the cached features"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.model.eval()
+
+        cached_dataloaders = {}
+        for key, dataloader in self.dataloaders.items():
+            # the split's dataset may be a TensorDataset or an IndexedDataset over shared arrays
+            dataset = dataloader.dataset
+            features, labels = None, []
+            start = 0
+            for data, target in DataLoader(dataset, batch_size=dataloader.batch_size, shuffle=False):
+                mixing_matrices, _ = self.model.encode(data.to(self.device))
+                if features is None:
+                    features = np.lib.format.open_memmap(
+                        f"{self.cache_dir}/{key}.npy", mode="w+", dtype=np.float16,
+                        shape=(len(dataset), *mixing_matrices.shape[1:]),
+                    )
+                features[start : start + data.shape[0]] = mixing_matrices.cpu().numpy()
+                labels.append(target)
+                start += data.shape[0]
+            features.flush()
+
+            cached_dataloaders[key] = DataLoader(
+                TensorDataset(torch.from_numpy(features), torch.cat(labels)),
+                batch_size=dataloader.batch_size,
+                num_workers=0,
+                shuffle=key == "train",
+                collate_fn=collate_float32,
+            )
+
+        return cached_dataloaders
+
+    def run(self):
+        try:
+            return super().run()
+        finally:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+
+def collate_float32(batch):
+    """Collate cached (float16 features, label) samples into a float32 batch"""
+    features, labels = default_collate(batch)
+    return [features.float(), labels]
+
+
 class RegCEloss:
     """Cross-entropy loss with model regularization"""
 
@@ -42,14 +139,14 @@ class RegCEloss:
             DNCs = DNCs.reshape(B*T, C, C)
             sparse_loss = self.sparsity_loss(DNCs)
 
-            pred_loss = F.mse_loss(predicted, originals)
+            pred_loss = F.mse_loss(predicted.float(), originals.float())
 
             loss = ce_loss + self.sp_weight * sparse_loss + self.pred_weight * pred_loss
 
             loss_components = {
-                "ce_loss": ce_loss.item(),
-                "sp_loss": sparse_loss.item(),
-                "pred_loss": pred_loss.item(),
+                "ce_loss": ce_loss.detach(),
+                "sp_loss": sparse_loss.detach(),
+                "pred_loss": pred_loss.detach(),
             }
             return loss, loss_components
         
@@ -58,13 +155,13 @@ class RegCEloss:
             DNCs = DNCs.reshape(B*T, C, C)
             sparse_loss = self.sparsity_loss(DNCs)
 
-            pred_loss = F.mse_loss(predicted, originals)
+            pred_loss = F.mse_loss(predicted.float(), originals.float())
 
             loss =  self.sp_weight * sparse_loss + self.pred_weight * pred_loss
 
             loss_components = {
-                "sp_loss": sparse_loss.item(),
-                "pred_loss": pred_loss.item(),
+                "sp_loss": sparse_loss.detach(),
+                "pred_loss": pred_loss.detach(),
             }
             return loss, loss_components
 
@@ -75,6 +172,7 @@ class InvertedHoyerMeasure:
 
     def __call__(self, x):
         # Assuming x has shape (batch_size, input_dim, input_dim)
+        x = x.float() # the measure is computed in fp32 under reduced precision
 
         n = x[0].numel()
         sqrt_n = torch.sqrt(torch.tensor(float(n), device=x.device))
@@ -185,6 +283,9 @@ class glassDBN(nn.Module):
 
         self.criterion = RegCEloss(model_cfg)
 
+        # if True, forward() expects cached mixing matrices instead of time series
+        self.from_cache = False
+
     def compute_loss(self, additional_outputs, logits, target):
         loss, log = self.criterion(
             logits=logits, 
@@ -208,17 +309,18 @@ class glassDBN(nn.Module):
             plot_combined_matrices(additional_outputs["FNCs"], f"{save_path}/{ds_name}_time_FNCs.png", n_samples=1)
             plot_mean_matrices(additional_outputs["FNCs"], f"{save_path}/{ds_name}_mean_FNCs.png", n_samples=-1)
 
-    def forward(self, x, pretraining=False):
+    def encode(self, x):
+        """Run the recurrent encoder, return mixing matrices and the latent states"""
         B, T, _ = x.shape  # [batch_size, time_length, input_size]
-        orig_x = x
 
         # Apply component-specific embeddings
-        if self.single_embed:
-            x = x.permute(0, 2, 1)
-            x = x.reshape(B * self.input_size, T, 1)
-            embedded = self.embeddings(x).reshape(B, self.input_size, T, self.embedding_dim)
-        else:
-            embedded = torch.stack([self.embeddings[i](x[:, :, i].unsqueeze(-1)) for i in range(self.input_size)], dim=1)
+        with no_grad_if_frozen(self, "embeddings"):
+            if self.single_embed:
+                x = x.permute(0, 2, 1)
+                x = x.reshape(B * self.input_size, T, 1)
+                embedded = self.embeddings(x).reshape(B, self.input_size, T, self.embedding_dim)
+            else:
+                embedded = torch.stack([self.embeddings[i](x[:, :, i].unsqueeze(-1)) for i in range(self.input_size)], dim=1)
         # embedded shape: [batch_size, input_size, time_length, embedding_dim]
         
         # Initialize hidden state and run the recurren loop
@@ -227,38 +329,61 @@ class glassDBN(nn.Module):
 
         mixing_matrices = []
         hidden_states = []
-        for t in range(T):
-            # Process one time step
-            gru_input = embedded[:, :, t, :].unsqueeze(2)  # (batch_size, input_size, 1, embedding_dim)
-            gru_input = gru_input.reshape(B*self.input_size, 1, self.embedding_dim) # (batch_size * input_size, 1, embedding_dim)
-            h = h.permute(1, 0, 2, 3).reshape(1, B*self.input_size, self.hidden_dim) # (1, batch_size * input_size, hidden_dim)
-            _, h = self.gru(gru_input, h)
-            h = h.reshape(1, B, self.input_size, self.hidden_dim).permute(1, 0, 2, 3) # (batch_size, 1, input_size, hidden_dim)
-
-            # Reshape h for self-attention
-            h = h.squeeze(1)  # (batch_size, input_size, hidden_dim)
-            # Apply self-attention
-            h, mixing_matrix = self.attention(h)
-            hidden_states.append(h)
-            mixing_matrices.append(mixing_matrix)
-            h = h.unsqueeze(1) # (batch_size, 1, input_size, hidden_dim)
-
-            if torch.any(torch.isnan(h)):
-                raise Exception(f"h has nans at time point {t}")
+        # the whole recurrence can skip autograd only if all of its parts are frozen
+        with no_grad_if_frozen(self, "embeddings", "gru", "attention"):
+            for t in range(T):
+                # Process one time step
+                gru_input = embedded[:, :, t, :].unsqueeze(2)  # (batch_size, input_size, 1, embedding_dim)
+                gru_input = gru_input.reshape(B*self.input_size, 1, self.embedding_dim) # (batch_size * input_size, 1, embedding_dim)
+                h = h.permute(1, 0, 2, 3).reshape(1, B*self.input_size, self.hidden_dim) # (1, batch_size * input_size, hidden_dim)
+                _, h = self.gru(gru_input, h)
+                h = h.reshape(1, B, self.input_size, self.hidden_dim).permute(1, 0, 2, 3) # (batch_size, 1, input_size, hidden_dim)
+
+                # Reshape h for self-attention
+                h = h.squeeze(1)  # (batch_size, input_size, hidden_dim)
+                # Apply self-attention
+                h, mixing_matrix = self.attention(h)
+                hidden_states.append(h)
+                mixing_matrices.append(mixing_matrix)
+                h = h.unsqueeze(1) # (batch_size, 1, input_size, hidden_dim)
+
+                if not h.is_meta and torch.any(torch.isnan(h)):
+                    raise Exception(f"h has nans at time point {t}")
             
         
-        # Stack the alignment matrices, predict the next input 
+        # Stack the alignment matrices
         mixing_matrices = torch.stack(mixing_matrices, dim=1)  # (batch_size, seq_len, input_size, input_size)
-        hidden_states = torch.stack(hidden_states, dim=1)[:, :-1, :, :] # brain latent states starting with time 0, [batch_size; time_length-1; input_size, hidden_dim]
-        predicted = self.predictor(hidden_states).squeeze() # predictions of x starting with time 1, [batch_size; time_length-1; input_size]
+        hidden_states = torch.stack(hidden_states, dim=1) # brain latent states, [batch_size; time_length; input_size, hidden_dim]
+
+        return mixing_matrices, hidden_states
+
+    def classify(self, mixing_matrices):
+        """Classify the mixing matrices, return mean-over-time logits and per-time-point logits"""
+        B, T = mixing_matrices.shape[:2]
+        clf_input = mixing_matrices.reshape(B, T, -1) # [batch_size; time_length; input_size * input_size]
+        time_logits = self.clf(clf_input) # [batch_size; time_length, n_classes]
+        logits = torch.mean(time_logits, dim=1) # mean over time, [batch_size; n_classes]
+
+        return logits, time_logits
+
+    def forward(self, x, pretraining=False):
+        if self.from_cache:
+            # x is a batch of cached mixing matrices
+            logits, time_logits = self.classify(x)
+            return logits, {"FNCs": x, "time_logits": time_logits}
+
+        orig_x = x
+        mixing_matrices, hidden_states = self.encode(x)
+
+        # predict the next input
+        with no_grad_if_frozen(self, "embeddings", "gru", "attention", "predictor"):
+            predicted = self.predictor(hidden_states[:, :-1, :, :]).squeeze() # predictions of x starting with time 1, [batch_size; time_length-1; input_size]
         
         if pretraining:
             # pretrain on the input prediction task
             return mixing_matrices, predicted, orig_x[:, 1:, :]
         
-        clf_input = mixing_matrices.reshape(B, T, -1) # [batch_size; time_length; input_size * input_size]
-        time_logits = self.clf(clf_input) # [batch_size; time_length, n_classes]
-        logits = torch.mean(time_logits, dim=1) # mean over time, [batch_size; n_classes]
+        logits, time_logits = self.classify(mixing_matrices)
         
         additional_outputs = {
             "FNCs": mixing_matrices,
@@ -299,8 +424,11 @@ class SelfAttention(nn.Module):
         keys = self.key(x)
 
         transfer = torch.bmm(queries, keys.transpose(1, 2))
-        norms = torch.linalg.matrix_norm(transfer, keepdim=True)
-        transfer = transfer / norms
+        # Frobenius-norm normalization is kept in fp32 under reduced precision
+        with autocast_disabled(transfer):
+            transfer_fp32 = transfer.float()
+            norms = torch.linalg.matrix_norm(transfer_fp32, keepdim=True)
+            transfer = (transfer_fp32 / norms).to(transfer.dtype)
 
         gate = self.gate(transfer)
         transfer = transfer * gate
@@ -9,17 +9,29 @@ from torch.nn import functional as F
 
 from omegaconf import OmegaConf, DictConfig
 from src.settings import WEIGHTS_ROOT
+from src.model_utils import autocast_disabled, no_grad_if_frozen
+from src.tracing import span
+
+FREEZE_GROUPS = {
+    "embeddings": ["embeddings"],
+    "gru": ["gru"],
+    "attention": ["attention"],
+    "predictor": ["predictor"],
+    "clf": ["clf"],
+}
+COMPILE_TARGETS = ["attention"]
 
 def get_model(cfg: DictConfig, model_cfg: DictConfig):
     model = glassDBN(model_cfg)
     if model_cfg.load_pretrained == True:
         path = model_cfg.pretrained_path
-        checkpoint = torch.load(
-            path, map_location=lambda storage, loc: storage
-        )
-        dont_load = ["clf"]
-        pruned_checkpoint = {k: v for k, v in checkpoint.items() if not any(key in k for key in dont_load)}
-        model.load_state_dict(pruned_checkpoint, strict=False)
+        with span("load_pretrained"):
+            checkpoint = torch.load(
+                path, map_location=lambda storage, loc: storage
+            )
+            dont_load = ["clf"]
+            pruned_checkpoint = {k: v for k, v in checkpoint.items() if not any(key in k for key in dont_load)}
+            model.load_state_dict(pruned_checkpoint, strict=False)
 
     return model
     
@@ -103,14 +115,14 @@ class RegCEloss:
             DNCs = DNCs.reshape(B*T, C, C)
             sparse_loss = self.sparsity_loss(DNCs)
 
-            pred_loss = F.mse_loss(predicted, originals)
+            pred_loss = F.mse_loss(predicted.float(), originals.float())
 
             loss = ce_loss + self.sp_weight * sparse_loss + self.pred_weight * pred_loss
 
             loss_components = {
-                "ce_loss": ce_loss.item(),
-                "sp_loss": sparse_loss.item(),
-                "pred_loss": pred_loss.item(),
+                "ce_loss": ce_loss.detach(),
+                "sp_loss": sparse_loss.detach(),
+                "pred_loss": pred_loss.detach(),
             }
             return loss, loss_components
         
@@ -119,13 +131,13 @@ class RegCEloss:
             DNCs = DNCs.reshape(B*T, C, C)
             sparse_loss = self.sparsity_loss(DNCs)
 
-            pred_loss = F.mse_loss(predicted, originals)
+            pred_loss = F.mse_loss(predicted.float(), originals.float())
 
             loss = self.sp_weight * sparse_loss + self.pred_weight * pred_loss
 
             loss_components = {
-                "sp_loss": sparse_loss.item(),
-                "pred_loss": pred_loss.item(),
+                "sp_loss": sparse_loss.detach(),
+                "pred_loss": pred_loss.detach(),
             }
             return loss, loss_components
 
@@ -136,6 +148,7 @@ class InvertedHoyerMeasure:
 
     def __call__(self, x):
         # Assuming x has shape (batch_size, input_dim, input_dim)
+        x = x.float() # the measure is computed in fp32 under reduced precision
 
         n = x[0].numel()
         sqrt_n = torch.sqrt(torch.tensor(float(n), device=x.device))
@@ -220,12 +233,13 @@ class glassDBN(nn.Module):
         orig_x = x
 
         # Apply component-specific embeddings
-        if self.single_embed:
-            x = x.permute(0, 2, 1)
-            x = x.reshape(B * self.input_size, T, 1)
-            embedded = self.embeddings(x).reshape(B, self.input_size, T, self.embedding_dim)
-        else:
-            embedded = torch.stack([self.embeddings[i](x[:, :, i].unsqueeze(-1)) for i in range(self.input_size)], dim=1)
+        with no_grad_if_frozen(self, "embeddings"):
+            if self.single_embed:
+                x = x.permute(0, 2, 1)
+                x = x.reshape(B * self.input_size, T, 1)
+                embedded = self.embeddings(x).reshape(B, self.input_size, T, self.embedding_dim)
+            else:
+                embedded = torch.stack([self.embeddings[i](x[:, :, i].unsqueeze(-1)) for i in range(self.input_size)], dim=1)
         # embedded shape: [batch_size, input_size, time_length, embedding_dim]
         
         # Initialize hidden state and run the recurren loop
@@ -234,30 +248,33 @@ class glassDBN(nn.Module):
 
         mixing_matrices = []
         hidden_states = []
-        for t in range(T):
-            # Process one time step
-            gru_input = embedded[:, :, t, :].unsqueeze(2)  # (batch_size, input_size, 1, embedding_dim)
-            gru_input = gru_input.reshape(B*self.input_size, 1, self.embedding_dim) # (batch_size * input_size, 1, embedding_dim)
-            h = h.permute(1, 0, 2, 3).reshape(1, B*self.input_size, self.hidden_dim) # (1, batch_size * input_size, hidden_dim)
-            _, h = self.gru(gru_input, h)
-            h = h.reshape(1, B, self.input_size, self.hidden_dim).permute(1, 0, 2, 3) # (batch_size, 1, input_size, hidden_dim)
-
-            # Reshape h for self-attention
-            h = h.squeeze(1)  # (batch_size, input_size, hidden_dim)
-            # Apply self-attention
-            h, mixing_matrix = self.attention(h)
-            hidden_states.append(h)
-            mixing_matrices.append(mixing_matrix)
-            h = h.unsqueeze(1) # (batch_size, 1, input_size, hidden_dim)
-
-            if torch.any(torch.isnan(h)):
-                raise Exception(f"h has nans at time point {t}")
+        # the whole recurrence can skip autograd only if all of its parts are frozen
+        with no_grad_if_frozen(self, "embeddings", "gru", "attention"):
+            for t in range(T):
+                # Process one time step
+                gru_input = embedded[:, :, t, :].unsqueeze(2)  # (batch_size, input_size, 1, embedding_dim)
+                gru_input = gru_input.reshape(B*self.input_size, 1, self.embedding_dim) # (batch_size * input_size, 1, embedding_dim)
+                h = h.permute(1, 0, 2, 3).reshape(1, B*self.input_size, self.hidden_dim) # (1, batch_size * input_size, hidden_dim)
+                _, h = self.gru(gru_input, h)
+                h = h.reshape(1, B, self.input_size, self.hidden_dim).permute(1, 0, 2, 3) # (batch_size, 1, input_size, hidden_dim)
+
+                # Reshape h for self-attention
+                h = h.squeeze(1)  # (batch_size, input_size, hidden_dim)
+                # Apply self-attention
+                h, mixing_matrix = self.attention(h)
+                hidden_states.append(h)
+                mixing_matrices.append(mixing_matrix)
+                h = h.unsqueeze(1) # (batch_size, 1, input_size, hidden_dim)
+
+                if not h.is_meta and torch.any(torch.isnan(h)):
+                    raise Exception(f"h has nans at time point {t}")
             
         
         # Stack the alignment matrices, predict the next input 
         mixing_matrices = torch.stack(mixing_matrices, dim=1)  # (batch_size, seq_len, input_size, input_size)
         hidden_states = torch.stack(hidden_states, dim=1)[:, :-1, :, :] # brain latent states starting with time 0, [batch_size; time_length-1; input_size, hidden_dim]
-        predicted = self.predictor(hidden_states).squeeze() # predictions of x starting with time 1, [batch_size; time_length-1; input_size]
+        with no_grad_if_frozen(self, "embeddings", "gru", "attention", "predictor"):
+            predicted = self.predictor(hidden_states).squeeze() # predictions of x starting with time 1, [batch_size; time_length-1; input_size]
         
         if pretraining:
             # pretrain on the input prediction task
@@ -311,8 +328,11 @@ class SelfAttention(nn.Module):
         keys = self.key(x)
 
         transfer = torch.bmm(queries, keys.transpose(1, 2))
-        norms = torch.linalg.matrix_norm(transfer, keepdim=True)
-        transfer = transfer / norms
+        # Frobenius-norm normalization is kept in fp32 under reduced precision
+        with autocast_disabled(transfer):
+            transfer_fp32 = transfer.float()
+            norms = torch.linalg.matrix_norm(transfer_fp32, keepdim=True)
+            transfer = (transfer_fp32 / norms).to(transfer.dtype)
 
         gate = self.gate(transfer)
         transfer = transfer * gate
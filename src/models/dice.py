@@ -8,6 +8,15 @@ from torch import optim
 
 from omegaconf import OmegaConf, DictConfig
 
+from src.model_utils import no_grad_if_frozen
+
+FREEZE_GROUPS = {
+    "lstm": ["lstm"],
+    "attention": ["key_layer", "value_layer", "query_layer", "multihead_attn"],
+    "gta": ["gta_embed", "gta_norm", "gta_attend"],
+    "clf": ["clf"],
+}
+
 
 def get_model(cfg: DictConfig, model_cfg: DictConfig):
     return DICE(model_cfg)
@@ -266,7 +275,8 @@ class DICE(nn.Module):
         x = x.permute(0, 2, 1)  # x.shape: [batch_size; input_feature_size; time_length]
         x = x.reshape(B * C, T, 1)  # x.shape: [batch_size * n_channels; time_length; 1]
         ##########################
-        lstm_output, _ = self.lstm(x)
+        with no_grad_if_frozen(self, "lstm"):
+            lstm_output, _ = self.lstm(x)
         # lstm_output.shape: [batch_size * input_feature_size; time_length; lstm_hidden_size]
         ##########################
         lstm_output = lstm_output.reshape(B, C, T, self.lstm_output_size)
@@ -278,7 +288,8 @@ class DICE(nn.Module):
         lstm_output = lstm_output.reshape(T * B, C, self.lstm_output_size)
         # lstm_output.shape: [time_length * batch_size; input_feature_size; lstm_hidden_size]
         ##########################
-        _, attn_weights = self.multi_head_attention(lstm_output)
+        with no_grad_if_frozen(self, "lstm", "attention"):
+            _, attn_weights = self.multi_head_attention(lstm_output)
         # attn_weights.shape: [time_length * batch_size; input_feature_size; input_feature_size]
         ##########################
         attn_weights = attn_weights.reshape(T, B, C, C)
@@ -292,7 +303,8 @@ class DICE(nn.Module):
         attn_weights = attn_weights.reshape(B, T, -1)
         # attn_weights.shape: [batch_size; time_length; input_feature_size * input_feature_size]
         ##########################
-        FC = self.gta_attention(attn_weights)
+        with no_grad_if_frozen(self, "lstm", "attention", "gta"):
+            FC = self.gta_attention(attn_weights)
         # FC.shape: [batch_size; input_feature_size * input_feature_size]
         ##########################
 
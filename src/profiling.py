@@ -0,0 +1,333 @@
+# pylint: disable=no-member, invalid-name
+"""Training hot-path profiling: per-phase timers, per-module timers and torch.profiler traces"""
+from contextlib import contextmanager
+import time
+
+import pandas as pd
+import torch
+
+PHASES = ["fetch", "h2d", "forward", "criterion", "backward", "step", "metrics"]
+
+
+class PhaseTimer:
+    """
+    Accumulate wall time of the training step phases over an epoch.
+    CUDA is synchronized at the phase boundaries, so that asynchronous kernels are attributed
+    to the phase that launched them (this slows the training down a bit, so it is opt-in).
+    A disabled timer is a no-op.
+
+    Usage:
+        timer = PhaseTimer(device, enabled=True)
+        for data, target in timer.iterate(dataloader):
+            with timer.phase("forward"):
+                ...
+        timer.results("train")  # {"train_forward_time": seconds, ...}
+    """
+
+    def __init__(self, device=None, enabled=False):
+        self.device = device
+        self.enabled = enabled
+        self.times = dict.fromkeys(PHASES, 0.0)
+
+    def synchronize(self):
+        """Wait for the device to finish the queued work"""
+        if self.device is not None and self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    @contextmanager
+    def phase(self, name):
+        """Time the block as phase `name`; it is also labeled in torch.profiler traces"""
+        if not self.enabled:
+            yield
+            return
+        with torch.profiler.record_function(name):
+            self.synchronize()
+            start_time = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.synchronize()
+                self.times[name] = self.times.get(name, 0.0) + time.perf_counter() - start_time
+
+    def iterate(self, iterable, name="fetch"):
+        """Iterate over `iterable` (e.g. a dataloader), timing each fetch as phase `name`"""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def results(self, prefix):
+        """Return the accumulated phase times in seconds as {prefix}_{phase}_time"""
+        if not self.enabled:
+            return {}
+        return {f"{prefix}_{name}_time": value for name, value in self.times.items()}
+
+
+def trace_profiler(path, n_steps, wait=1, warmup=1):
+    """
+    Return torch.profiler.profile, which records n_steps training steps (after `wait` skipped
+    and `warmup` steps) and exports a Chrome trace (chrome://tracing, Perfetto) to path.
+    The caller must call .start(), .step() after each training step, and .stop()
+    """
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    def export(profiler):
+        profiler.export_chrome_trace(path)
+        print(f"Profiler trace is saved to {path}")
+
+    return torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=n_steps, repeat=1),
+        on_trace_ready=export,
+        record_shapes=True,
+        profile_memory=True,
+        with_stack=False,
+    )
+
+
+class ModuleTimer:
+    """
+    Forward and backward timing hooks on named submodules of any model.
+    Collects time, call counts and output sizes per module. On CUDA the times are measured
+    with CUDA events, which are resolved in bulk, so the hooks don't synchronize the device.
+
+    `modules` selects the submodules: a list of (dotted) names, or an int depth
+    (1 - direct children of the model, 2 - also their children, ...).
+    Backward hooks wrap the module outputs, which fails for outputs modified in-place later;
+    backward=False times only the forward pass.
+
+    Usage:
+        module_timer = ModuleTimer(model, modules=1)
+        ...  # training
+        module_timer.remove()
+        module_timer.summary().to_csv("module_profile.csv")
+    """
+
+    max_pending = 10000  # CUDA event pairs kept before resolving them
+
+    def __init__(self, model, modules=1, backward=True):
+        # hooks go on the original modules of compiled models
+        model = getattr(model, "_orig_mod", model)
+        if isinstance(modules, int):
+            names = [name for name, _ in model.named_modules() if name and name.count(".") < modules]
+        else:
+            names = list(modules)
+
+        self.stats = {
+            name: {"forward_calls": 0, "forward_time": 0.0, "backward_calls": 0, "backward_time": 0.0,
+                   "output_bytes": 0, "output_shape": None}
+            for name in names
+        }
+        self.params = {name: sum(p.numel() for p in model.get_submodule(name).parameters()) for name in names}
+        self._starts = {}  # (name, pass) -> stack of start times/events, modules may be re-entered
+        self._pending = []  # (name, pass, start event, end event)
+        self._handles = []
+        self.cuda = any(p.is_cuda for p in model.parameters())
+
+        for name in names:
+            module = model.get_submodule(name)
+            self._handles += [
+                module.register_forward_pre_hook(self._start_hook(name, "forward")),
+                module.register_forward_hook(self._forward_hook(name)),
+            ]
+            if backward:
+                self._handles += [
+                    module.register_full_backward_pre_hook(self._start_hook(name, "backward")),
+                    module.register_full_backward_hook(self._end_hook(name, "backward")),
+                ]
+
+    def _now(self):
+        """CUDA event recorded on the current stream, or the wall time on CPU"""
+        if self.cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def _start(self, name, pass_name):
+        self._starts.setdefault((name, pass_name), []).append(self._now())
+
+    def _end(self, name, pass_name):
+        starts = self._starts.get((name, pass_name))
+        if not starts:
+            return
+        start = starts.pop()
+        end = self._now()
+        stats = self.stats[name]
+        stats[f"{pass_name}_calls"] += 1
+        if isinstance(start, float):
+            stats[f"{pass_name}_time"] += end - start
+        else:
+            self._pending.append((name, pass_name, start, end))
+            if len(self._pending) >= self.max_pending:
+                self.resolve()
+
+    def _start_hook(self, name, pass_name):
+        def hook(*_):
+            self._start(name, pass_name)
+
+        return hook
+
+    def _end_hook(self, name, pass_name):
+        def hook(*_):
+            self._end(name, pass_name)
+
+        return hook
+
+    def _forward_hook(self, name):
+        def hook(_, __, output):
+            self._end(name, "forward")
+            tensors = _tensors(output)
+            self.stats[name]["output_bytes"] += sum(t.numel() * t.element_size() for t in tensors)
+            if tensors:
+                self.stats[name]["output_shape"] = tuple(tensors[0].shape)
+
+        return hook
+
+    def resolve(self):
+        """Wait for the recorded CUDA events and accumulate their times"""
+        if not self._pending:
+            return
+        torch.cuda.synchronize()
+        for name, pass_name, start, end in self._pending:
+            self.stats[name][f"{pass_name}_time"] += start.elapsed_time(end) / 1000
+        self._pending = []
+
+    def remove(self):
+        """Remove the hooks"""
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def summary(self):
+        """Return per-module table: times (s), calls, ms per call, share of the model time, mean output size"""
+        self.resolve()
+        rows = []
+        for name, stats in self.stats.items():
+            forward_calls, backward_calls = stats["forward_calls"], stats["backward_calls"]
+            rows.append({
+                "module": name,
+                "params": self.params[name],
+                "forward_calls": forward_calls,
+                "forward_time": stats["forward_time"],
+                "forward_ms_per_call": 1000 * stats["forward_time"] / max(forward_calls, 1),
+                "backward_calls": backward_calls,
+                "backward_time": stats["backward_time"],
+                "backward_ms_per_call": 1000 * stats["backward_time"] / max(backward_calls, 1),
+                "output_mb_per_call": stats["output_bytes"] / max(forward_calls, 1) / 2**20,
+                "output_shape": stats["output_shape"],
+            })
+        df = pd.DataFrame(rows)
+        # share of the total time of the top-level selected modules (nested modules are counted in their parents)
+        top_level = ~df["module"].apply(
+            lambda name: any(name.startswith(f"{other}.") for other in self.stats)
+        )
+        total_time = (df["forward_time"] + df["backward_time"])[top_level].sum()
+        df["time_share"] = (df["forward_time"] + df["backward_time"]) / total_time if total_time > 0 else 0.0
+        return df
+
+
+def _tensors(outputs):
+    """Flat list of tensors in (nested) module inputs/outputs"""
+    if torch.is_tensor(outputs):
+        return [outputs]
+    if isinstance(outputs, dict):
+        outputs = list(outputs.values())
+    if isinstance(outputs, (list, tuple)):
+        return [t for output in outputs for t in _tensors(output)]
+    return []
+
+
+class SavedTensorCounter:
+    """
+    Counts bytes of the tensors saved for backward while active (parameters and their views excluded).
+    Unlike ActivationMeter it doesn't rely on storage pointers, so it also works with meta tensors;
+    a tensor saved by several operations is counted once
+    """
+
+    def __init__(self, model):
+        self.param_ids = {id(param) for param in model.parameters()}
+        self.bytes = 0
+        self._seen = set()
+        self._hooks = None
+
+    def pack(self, tensor):
+        """saved_tensors_hooks pack hook"""
+        base = tensor._base if tensor._base is not None else tensor  # pylint: disable=protected-access
+        if id(base) not in self.param_ids and id(tensor) not in self._seen:
+            self._seen.add(id(tensor))
+            self.bytes += tensor.numel() * tensor.element_size()
+        return tensor
+
+    @staticmethod
+    def unpack(tensor):
+        """saved_tensors_hooks unpack hook"""
+        return tensor
+
+    def __enter__(self):
+        self._hooks = torch.autograd.graph.saved_tensors_hooks(self.pack, self.unpack)
+        self._hooks.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self._hooks.__exit__(*args)
+        self._hooks = None
+
+
+def trace_step(model, input_shapes, batch_size):
+    """
+    Run one forward/backward pass of a (meta) model on meta inputs [batch_size, *shape] for each input shape.
+    Returns saved activation bytes, forward and backward FLOPs
+    """
+    from torch.utils.flop_counter import FlopCounterMode  # pylint: disable=import-outside-toplevel
+
+    inputs = [torch.empty(batch_size, *shape, device="meta") for shape in input_shapes]
+    counter = SavedTensorCounter(model)
+    model.train()
+    with FlopCounterMode(display=False) as forward_flops, counter:
+        output = model(*inputs)
+    logits = output[0] if isinstance(output, (tuple, list)) else output
+    with FlopCounterMode(display=False) as backward_flops:
+        logits.float().sum().backward()
+    model.zero_grad(set_to_none=True)
+
+    return {
+        "activation_bytes": counter.bytes,
+        "forward_flops": forward_flops.get_total_flops(),
+        "backward_flops": backward_flops.get_total_flops(),
+    }
+
+
+def static_profile(get_model, input_shapes):
+    """
+    Profile a model without allocating real memory: get_model() is called on the meta device,
+    and one forward/backward pass is traced on meta inputs of batch sizes 1 and 2.
+    Per-sample costs are the difference between the two, batch-independent costs are reported as fixed.
+    Returns parameter counts and bytes, activation bytes and FLOPs (forward, backward) per sample,
+    or None if get_model() doesn't return a torch module (e.g. sklearn models)
+    """
+    with torch.device("meta"):
+        model = get_model()
+    if not isinstance(model, torch.nn.Module):
+        return None
+    params = list(model.parameters())
+    profile = {
+        "params": sum(param.numel() for param in params),
+        "trainable_params": sum(param.numel() for param in params if param.requires_grad),
+        "param_mb": sum(param.numel() * param.element_size() for param in params) / 2**20,
+    }
+
+    single, double = trace_step(model, input_shapes, 1), trace_step(model, input_shapes, 2)
+    for key in single:
+        per_sample = double[key] - single[key]
+        profile[f"{key}_per_sample"] = per_sample
+        profile[f"{key}_fixed"] = single[key] - per_sample
+    profile["activation_mb_per_sample"] = profile.pop("activation_bytes_per_sample") / 2**20
+    profile["activation_mb_fixed"] = profile.pop("activation_bytes_fixed") / 2**20
+    return profile
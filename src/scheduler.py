@@ -0,0 +1,145 @@
+# pylint: disable=invalid-name, too-many-arguments
+"""Local scheduler for running independent runs in parallel worker processes"""
+from multiprocessing import get_context
+from multiprocessing.connection import wait
+import os
+import traceback
+
+import torch
+
+from omegaconf import DictConfig
+
+
+class RunError(Exception):
+    """A run failed or its worker process crashed"""
+
+
+class LocalScheduler:
+    """
+    Run independent runs in a pool of worker processes.
+    Each run gets its own spawned process, so a crash (including segfaults and OOM kills)
+    only fails that run. With n_workers=1 runs are executed sequentially in the current process;
+    their exceptions are also yielded as RunError, except for the `propagate` exception types.
+    By default no new runs are started after the first failure (the running ones are finished),
+    with continue_on_error=True all runs are executed regardless of failures.
+
+    Usage:
+        scheduler = LocalScheduler.from_cfg(cfg)
+        for i, result in scheduler.run(fn, tasks):
+            # results come in completion order, failed runs yield RunError instances
+    """
+
+    def __init__(self, n_workers=1, threads_per_worker=None, pin_workers=False, continue_on_error=False):
+        self.n_workers = max(int(n_workers), 1)
+        self.continue_on_error = continue_on_error
+
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+        if threads_per_worker is None:
+            threads_per_worker = max(len(cpus) // self.n_workers, 1)
+        self.threads_per_worker = threads_per_worker
+
+        # disjoint core sets for each worker slot; the cores are reused cyclically
+        # if n_workers * threads_per_worker exceeds the available cores
+        if pin_workers and hasattr(os, "sched_setaffinity"):
+            if self.n_workers * threads_per_worker > len(cpus):
+                print(
+                    f"Warning: {self.n_workers} workers x {threads_per_worker} threads oversubscribe "
+                    f"{len(cpus)} cores, pinned core sets overlap"
+                )
+            self.slot_cpus = [
+                sorted({cpus[(i * threads_per_worker + j) % len(cpus)] for j in range(threads_per_worker)})
+                for i in range(self.n_workers)
+            ]
+        else:
+            self.slot_cpus = [None] * self.n_workers
+
+    @classmethod
+    def from_cfg(cls, cfg: DictConfig):
+        """Create scheduler from the top-level n_workers, threads_per_worker, pin_workers, and continue_on_error options"""
+        return cls(
+            n_workers=cfg.n_workers if "n_workers" in cfg and cfg.n_workers else 1,
+            threads_per_worker=cfg.threads_per_worker if "threads_per_worker" in cfg else None,
+            pin_workers="pin_workers" in cfg and cfg.pin_workers,
+            continue_on_error="continue_on_error" in cfg and cfg.continue_on_error,
+        )
+
+    def run(self, fn, tasks, propagate=()):
+        """
+        Run fn(*task) for each task in tasks, yield (task index, result) in completion order.
+        fn must be a picklable (module-level) function. Unless continue_on_error is set,
+        the tasks not started before the first failure are skipped (nothing is yielded for them).
+        With n_workers=1, exceptions of the `propagate` types (e.g. optuna.TrialPruned raised
+        by epoch callbacks) are raised to the caller instead of being yielded as RunError
+        """
+        tasks = list(tasks)
+        if self.n_workers == 1:
+            for i, task in enumerate(tasks):
+                try:
+                    result = fn(*task)
+                except propagate:
+                    raise
+                except Exception:  # pylint: disable=broad-except
+                    result = RunError(f"Task {i} failed: {traceback.format_exc()}")
+                yield i, result
+                if isinstance(result, RunError) and not self.continue_on_error:
+                    return
+            return
+
+        ctx = get_context("spawn")
+        pending = list(enumerate(tasks))
+        free_slots = list(range(self.n_workers))
+        running = {}  # connection -> (task index, process, slot)
+
+        try:
+            while pending or running:
+                # launch new runs while there are free slots
+                while pending and free_slots:
+                    i, task = pending.pop(0)
+                    slot = free_slots.pop(0)
+                    receiver, sender = ctx.Pipe(duplex=False)
+                    process = ctx.Process(
+                        target=_worker,
+                        args=(fn, task, sender, self.threads_per_worker, self.slot_cpus[slot]),
+                        daemon=False,
+                    )
+                    process.start()
+                    sender.close()
+                    running[receiver] = (i, process, slot)
+
+                for receiver in wait(list(running)):
+                    i, process, slot = running.pop(receiver)
+                    try:
+                        status, result = receiver.recv()
+                    except EOFError:
+                        # the worker died without sending anything back
+                        process.join()
+                        status, result = "error", f"worker crashed with exit code {process.exitcode}"
+                    receiver.close()
+                    process.join()
+                    free_slots.append(slot)
+
+                    if status == "error":
+                        result = RunError(f"Task {i} failed: {result}")
+                        if not self.continue_on_error:
+                            pending = []
+                    yield i, result
+        finally:
+            # don't leave orphaned workers behind if the caller is interrupted
+            for receiver, (_, process, _) in running.items():
+                process.terminate()
+                process.join()
+                receiver.close()
+
+
+def _worker(fn, task, connection, n_threads, cpus):
+    """Entry point of a worker process"""
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(n_threads)
+
+    try:
+        result = ("ok", fn(*task))
+    except BaseException:  # pylint: disable=broad-except
+        result = ("error", traceback.format_exc())
+    connection.send(result)
+    connection.close()
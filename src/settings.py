@@ -9,6 +9,14 @@ PROJECT_ROOT = path.Path(os.path.dirname(__file__)).joinpath("..").abspath()
 ASSETS_ROOT = PROJECT_ROOT.joinpath("assets")
 WEIGHTS_ROOT = ASSETS_ROOT.joinpath("model_weights")
 LOGS_ROOT = ASSETS_ROOT.joinpath("logs")
+COMPILE_CACHE_ROOT = ASSETS_ROOT.joinpath("compile_cache")
+AUTOTUNE_CACHE_ROOT = ASSETS_ROOT.joinpath("autotune_cache")
+BENCHMARKS_ROOT = ASSETS_ROOT.joinpath("benchmarks")
+# shared datasets for parallel workers, RAM-backed if possible
+if os.path.isdir("/dev/shm"):
+    SHARED_DATA_ROOT = path.Path("/dev/shm").joinpath("dbnglass_shared_data")
+else:
+    SHARED_DATA_ROOT = ASSETS_ROOT.joinpath("shared_data")
 
 UTCNOW = datetime.utcnow().strftime("%y%m%d.%H%M%S")
 
@@ -17,3 +25,4 @@ if "arctrd" in node:
     DATA_ROOT = path.Path("/data/users2/ppopov1/datasets")
 else:
     DATA_ROOT = ASSETS_ROOT.joinpath("data")
+
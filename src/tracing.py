@@ -0,0 +1,140 @@
+# pylint: disable=invalid-name
+"""
+Lightweight experiment-level span tracer.
+Spans are appended as Chrome trace events to per-process JSONL files,
+which are merged into {project_dir}/trace.json (chrome://tracing, Perfetto)
+and summarized by stage in {project_dir}/trace_summary.csv
+"""
+from contextlib import contextmanager
+from functools import wraps
+import glob
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+
+from omegaconf import DictConfig
+
+# the trace directory is passed through the environment, so that spawned worker processes trace too
+TRACE_DIR_ENV = "DBNGLASS_TRACE_DIR"
+
+
+def configure_tracing(cfg: DictConfig):
+    """Enable tracing into {cfg.project_dir}/trace if cfg.trace is True"""
+    if "trace" in cfg and cfg.trace:
+        trace_dir = f"{cfg.project_dir}/trace"
+        os.makedirs(trace_dir, exist_ok=True)
+        os.environ[TRACE_DIR_ENV] = trace_dir
+    else:
+        os.environ.pop(TRACE_DIR_ENV, None)
+
+
+def tracing_enabled():
+    """Whether spans are recorded"""
+    return TRACE_DIR_ENV in os.environ
+
+
+@contextmanager
+def span(name, **args):
+    """Record the block as a span `name` with optional args (shown in the trace viewer)"""
+    trace_dir = os.environ.get(TRACE_DIR_ENV)
+    if trace_dir is None:
+        yield
+        return
+
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": start_time * 1e6,
+            "dur": (time.time() - start_time) * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": {key: str(value) for key, value in args.items()},
+        }
+        with open(f"{trace_dir}/{os.getpid()}.jsonl", "a", encoding="utf8") as f:
+            f.write(json.dumps(event) + "\n")
+
+
+def traced(name=None):
+    """Decorator recording each call of the function as a span (named after the function by default)"""
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name or fn.__name__):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def merge_traces(project_dir):
+    """
+    Merge the per-process span files of the project into {project_dir}/trace.json,
+    and save the time by stage into {project_dir}/trace_summary.csv.
+    Returns the summary DataFrame, or None if nothing was traced
+    """
+    events = []
+    for path in sorted(glob.glob(f"{project_dir}/trace/*.jsonl")):
+        with open(path, "r", encoding="utf8") as f:
+            # the last line may be incomplete if the process was killed
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except json.JSONDecodeError:
+                    pass
+    if len(events) == 0:
+        return None
+
+    with open(f"{project_dir}/trace.json", "w", encoding="utf8") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    summary = trace_summary(events)
+    summary.to_csv(f"{project_dir}/trace_summary.csv", index=False)
+    return summary
+
+
+def trace_summary(events):
+    """
+    Return time by stage: number of spans, total and self time (excluding nested spans) in seconds,
+    and the share of the self time in the total traced time
+    """
+    self_time = {}
+    total_time = {}
+    counts = {}
+
+    threads = {}
+    for event in events:
+        threads.setdefault((event["pid"], event["tid"]), []).append(event)
+    for thread_events in threads.values():
+        # parents come before their children: sort by start, longer spans first
+        thread_events.sort(key=lambda event: (event["ts"], -event["dur"]))
+        stack = []
+        for event in thread_events:
+            while stack and stack[-1]["ts"] + stack[-1]["dur"] <= event["ts"]:
+                stack.pop()
+            if stack:
+                self_time[stack[-1]["name"]] -= event["dur"]
+            name = event["name"]
+            counts[name] = counts.get(name, 0) + 1
+            total_time[name] = total_time.get(name, 0.0) + event["dur"]
+            self_time[name] = self_time.get(name, 0.0) + event["dur"]
+            stack.append(event)
+
+    df = pd.DataFrame(
+        {
+            "stage": list(counts),
+            "count": list(counts.values()),
+            "total_time": [total_time[name] / 1e6 for name in counts],
+            "self_time": [self_time[name] / 1e6 for name in counts],
+        }
+    )
+    df["self_time_share"] = df["self_time"] / df["self_time"].sum()
+    return df.sort_values("self_time", ascending=False)
@@ -1,15 +1,19 @@
 # pylint: disable=no-member, too-many-locals, too-many-arguments, too-many-instance-attributes, invalid-name, attribute-defined-outside-init, no-name-in-module
 """Training scripts"""
 from importlib import import_module
+from copy import deepcopy
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 import gc
 import os
 import time
 import warnings
 from pprint import pprint
 import math
+import random
+import threading
 
 import torch
-from torch.utils.data import DataLoader
 from torch import nn, randperm as rp
 from torch.nn import functional as F
 import numpy as np
@@ -20,6 +24,12 @@ from apto.utils.report import get_classification_report
 
 from omegaconf import OmegaConf, open_dict
 
+from src.memory import ActivationMeter, available_memory, is_oom_error, log_memory, memory_snapshot
+from src.metrics import classification_metrics
+from src.model_utils import copy_model
+from src.profiling import ModuleTimer, PhaseTimer, trace_profiler
+from src.tracing import span
+
 warnings.filterwarnings("ignore")
 
 
@@ -68,6 +78,13 @@ def trainer_factory(
 def ce_wrapper(additional_outputs, logits, target):
     return F.cross_entropy(logits, target), {}
 
+
+# precision policies supported by BasicTrainer (cfg.model.precision):
+#   fp32 - default full precision training
+#   bf16-autocast - forward pass under bfloat16 autocast, fp32 weights
+#   bf16 - bfloat16 weights and activations, fp32 master weights are updated by the optimizer
+PRECISIONS = ["fp32", "bf16-autocast", "bf16"]
+
 class BasicTrainer:
     """Basic training script"""
 
@@ -99,13 +116,34 @@ class BasicTrainer:
 
         params = self.count_params(self.model)
 
+        # per-phase timers of the training step (opt-in, synchronizes CUDA at the phase boundaries),
+        # and torch.profiler Chrome trace of profile_steps training steps
+        self.profile_phases = "profile_phases" in self.cfg.mode and self.cfg.mode.profile_phases
+        self.profile_steps = self.cfg.mode.profile_steps if "profile_steps" in self.cfg.mode else 0
+        self.phase_timer = PhaseTimer(enabled=False)
+        self.profiler = None
+
         self.epochs = self.cfg.mode.max_epochs
+        # validation cadence: every valid_every epochs, every epoch near the early stopping (valid_adaptive),
+        # and asynchronous validation overlapped with the next training epoch (async_valid)
+        self.valid_every = self.cfg.mode.valid_every if "valid_every" in self.cfg.mode else 1
+        self.valid_adaptive = "valid_adaptive" in self.cfg.mode and self.cfg.mode.valid_adaptive
+        self.async_valid = "async_valid" in self.cfg.mode and self.cfg.mode.async_valid
+        # resumable training state, saved at most every train_state_every seconds
+        self.train_state_every = self.cfg.mode.train_state_every if "train_state_every" in self.cfg.mode else None
+        self.train_state_path = f"{self.cfg.run_dir}/train_state.pt"
+        # epoch whose asynchronous validation was running when the restored training state was saved
+        self.resume_valid_epoch = None
+        # functions called with (epoch, epoch results) after each epoch, e.g. for optuna pruning
+        self.epoch_callbacks = []
         self.save_path = self.cfg.run_dir
 
         self.early_stopping = EarlyStopping(
             path=self.save_path,
             minimize=True,
             patience=self.cfg.mode.patience,
+            # the best model is kept in memory, and written to disk only if it should be preserved
+            persist=self.cfg.mode.preserve_checkpoints,
         )
 
         # set device
@@ -120,6 +158,29 @@ class BasicTrainer:
 
         self.model = model.to(self.device)
 
+        # micro-batch size for gradient accumulation, None means whole batches
+        self.micro_batch_size = None
+
+        # set precision policy
+        if "precision" in cfg.model and cfg.model.precision is not None:
+            self.precision = cfg.model.precision
+        else:
+            self.precision = "fp32"
+        assert self.precision in PRECISIONS, f"Unknown precision '{self.precision}', use one of {PRECISIONS}"
+        if self.precision == "bf16":
+            # self.model keeps fp32 master weights (the optimizer is built on them),
+            # forward and backward passes run on the bfloat16 copy
+            self.compute_model = copy_model(self.model).to(torch.bfloat16)
+        else:
+            self.compute_model = self.model
+
+        # measure activation memory retained for backward (opt-in, adds a hook call per saved tensor);
+        # the forward pass runs on the compute model, so its parameters are excluded
+        if "log_memory" in cfg.mode and cfg.mode.log_memory:
+            self.activation_meter = ActivationMeter(self.compute_model)
+        else:
+            self.activation_meter = None
+
         # save configs in the run's directory
         with open_dict(self.cfg):
             self.cfg.device = dev
@@ -139,36 +200,43 @@ class BasicTrainer:
             total_params = sum(p.numel() for p in model.parameters())
         return total_params
 
-    def run_epoch(self, ds_name):
-        """Run single epoch and monitor OutOfMemoryError"""
+    def run_epoch(self, ds_name, model=None):
+        """
+        Run single epoch and monitor out of memory errors.
+        On OOM the batches are split into smaller micro-batches with gradient accumulation,
+        so the effective batch size and the optimization stay the same
+        """
+        metrics, micro_batch_size = self.run_epoch_safely(ds_name, model, self.micro_batch_size)
+        if micro_batch_size != self.micro_batch_size:
+            self.set_micro_batch_size(micro_batch_size, reason="OOM")
+
+        return metrics
+
+    def run_epoch_safely(self, ds_name, model, micro_batch_size):
+        """
+        OOM-retrying part of run_epoch, which doesn't change the trainer's micro-batch size,
+        so that it can run on the validation thread. Returns the metrics and the micro-batch size that fit
+        """
         impatience = 0
         while True:
             try:
-                metrics = self.run_epoch_for_real(ds_name)
-            except torch.cuda.OutOfMemoryError as e:
-                if impatience > 5:
-                    raise torch.cuda.OutOfMemoryError(
-                        "Can't fix CUDA out of memory exception"
-                    ) from e
+                metrics = self.run_epoch_for_real(ds_name, model, micro_batch_size)
+            except (torch.cuda.OutOfMemoryError, MemoryError, RuntimeError) as e:
+                if not is_oom_error(e):
+                    raise
+                if impatience > 5 or micro_batch_size == 1:
+                    raise MemoryError("Can't fix out of memory exception") from e
 
                 impatience += 1
-                print("CUDA OOM encountered, reducing batch_size and cleaning memory")
+                print("OOM encountered, reducing micro-batch size and cleaning memory")
 
                 # run garbage collector and empty cache
                 gc.collect()
-                torch.cuda.empty_cache()
-
-                # reduce batch_size
-                with open_dict(self.cfg):
-                    self.cfg.mode.batch_size //= 2
-                for key in self.dataloaders:
-                    dataset = self.dataloaders[key].dataset
-                    self.dataloaders[key] = DataLoader(
-                        dataset,
-                        batch_size=self.cfg.mode.batch_size,
-                        num_workers=0,
-                        shuffle=key == "train",
-                    )
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+
+                # reduce micro_batch_size
+                micro_batch_size = max((micro_batch_size or self.dataloaders[ds_name].batch_size) // 2, 1)
 
                 # try to run the epoch again
                 continue
@@ -176,121 +244,477 @@ class BasicTrainer:
             # no errors encountered, exiting loop
             break
 
-        return metrics
+        return metrics, micro_batch_size
 
-    def run_epoch_for_real(self, ds_name):
-        """Run single epoch on `ds_name` dataloder"""
+    def probe_micro_batch_size(self):
+        """
+        Pick the micro-batch size up front:
+        measure memory used by forward/backward pass on a couple of samples from the first training batch,
+        and fit as many samples into the available memory as possible
+        """
+        data, target = next(iter(self.dataloaders["train"]))
+        batch_size = self.dataloaders["train"].batch_size
+        probe_size = min(2, data.shape[0])
+        data, target = data[:probe_size].to(self.device), target[:probe_size].to(self.device)
+        if self.precision == "bf16":
+            data = data.to(torch.bfloat16)
+
+        # probe an eager copy, so that the model's state (e.g. BatchNorm stats) is untouched
+        model = copy_model(self.compute_model, recompile=False)
+        model.train()
+        meter = ActivationMeter(model)
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+            base_memory = torch.cuda.memory_allocated(self.device)
+        with torch.autocast(
+            device_type=self.device.type,
+            dtype=torch.bfloat16,
+            enabled=self.precision == "bf16-autocast",
+        ):
+            with meter:
+                logits, additional_outputs = model(data)
+        loss, _ = self.criterion(logits=logits.float(), target=target, additional_outputs=additional_outputs)
+        loss.backward()
+        if self.device.type == "cuda":
+            used_memory = torch.cuda.max_memory_allocated(self.device) - base_memory
+        else:
+            used_memory = meter.peak
+        del model, logits, additional_outputs, loss
+
+        sample_memory = max(used_memory / probe_size, 1)
+        fraction = self.cfg.mode.memory_fraction if "memory_fraction" in self.cfg.mode else 0.8
+        if "memory_budget_gb" in self.cfg.mode and self.cfg.mode.memory_budget_gb:
+            memory = self.cfg.mode.memory_budget_gb * 2**30
+        else:
+            memory = available_memory(self.device)
+        if memory is None:
+            print("Can't estimate available memory, micro-batching is not used")
+            return
+        micro_batch_size = int(min(max(memory * fraction // sample_memory, 1), batch_size))
+
+        self.set_micro_batch_size(
+            micro_batch_size,
+            reason="memory probe",
+            sample_memory_mb=sample_memory / 2**20,
+            available_memory_mb=memory / 2**20,
+        )
+
+    def set_micro_batch_size(self, micro_batch_size, reason, **probe_info):
+        """Set micro-batch size and record the chosen split in the run config"""
+        batch_size = self.dataloaders["train"].batch_size
+        self.micro_batch_size = micro_batch_size
+        accumulation_steps = math.ceil(batch_size / micro_batch_size)
+        print(
+            f"Micro-batching ({reason}): batch_size {batch_size} is split into "
+            f"{accumulation_steps} accumulation steps of <= {micro_batch_size} samples"
+        )
+
+        with open_dict(self.cfg):
+            self.cfg.micro_batching = {
+                "micro_batch_size": micro_batch_size,
+                "accumulation_steps": accumulation_steps,
+                "reason": reason,
+                **probe_info,
+            }
+        with open(f"{self.save_path}/config.yaml", "w", encoding="utf8") as f:
+            OmegaConf.save(self.cfg, f)
+
+    def run_epoch_for_real(self, ds_name, model=None, micro_batch_size=None):
+        """
+        Run single epoch on `ds_name` dataloder, split the batches into micro-batches of micro_batch_size (None - whole batches).
+        The compute model is used by default, another model (e.g., a weight snapshot) can be provided for evaluation
+        """
         is_train_dataset = ds_name == "train"
+        if model is None:
+            model = self.compute_model
 
+        # metrics are accumulated on the device, and synced with the host once per epoch
         all_scores, all_targets = [], []
-        total_loss = 0.0
-        loss_components = {} 
-
-        self.model.train(is_train_dataset)
+        total_loss = torch.zeros((), device=self.device)
+        loss_components = {}
+
+        model.train(is_train_dataset)
+        # frozen modules are not trained, so they always run in eval mode
+        for module_name in getattr(model, "frozen_modules", ()):
+            getattr(model, module_name).eval()
+        # the meter measures training only, validation may run concurrently on another thread
+        if self.activation_meter is not None and is_train_dataset:
+            self.activation_meter.reset_peak()
+        # the timer is local, as validation may run concurrently on another thread; do_update uses it in training
+        timer = PhaseTimer(self.device, enabled=self.profile_phases)
+        if is_train_dataset:
+            self.phase_timer = timer
         start_time = time.time()
 
         n_samples = len(self.dataloaders[ds_name].dataset)
         n_batches = math.ceil(n_samples / self.dataloaders[ds_name].batch_size)
         with torch.set_grad_enabled(is_train_dataset):
-            for data, target in self.dataloaders[ds_name]:
+            for data, target in timer.iterate(self.dataloaders[ds_name], "fetch"):
                 # permute TS data if needed
                 if is_train_dataset and self.permute:
                     for i, sample in enumerate(data):
                         data[i] = sample[rp(sample.shape[0]), :]
 
-                data, target = data.to(self.device), target.to(self.device)
-
-                logits, additional_outputs = self.model(data)
-                loss, loss_logs = self.criterion(
-                    logits=logits,
-                    target=target,
-                    additional_outputs=additional_outputs
-                )
-                
-                for key, value in loss_logs.items():
-                    loss_components[key] = loss_components.get(key, 0.0) + value
-                score = torch.softmax(logits, dim=-1)
-
-                all_scores.append(score.cpu().detach().numpy())
-                all_targets.append(target.cpu().detach().numpy())
-                total_loss += loss.item()
-
-                if is_train_dataset:
-                    self.do_update(loss)
-                elif ds_name not in ["train", "valid"]:
-                    try:
-                        self.model.save_data(self.cfg, ds_name, data, target, additional_outputs)
-                    except:
-                        pass
-
-        average_time = (time.time() - start_time) / n_samples
-        average_loss = total_loss / n_batches
-        loss_components = {key: value / n_batches for key, value in loss_components.items()}
-
-
-        y_test = np.hstack(all_targets)
-        y_score = np.vstack(all_scores)
-        y_pred = np.argmax(y_score, axis=-1).astype(np.int32)
-
-        report = get_classification_report(
-            y_true=y_test, y_pred=y_pred, y_score=y_score, beta=0.5
-        )
+                with timer.phase("h2d"):
+                    data, target = data.to(self.device), target.to(self.device)
+                    if self.precision == "bf16":
+                        data = data.to(torch.bfloat16)
+
+                # split the batch into micro-batches for gradient accumulation if memory is short
+                if micro_batch_size is not None and data.shape[0] > micro_batch_size:
+                    micro_batches = list(zip(data.split(micro_batch_size), target.split(micro_batch_size)))
+                else:
+                    micro_batches = [(data, target)]
+
+                for i, (micro_data, micro_target) in enumerate(micro_batches):
+                    weight = micro_data.shape[0] / data.shape[0]
+
+                    with timer.phase("forward"), torch.autocast(
+                        device_type=self.device.type,
+                        dtype=torch.bfloat16,
+                        enabled=self.precision == "bf16-autocast",
+                    ):
+                        if self.activation_meter is not None and is_train_dataset:
+                            with self.activation_meter:
+                                logits, additional_outputs = model(micro_data)
+                        else:
+                            logits, additional_outputs = model(micro_data)
+                    # loss and metrics are computed in fp32
+                    with timer.phase("criterion"):
+                        logits = logits.float()
+                        loss, loss_logs = self.criterion(
+                            logits=logits,
+                            target=micro_target,
+                            additional_outputs=additional_outputs
+                        )
+
+                    with timer.phase("metrics"):
+                        for key, value in loss_logs.items():
+                            loss_components[key] = loss_components.get(key, 0.0) + weight * value
+                        score = torch.softmax(logits.detach(), dim=-1)
+
+                        all_scores.append(score)
+                        all_targets.append(micro_target)
+                        total_loss += weight * loss.detach()
+
+                    if is_train_dataset:
+                        self.do_update(
+                            weight * loss,
+                            zero_grad=i == 0,
+                            step=i == len(micro_batches) - 1,
+                        )
+                    elif ds_name not in ["train", "valid"]:
+                        if self.precision != "fp32":
+                            micro_data = micro_data.float()
+                            additional_outputs = {
+                                key: value.float() if torch.is_tensor(value) and value.is_floating_point() else value
+                                for key, value in additional_outputs.items()
+                            }
+                        try:
+                            self.model.save_data(self.cfg, ds_name, micro_data, micro_target, additional_outputs)
+                        except:
+                            pass
+
+                if is_train_dataset and self.profiler is not None:
+                    self.profiler.step()
+
+        with timer.phase("metrics"):
+            y_test = torch.cat(all_targets)
+            y_score = torch.cat(all_scores)
+            epoch_metrics = classification_metrics(y_test, y_score)
+
+            average_time = (time.time() - start_time) / n_samples
+            average_loss = total_loss.item() / n_batches
+            loss_components = {key: float(value) / n_batches for key, value in loss_components.items()}
+
+        accuracy, score = epoch_metrics["accuracy"].item(), epoch_metrics["auc"].item()
+        # full classification report is built only for the test datasets;
+        # the final test metrics come from it, so that they are comparable with the earlier results
+        if ds_name not in ["train", "valid"]:
+            y_test, y_score = y_test.cpu().numpy(), y_score.cpu().numpy()
+            report = get_classification_report(
+                y_true=y_test,
+                y_pred=np.argmax(y_score, axis=-1).astype(np.int32),
+                y_score=y_score,
+                beta=0.5,
+            )
+            report.to_csv(f"{self.save_path}/{ds_name}_report.csv")
+            accuracy, score = report["precision"].loc["accuracy"], report["auc"].loc["weighted"]
 
         metrics = {
-            ds_name + "_accuracy": report["precision"].loc["accuracy"],
-            ds_name + "_score": report["auc"].loc["weighted"],
+            ds_name + "_accuracy": accuracy,
+            ds_name + "_score": score,
             ds_name + "_average_loss": average_loss,
             ds_name + "_average_inf_time": average_time,
             **{f"{ds_name}_{key}": value for key, value in loss_components.items()},
         }
+        if self.activation_meter is not None and is_train_dataset:
+            metrics[ds_name + "_activation_mb"] = self.activation_meter.peak / 2**20
+        metrics.update(timer.results(ds_name))
 
         return metrics
 
-    def do_update(self, loss):
+    def do_update(self, loss, zero_grad=True, step=True):
         """
-        Used to update weights once the loss is computed. It is moved here for easier inheritance
+        Used to update weights once the loss is computed. It is moved here for easier inheritance.
+        With gradient accumulation, gradients are zeroed before the first micro-batch,
+        and weights are updated after the last one.
         """
-        self.optimizer.zero_grad()
-        loss.backward()
+        if zero_grad:
+            self.optimizer.zero_grad()
+        with self.phase_timer.phase("backward"):
+            loss.backward()
+        if not step:
+            return
+        with self.phase_timer.phase("step"):
+            self.optimizer_step()
+
+    def optimizer_step(self):
+        """Update the weights with the accumulated gradients"""
+        if self.compute_model is not self.model:
+            # move bf16 gradients to the fp32 master weights
+            for master_param, param in zip(self.model.parameters(), self.compute_model.parameters()):
+                if param.grad is not None:
+                    master_param.grad = param.grad.float()
+            self.compute_model.zero_grad(set_to_none=True)
         self.optimizer.step()
+        if self.compute_model is not self.model:
+            with torch.no_grad():
+                for master_param, param in zip(self.model.parameters(), self.compute_model.parameters()):
+                    param.copy_(master_param)
+                # buffers (e.g. BatchNorm stats) are updated by the compute model
+                for master_buffer, buffer in zip(self.model.buffers(), self.compute_model.buffers()):
+                    master_buffer.copy_(buffer)
         if isinstance(self.scheduler, torch.optim.lr_scheduler.OneCycleLR):
             self.scheduler.step()
 
+    def sync_compute_model(self):
+        """In bf16 mode, copy the fp32 master weights and buffers to the bf16 compute model"""
+        with torch.no_grad():
+            for master_param, param in zip(self.model.parameters(), self.compute_model.parameters()):
+                param.copy_(master_param)
+            for master_buffer, buffer in zip(self.model.buffers(), self.compute_model.buffers()):
+                buffer.copy_(master_buffer)
+
     def train(self):
         """Start training"""
         start_time = time.time()
 
-        train_log_savepath = f"{self.save_path}/train_log.csv"
+        metrics_writer = MetricsWriter(
+            f"{self.save_path}/train_log",
+            fmt=self.cfg.mode.metrics_format if "metrics_format" in self.cfg.mode else "csv",
+            flush_every=self.cfg.mode.metrics_flush_every if "metrics_flush_every" in self.cfg.mode else 10,
+            flush_seconds=self.cfg.mode.metrics_flush_seconds if "metrics_flush_seconds" in self.cfg.mode else 60,
+        )
+        if "micro_batching" in self.cfg.mode and self.cfg.mode.micro_batching:
+            self.probe_micro_batch_size()
+
         train_results = []
-        for epoch in tqdm(range(self.epochs)):
-            # run train and valid dataloaders
-            results = self.run_epoch("train")
-            results.update(self.run_epoch("valid"))
-            results["epoch"] = epoch
-
-            # save results
-            pd.DataFrame([results]).to_csv(
-                train_log_savepath,
-                mode="a",
-                header=not os.path.exists(train_log_savepath),
-                index=False,
+        self.epochs_run = 0
+        start_epoch = 0
+        # continue the interrupted training from its last saved state
+        if "resume" in self.cfg and self.cfg.resume and os.path.exists(self.train_state_path):
+            start_epoch, elapsed_time = self.load_train_state()
+            start_time -= elapsed_time
+            self.epochs_run = start_epoch
+            # drop the logs of the epochs after the saved state
+            metrics_writer.truncate(start_epoch)
+        last_state_time = time.time()
+
+        # asynchronous validation runs on a weight snapshot, while the next epoch is training
+        valid_pool = None
+        if self.async_valid or self.resume_valid_epoch is not None:
+            valid_pool = ThreadPoolExecutor(max_workers=1)
+            self.valid_model = copy_model(self.compute_model)
+            # in bf16 mode early stopping keeps the fp32 master weights of the snapshot
+            if self.compute_model is not self.model:
+                self.valid_master = copy_model(self.model, recompile=False)
+            else:
+                self.valid_master = self.valid_model
+        pending = None  # (epoch, future) of the running asynchronous validation
+        if self.resume_valid_epoch is not None:
+            # restart the validation that was running when the training state was saved
+            pending = self.submit_validation(self.resume_valid_epoch, valid_pool)
+
+        if self.profile_steps:
+            self.profiler = trace_profiler(f"{self.cfg.run_dir}/profiler_trace.json", self.profile_steps)
+            self.profiler.start()
+        # per-module forward/backward times (after the validation snapshot is copied, so it has no hooks)
+        module_timer = None
+        if "profile_modules" in self.cfg.mode and self.cfg.mode.profile_modules:
+            module_timer = ModuleTimer(
+                self.compute_model,
+                modules=self.cfg.mode.profile_modules,
+                backward=self.cfg.mode.profile_modules_backward if "profile_modules_backward" in self.cfg.mode else True,
             )
-            train_results.append(results)
 
-            # update scheduler
-            if not isinstance(self.scheduler, torch.optim.lr_scheduler.OneCycleLR):
-                self.scheduler.step(results["valid_average_loss"])
+        try:
+            for epoch in tqdm(range(start_epoch, self.epochs), initial=start_epoch, total=self.epochs):
+                self.epochs_run = epoch + 1
+                # run train dataloader
+                results = self.run_epoch("train")
+                results["epoch"] = epoch
+                state_due = (
+                    self.train_state_every is not None
+                    and time.time() - last_state_time >= self.train_state_every
+                )
 
-            # check early stopping criterion
-            self.early_stopping(results["valid_average_loss"], self.model, epoch)
-            if self.early_stopping.early_stop:
-                break
+                # the previous epoch's validation ran concurrently with this epoch's training,
+                # its results are applied and logged one epoch late (with its 'valid_epoch')
+                if pending is not None:
+                    results.update(self.finish_validation(*pending))
+                    pending = None
+
+                # run valid dataloader
+                if self.should_validate(epoch) and not self.early_stopping.early_stop:
+                    # the last epoch is validated synchronously
+                    if self.async_valid and epoch != self.epochs - 1:
+                        pending = self.submit_validation(epoch, valid_pool)
+                    else:
+                        valid_results = self.run_epoch("valid")
+                        self.apply_validation(epoch, valid_results, self.model)
+                        results.update(valid_results)
+
+                # save results, with the process memory after the epoch
+                results.update(memory_snapshot(self.device))
+                metrics_writer.write(results)
+                train_results.append(results)
+
+                for callback in self.epoch_callbacks:
+                    callback(epoch, results)
+
+                if self.early_stopping.early_stop:
+                    break
+
+                # save resumable training state, at most every train_state_every seconds
+                if state_due:
+                    # the logs must cover the saved state
+                    metrics_writer.flush()
+                    # the running validation is not part of the state, it is restarted on resume
+                    self.save_train_state(
+                        epoch,
+                        time.time() - start_time,
+                        pending_valid_epoch=pending[0] if pending is not None else None,
+                    )
+                    last_state_time = time.time()
+        finally:
+            if valid_pool is not None:
+                valid_pool.shutdown(wait=True)
+            if self.profiler is not None:
+                self.profiler.stop()
+                self.profiler = None
+            if module_timer is not None:
+                module_timer.remove()
+                module_timer.summary().to_csv(f"{self.save_path}/module_profile.csv", index=False)
+            # write the buffered logs, also if training crashed
+            metrics_writer.close()
 
         if self.early_stopping.early_stop:
             print("EarlyStopping triggered")
 
         self.training_time = time.time() - start_time
 
+        # training is finished, the state is not needed anymore
+        if os.path.exists(self.train_state_path):
+            os.remove(self.train_state_path)
+
+    def should_validate(self, epoch):
+        """
+        Validate every valid_every epochs and on the last epoch.
+        With valid_adaptive, validate every epoch when early stopping is due within valid_every epochs
+        """
+        if epoch == self.epochs - 1 or (epoch + 1) % self.valid_every == 0:
+            return True
+        if self.valid_adaptive and self.early_stopping.best_epoch is not None:
+            epochs_left = self.early_stopping.patience - (epoch - self.early_stopping.best_epoch)
+            return epochs_left <= self.valid_every
+        return False
+
+    def apply_validation(self, epoch, valid_results, model):
+        """Update scheduler and early stopping with the validation results of the model weights after `epoch`"""
+        if not isinstance(self.scheduler, torch.optim.lr_scheduler.OneCycleLR):
+            self.scheduler.step(valid_results["valid_average_loss"])
+        self.early_stopping(valid_results["valid_average_loss"], model, epoch)
+
+    def submit_validation(self, epoch, valid_pool):
+        """Snapshot the weights after `epoch` and validate them on the background thread, return (epoch, future)"""
+        self.valid_model.load_state_dict(self.compute_model.state_dict())
+        if self.valid_master is not self.valid_model:
+            self.valid_master.load_state_dict(self.model.state_dict())
+        return epoch, valid_pool.submit(self.run_epoch_safely, "valid", self.valid_model, self.micro_batch_size)
+
+    def finish_validation(self, epoch, future):
+        """Wait for the asynchronous validation of the weights after `epoch`, apply and return its results"""
+        valid_results, micro_batch_size = future.result()
+        # the validation thread doesn't change the trainer, a micro-batch size reduced on OOM is applied here
+        if micro_batch_size is not None and (self.micro_batch_size is None or micro_batch_size < self.micro_batch_size):
+            self.set_micro_batch_size(micro_batch_size, reason="OOM in validation")
+        self.apply_validation(epoch, valid_results, self.valid_master)
+        return {**valid_results, "valid_epoch": epoch}
+
+    def save_train_state(self, epoch, elapsed_time, pending_valid_epoch=None):
+        """
+        Atomically save everything needed to continue training after the given epoch:
+        model, optimizer, scheduler, early stopping, and RNG states,
+        and the epoch of the asynchronous validation not yet applied to early stopping (pending_valid_epoch)
+        """
+        state = {
+            "epoch": epoch,
+            "elapsed_time": elapsed_time,
+            "pending_valid_epoch": pending_valid_epoch,
+            "model": self.model.state_dict(),
+            "optimizer": self.optimizer.state_dict(),
+            "scheduler": self.scheduler.state_dict() if hasattr(self.scheduler, "state_dict") else None,
+            "early_stopping": {
+                "counter": self.early_stopping.counter,
+                "best_score": self.early_stopping.best_score,
+                "best_epoch": self.early_stopping.best_epoch,
+                "best_state": self.early_stopping.best_state,
+            },
+            "micro_batch_size": self.micro_batch_size,
+            "rng": {
+                "torch": torch.get_rng_state(),
+                "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+                "numpy": np.random.get_state(),
+                "python": random.getstate(),
+            },
+        }
+        tmp_path = f"{self.train_state_path}.tmp"
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, self.train_state_path)
+
+    def load_train_state(self):
+        """Restore the saved training state, return the epoch to start from and the elapsed training time"""
+        state = torch.load(self.train_state_path, map_location="cpu", weights_only=False)
+        epoch = state["epoch"]
+        print(f"Resuming training after epoch {epoch}")
+
+        self.model.load_state_dict(state["model"])
+        if self.compute_model is not self.model:
+            self.sync_compute_model()
+        self.optimizer.load_state_dict(state["optimizer"])
+        if state["scheduler"] is not None:
+            self.scheduler.load_state_dict(state["scheduler"])
+
+        self.early_stopping.counter = state["early_stopping"]["counter"]
+        self.early_stopping.best_score = state["early_stopping"]["best_score"]
+        self.early_stopping.best_epoch = state["early_stopping"].get("best_epoch")
+        self.early_stopping.best_state = state["early_stopping"]["best_state"]
+        if self.early_stopping.writer is not None:
+            self.early_stopping.writer.submit(self.early_stopping.best_state)
+        if state["micro_batch_size"] is not None:
+            self.micro_batch_size = state["micro_batch_size"]
+        self.resume_valid_epoch = state.get("pending_valid_epoch")
+
+        torch.set_rng_state(state["rng"]["torch"])
+        if state["rng"]["cuda"] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state["rng"]["cuda"])
+        np.random.set_state(state["rng"]["numpy"])
+        random.setstate(state["rng"]["python"])
+
+
+        return epoch + 1, state["elapsed_time"]
+
     def test(self):
         """Start testing"""
         for key in self.dataloaders:
@@ -303,42 +727,91 @@ class BasicTrainer:
         test_results = pd.DataFrame(self.test_results, index=[0])
         test_results.to_csv(f"{self.save_path}/test_log.csv", index=False)
 
+    def validate_precision(self):
+        """
+        Re-evaluate the test datasets in fp32 and check that the reduced precision
+        test scores are within cfg.model.precision_tolerance of the fp32 scores
+        """
+        if "precision_tolerance" in self.cfg.model and self.cfg.model.precision_tolerance is not None:
+            tolerance = self.cfg.model.precision_tolerance
+        else:
+            tolerance = 0.01
+
+        precision, compute_model = self.precision, self.compute_model
+        self.precision, self.compute_model = "fp32", self.model
+        try:
+            for key in self.dataloaders:
+                if key not in ["train", "valid"]:
+                    fp32_score = self.run_epoch_for_real(key, micro_batch_size=self.micro_batch_size)[f"{key}_score"]
+                    score_diff = abs(self.test_results[f"{key}_score"] - fp32_score)
+                    self.test_results[f"{key}_score_fp32"] = fp32_score
+                    self.test_results[f"{key}_precision_ok"] = score_diff <= tolerance
+                    if score_diff > tolerance:
+                        print(
+                            f"Warning: {precision} {key}_score differs from fp32 by {score_diff:.4f} \
+                            (tolerance {tolerance})"
+                        )
+        finally:
+            self.precision, self.compute_model = precision, compute_model
+
+        # update the test log with the fp32 results
+        test_results = pd.DataFrame(self.test_results, index=[0])
+        test_results.to_csv(f"{self.save_path}/test_log.csv", index=False)
+
     def run(self):
         """Run training script"""
 
         print("Training model")
-        self.train()
+        with span("train", run_dir=self.cfg.run_dir):
+            self.train()
 
         print("Loading best model")
-        model_logpath = f"{self.save_path}/best_model.pt"
-        checkpoint = torch.load(
-            model_logpath, map_location=lambda storage, loc: storage
-        )
-        self.model.load_state_dict(checkpoint)
+        with span("load_best_model"):
+            self.model.load_state_dict(self.early_stopping.best_state)
+            if self.compute_model is not self.model:
+                self.sync_compute_model()
 
         print("Testing trained model")
         self.test_results = {}
         self.test_results["training_time"] = self.training_time
         self.test_results["params"] = self.cfg.params
-        self.test()
+        self.test_results["trainable_params"] = self.count_params(self.model, only_requires_grad=True)
+        self.test_results["epoch_time"] = self.training_time / max(self.epochs_run, 1)
+        # peak memory of the run, summarized in runs.csv
+        memory = log_memory(self.cfg, "train", device=self.device, epochs=self.epochs_run)
+        self.test_results["peak_rss_mb"] = memory["peak_rss_mb"]
+        if "cuda_peak_mb" in memory:
+            self.test_results["cuda_peak_mb"] = memory["cuda_peak_mb"]
+        with span("test"):
+            self.test()
+        if self.precision != "fp32":
+            with span("validate_precision"):
+                self.validate_precision()
         print("Test results:")
         pprint(self.test_results, indent=2)
         print("Done!")
 
-        if not self.cfg.mode.preserve_checkpoints:
-            os.remove(f"{self.save_path}/best_model.pt")
+        # wait for the best checkpoint to be written
+        with span("write_checkpoint"):
+            self.early_stopping.close()
 
         return self.test_results
 
 
 class EarlyStopping:
-    """Early stops the training if the given score does not improve after a given patience."""
+    """
+    Early stops the training if the given score does not improve for `patience` epochs
+    (epochs, not calls, so that validation may happen less often than every epoch).
+    The best model is kept as an in-memory CPU snapshot (best_state);
+    if persist is True, it is also written to best_model.pt on a background thread
+    """
 
     def __init__(
         self,
         path: str,
         minimize: bool,
         patience: int = 30,
+        persist: bool = True,
     ):
         assert minimize in [True, False]
 
@@ -347,11 +820,16 @@ class EarlyStopping:
         self.patience = patience
         self.counter = 0
         self.best_score = None
+        self.best_epoch = None
         self.early_stop = False
 
+        self.best_state = None
+        self.writer = CheckpointWriter(f"{path}/best_model.pt") if persist else None
+
     def __call__(self, new_score, model, epoch):
         if self.best_score is None:
             self.best_score = new_score
+            self.best_epoch = epoch
             self.save_checkpoint(model)
         else:
             if self.minimize:
@@ -362,19 +840,187 @@ class EarlyStopping:
             if change > 0.0:
                 self.counter = 0
                 self.best_score = new_score
+                self.best_epoch = epoch
                 self.save_checkpoint(model)
             else:
-                self.counter += 1
+                # epochs since the best score
+                self.counter = epoch - self.best_epoch
                 if self.counter >= self.patience:
                     self.early_stop = True
 
     def save_checkpoint(self, model):
         # based on callback from animus package
-        """Saves model if criterion is met"""
+        """Saves model snapshot if criterion is met"""
         if isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
             model = model.module
 
         if issubclass(model.__class__, torch.nn.Module):
-            torch.save(model.state_dict(), f"{self.path}/best_model.pt")
+            self.best_state = {
+                key: value.detach().to("cpu", copy=True)
+                for key, value in model.state_dict().items()
+            }
+        else:
+            self.best_state = deepcopy(model)
+
+        if self.writer is not None:
+            self.writer.submit(self.best_state)
+
+    def close(self):
+        """Wait until the best checkpoint is written to disk, may be called more than once"""
+        writer, self.writer = self.writer, None
+        if writer is not None:
+            writer.close()
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints to path on a background thread.
+    Only the latest submitted checkpoint is written if several are submitted while a write is in progress;
+    files are replaced atomically, so path always holds a complete checkpoint
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = None
+        self.error = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, checkpoint):
+        """Schedule checkpoint for writing, replacing the not yet written one"""
+        with self.condition:
+            self.pending = checkpoint
+            self.condition.notify()
+
+    def close(self):
+        """Write the pending checkpoint and stop the thread"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.closed:
+                    self.condition.wait()
+                if self.pending is None:
+                    return
+                checkpoint, self.pending = self.pending, None
+
+            try:
+                tmp_path = f"{self.path}.tmp"
+                torch.save(checkpoint, tmp_path)
+                os.replace(tmp_path, self.path)
+            except Exception as e:  # pylint: disable=broad-except
+                self.error = e
+
+
+class MetricsWriter:
+    """
+    Buffers metric rows (dicts) in memory and writes them to path + extension
+    every flush_every rows or flush_seconds seconds, and on close.
+    Formats:
+        csv - rows are appended to a .csv file;
+        parquet, arrow - the .parquet / Arrow IPC (.arrow) file is rewritten atomically on flush,
+            requires pyarrow (falls back to csv if it is not installed)
+    """
+
+    EXTENSIONS = {"csv": "csv", "parquet": "parquet", "arrow": "arrow"}
+
+    def __init__(self, path, fmt="csv", flush_every=10, flush_seconds=60):
+        if fmt not in self.EXTENSIONS:
+            raise ValueError(f"Unknown metrics format '{fmt}', use one of {list(self.EXTENSIONS)}")
+        if fmt != "csv":
+            try:
+                import pyarrow  # pylint: disable=import-outside-toplevel, unused-import
+            except ImportError:
+                print(f"pyarrow is not installed, writing metrics in csv instead of {fmt}")
+                fmt = "csv"
+
+        self.fmt = fmt
+        self.path = f"{path}.{self.EXTENSIONS[fmt]}"
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+
+        # rows already in the file are kept for the columnar formats, which are rewritten on flush
+        self.rows = self.read().to_dict("records") if fmt != "csv" and os.path.exists(self.path) else []
+        self.n_flushed = len(self.rows)
+        self.last_flush = time.time()
+        # don't lose the buffered rows if the process exits without closing the writer
+        atexit.register(self.flush)
+
+    def write(self, row):
+        """Add row, flush if needed"""
+        self.rows.append(row)
+        if (
+            len(self.rows) - self.n_flushed >= self.flush_every
+            or time.time() - self.last_flush >= self.flush_seconds
+        ):
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows"""
+        self.last_flush = time.time()
+        if len(self.rows) == self.n_flushed:
+            return
+
+        if self.fmt == "csv":
+            df = pd.DataFrame(self.rows[self.n_flushed :])
+            if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+                # rows may miss some columns (e.g., not validated epochs)
+                columns = pd.read_csv(self.path, nrows=0).columns
+                if set(df.columns) <= set(columns):
+                    with open(self.path, "a", encoding="utf8") as f:
+                        df.reindex(columns=columns).to_csv(f, header=False, index=False)
+                else:
+                    # new columns, rewrite the file with the extended header
+                    self.rewrite(pd.concat([self.read(), df], ignore_index=True))
+            else:
+                df.to_csv(self.path, index=False)
+            # written rows are not needed anymore
+            self.rows = []
+            self.n_flushed = 0
+        else:
+            self.rewrite(pd.DataFrame(self.rows))
+            self.n_flushed = len(self.rows)
+
+    def close(self):
+        """Write the buffered rows"""
+        self.flush()
+        atexit.unregister(self.flush)
+
+    def read(self):
+        """Return the written rows as a DataFrame"""
+        if self.fmt == "csv":
+            return pd.read_csv(self.path)
+        if self.fmt == "parquet":
+            return pd.read_parquet(self.path)
+        return pd.read_feather(self.path)
+
+    def truncate(self, n_epochs):
+        """Keep only the rows of the first n_epochs epochs in the file and the buffer"""
+        self.flush()
+        if not os.path.exists(self.path):
+            return
+        df = self.read()
+        df = df[df["epoch"] < n_epochs]
+        self.rewrite(df)
+        if self.fmt != "csv":
+            self.rows = df.to_dict("records")
+            self.n_flushed = len(self.rows)
+
+    def rewrite(self, df):
+        """Atomically replace the file with df"""
+        tmp_path = f"{self.path}.tmp"
+        if self.fmt == "csv":
+            df.to_csv(tmp_path, index=False)
+        elif self.fmt == "parquet":
+            df.to_parquet(tmp_path, index=False)
         else:
-            torch.save(model, f"{self.path}/best_model.pt")
+            df.reset_index(drop=True).to_feather(tmp_path)
+        os.replace(tmp_path, self.path)
@@ -2,6 +2,7 @@
 """Auxilary functions"""
 
 import os
+import fcntl
 import glob
 import shutil
 
@@ -139,7 +140,9 @@ def get_resume_params(cfg: DictConfig) -> DictConfig:
         except FileNotFoundError:
             interrupted_trial = 0
 
-        interrupted_dir = f"{search_dir}/trial_{interrupted_trial:04d}"
+        # trials are numbered by the optuna study, which is resumed from its storage;
+        # logs of the interrupted trials are kept
+        interrupted_dir = None
 
     elif cfg.mode.name == "exp":
         starting_k = max(len(glob.glob(f"{cfg.project_dir}/k_*")) - 1, 0)
@@ -152,11 +155,14 @@ def get_resume_params(cfg: DictConfig) -> DictConfig:
 
         interrupted_dir = f"{search_dir}/trial_{interrupted_trial:04d}"
 
-    print(f"Deleting interrupted run logs in '{interrupted_dir}'")
-    try:
-        shutil.rmtree(interrupted_dir)
-    except FileNotFoundError:
-        print("Could not delete interrupted run logs - FileNotFoundError")
+    if interrupted_dir is not None and os.path.exists(f"{interrupted_dir}/train_state.pt"):
+        print(f"Interrupted run in '{interrupted_dir}' will continue from its saved training state")
+    elif interrupted_dir is not None:
+        print(f"Deleting interrupted run logs in '{interrupted_dir}'")
+        try:
+            shutil.rmtree(interrupted_dir)
+        except FileNotFoundError:
+            print("Could not delete interrupted run logs - FileNotFoundError")
 
     if interrupted_trial == interrupted_cfg.mode.n_trials:
         interrupted_trial = 0
@@ -171,3 +177,15 @@ def get_resume_params(cfg: DictConfig) -> DictConfig:
         }
 
     return interrupted_cfg
+
+
+def append_csv(df: pd.DataFrame, path: str):
+    """Append df to a csv file (with header if the file is empty), safe for concurrent writers"""
+    with open(path, "a", encoding="utf8") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0, os.SEEK_END)
+            df.to_csv(f, header=f.tell() == 0, index=False)
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
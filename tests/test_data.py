@@ -0,0 +1,31 @@
+"""Shared memory arrays of src.data"""
+import pickle
+
+import numpy as np
+
+from src.data import SharedArray, attach_array
+
+
+def test_shared_array_pickled_as_path(tmp_path):
+    array = np.arange(24 * 1024, dtype=np.float32).reshape(24, 1024)
+    np.save(tmp_path / "main_data.npy", array)
+    shared = attach_array(str(tmp_path / "main_data.npy"))
+
+    payload = pickle.dumps(shared)
+    restored = pickle.loads(payload)
+
+    # the whole array is pickled as its file path, not as data
+    assert len(payload) < array.nbytes // 10
+    assert isinstance(restored, SharedArray)
+    np.testing.assert_array_equal(restored, array)
+
+
+def test_shared_array_view_pickled_as_array(tmp_path):
+    array = np.arange(24 * 16, dtype=np.float32).reshape(24, 16)
+    np.save(tmp_path / "main_data.npy", array)
+    shared = attach_array(str(tmp_path / "main_data.npy"))
+
+    restored = pickle.loads(pickle.dumps(shared[2:5]))
+
+    assert not isinstance(restored, SharedArray)
+    np.testing.assert_array_equal(restored, array[2:5])
@@ -0,0 +1,61 @@
+"""Rank-based metrics of src.metrics against scikit-learn"""
+import numpy as np
+import pytest
+import torch
+
+from src.metrics import classification_metrics
+
+sklearn_metrics = pytest.importorskip("sklearn.metrics")
+
+
+def random_scores(rng, n_samples, n_classes):
+    """Class probabilities with ties, as produced by low-precision softmax outputs"""
+    logits = np.round(rng.normal(size=(n_samples, n_classes)), 1)
+    scores = np.exp(logits) / np.exp(logits).sum(axis=1, keepdims=True)
+    return scores
+
+
+@pytest.mark.parametrize("n_classes", [2, 3, 5])
+@pytest.mark.parametrize("seed", range(5))
+def test_auc_matches_sklearn(n_classes, seed):
+    rng = np.random.default_rng(seed)
+    y_true = np.concatenate([np.arange(n_classes), rng.integers(0, n_classes, size=200)])
+    y_score = random_scores(rng, y_true.shape[0], n_classes)
+
+    metrics = classification_metrics(torch.from_numpy(y_true), torch.from_numpy(y_score))
+
+    if n_classes == 2:
+        expected = sklearn_metrics.roc_auc_score(y_true, y_score[:, 1])
+    else:
+        expected = sklearn_metrics.roc_auc_score(y_true, y_score, multi_class="ovr", average="weighted")
+    assert metrics["auc"].item() == pytest.approx(expected, abs=1e-10)
+    assert metrics["accuracy"].item() == pytest.approx(
+        sklearn_metrics.accuracy_score(y_true, y_score.argmax(axis=1))
+    )
+    np.testing.assert_array_equal(
+        metrics["confusion"].numpy(),
+        sklearn_metrics.confusion_matrix(y_true, y_score.argmax(axis=1), labels=range(n_classes)),
+    )
+
+
+def test_auc_ignores_absent_class():
+    rng = np.random.default_rng(0)
+    # class 2 is absent, its one-vs-rest AUC is undefined
+    y_true = rng.integers(0, 2, size=100)
+    y_score = random_scores(rng, y_true.shape[0], 3)
+
+    metrics = classification_metrics(torch.from_numpy(y_true), torch.from_numpy(y_score))
+
+    aucs = [sklearn_metrics.roc_auc_score(y_true == c, y_score[:, c]) for c in range(2)]
+    expected = np.average(aucs, weights=np.bincount(y_true))
+    assert metrics["auc"].item() == pytest.approx(expected, abs=1e-10)
+
+
+def test_auc_is_nan_for_single_class():
+    rng = np.random.default_rng(0)
+    y_true = np.zeros(50, dtype=np.int64)
+    y_score = random_scores(rng, y_true.shape[0], 2)
+
+    metrics = classification_metrics(torch.from_numpy(y_true), torch.from_numpy(y_score))
+
+    assert np.isnan(metrics["auc"].item())
@@ -0,0 +1,131 @@
+"""Resumable training state and buffered train logs of src.trainer"""
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+from torch import nn
+
+from src.model_utils import copy_model
+from src.trainer import BasicTrainer, EarlyStopping, MetricsWriter
+
+
+def make_trainer(run_dir, precision="fp32", seed=0):
+    """Trainer with only the attributes used by save_train_state/load_train_state"""
+    torch.manual_seed(seed)
+    trainer = BasicTrainer.__new__(BasicTrainer)
+    trainer.model = nn.Sequential(nn.Linear(4, 8), nn.BatchNorm1d(8), nn.ReLU(), nn.Linear(8, 2))
+    if precision == "bf16":
+        trainer.compute_model = copy_model(trainer.model).to(torch.bfloat16)
+    else:
+        trainer.compute_model = trainer.model
+    trainer.optimizer = torch.optim.Adam(trainer.model.parameters(), lr=1e-2)
+    trainer.scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(trainer.optimizer, patience=2)
+    trainer.early_stopping = EarlyStopping(path=str(run_dir), minimize=True, persist=False)
+    trainer.micro_batch_size = None
+    trainer.train_state_path = f"{run_dir}/train_state.pt"
+    trainer.resume_valid_epoch = None
+    return trainer
+
+
+def assert_state_equal(expected, actual):
+    """Compare nested state dicts"""
+    if isinstance(expected, dict):
+        assert expected.keys() == actual.keys()
+        for key in expected:
+            assert_state_equal(expected[key], actual[key])
+    elif isinstance(expected, (list, tuple)):
+        assert len(expected) == len(actual)
+        for expected_item, actual_item in zip(expected, actual):
+            assert_state_equal(expected_item, actual_item)
+    elif isinstance(expected, torch.Tensor):
+        torch.testing.assert_close(actual, expected, rtol=0, atol=0)
+    else:
+        assert expected == actual
+
+
+@pytest.mark.parametrize("precision", ["fp32", "bf16"])
+def test_train_state_round_trip(tmp_path, precision):
+    trainer = make_trainer(tmp_path, precision)
+    for epoch in range(3):
+        trainer.model.train()
+        loss = trainer.model(torch.randn(16, 4)).sum()
+        trainer.optimizer.zero_grad()
+        loss.backward()
+        trainer.optimizer.step()
+        trainer.scheduler.step(loss.item())
+        trainer.early_stopping(-loss.item(), trainer.model, epoch)
+    trainer.micro_batch_size = 4
+    trainer.save_train_state(epoch=2, elapsed_time=12.5, pending_valid_epoch=2)
+    expected_random = (torch.rand(3), np.random.rand(3), random.random())
+
+    resumed = make_trainer(tmp_path, precision, seed=1)
+    start_epoch, elapsed_time = resumed.load_train_state()
+
+    assert (start_epoch, elapsed_time) == (3, 12.5)
+    assert_state_equal(trainer.model.state_dict(), resumed.model.state_dict())
+    assert_state_equal(trainer.optimizer.state_dict(), resumed.optimizer.state_dict())
+    assert_state_equal(trainer.scheduler.state_dict(), resumed.scheduler.state_dict())
+    for key in ["counter", "best_score", "best_epoch"]:
+        assert getattr(resumed.early_stopping, key) == getattr(trainer.early_stopping, key)
+    assert_state_equal(trainer.early_stopping.best_state, resumed.early_stopping.best_state)
+    assert resumed.micro_batch_size == 4
+    assert resumed.resume_valid_epoch == 2
+    # the compute model runs on the restored master weights
+    for param, compute_param in zip(resumed.model.parameters(), resumed.compute_model.parameters()):
+        torch.testing.assert_close(compute_param, param.to(compute_param.dtype), rtol=0, atol=0)
+    # the random streams continue where the saved run was
+    torch.testing.assert_close(torch.rand(3), expected_random[0])
+    np.testing.assert_array_equal(np.random.rand(3), expected_random[1])
+    assert random.random() == expected_random[2]
+
+
+def metrics_formats():
+    """Formats of MetricsWriter available here, the columnar ones require pyarrow"""
+    formats = ["csv"]
+    try:
+        import pyarrow  # pylint: disable=import-outside-toplevel, unused-import
+    except ImportError:
+        return formats
+    return formats + ["parquet", "arrow"]
+
+
+def epoch_row(epoch):
+    """Train log row, validated every other epoch"""
+    row = {"epoch": epoch, "train_average_loss": 1.0 / (epoch + 1)}
+    if epoch % 2 == 1:
+        row["valid_average_loss"] = 2.0 / (epoch + 1)
+    return row
+
+
+@pytest.mark.parametrize("fmt", metrics_formats())
+def test_metrics_round_trip(tmp_path, fmt):
+    writer = MetricsWriter(f"{tmp_path}/train_log", fmt=fmt, flush_every=3, flush_seconds=60)
+    for epoch in range(8):
+        writer.write(epoch_row(epoch))
+    writer.close()
+
+    df = writer.read()
+    expected = pd.DataFrame([epoch_row(epoch) for epoch in range(8)])
+    pd.testing.assert_frame_equal(df[expected.columns], expected, check_dtype=False)
+
+
+@pytest.mark.parametrize("fmt", metrics_formats())
+def test_metrics_truncated_on_resume(tmp_path, fmt):
+    writer = MetricsWriter(f"{tmp_path}/train_log", fmt=fmt, flush_every=3, flush_seconds=60)
+    for epoch in range(8):
+        writer.write(epoch_row(epoch))
+    writer.close()
+
+    # resumed after epoch 4: the rows of the later epochs are dropped and logged again
+    resumed = MetricsWriter(f"{tmp_path}/train_log", fmt=fmt, flush_every=3, flush_seconds=60)
+    resumed.truncate(5)
+    assert resumed.read()["epoch"].tolist() == list(range(5))
+    for epoch in range(5, 7):
+        resumed.write(epoch_row(epoch))
+    resumed.close()
+
+    df = resumed.read()
+    expected = pd.DataFrame([epoch_row(epoch) for epoch in range(7)])
+    pd.testing.assert_frame_equal(df[expected.columns], expected, check_dtype=False)